@@ -45,9 +45,13 @@ setup(
     version='2.0.8',
     url='https://github.com/VRGhost/sqlalchemy-fsm',
     install_requires=[
-        'SQLAlchemy>=1.0.0',
+        'SQLAlchemy>=1.2.0',
         'six>=1.10.0',
+        'futures>=3.0.0; python_version < "3.0"',
     ],
+    extras_require={
+        'columnar': ['numpy'],
+    },
     setup_requires=['pytest-runner'],
     tests_require=['pytest']
 )
@@ -1,10 +1,12 @@
 from . import (
     exc,
     events,
+    conditions,
+    scheduled,
 )
 
-from .sqltypes import FSMField
+from .sqltypes import FSMField, FSMTimestamp
 
-from .transition import transition
+from .transition import transition, InStateMixin
 
 __version__ = '2.0.8'
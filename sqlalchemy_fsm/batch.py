@@ -0,0 +1,324 @@
+"""Process-pool batch execution of transitions.
+
+Transition handlers that are CPU-bound do not benefit from threads,
+so `run()` ships column values of the records to worker processes,
+runs the handlers there on detached copies of the records and applies
+the resulting changes back in the parent session in bulk.
+"""
+
+import importlib
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy
+
+from sqlalchemy import inspect as sqla_inspect
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import cache, statements, util
+from .bound import COLUMN_CACHE
+from .transition import get_prefetch_options, get_prefetch_paths
+
+
+class TransitionRef(object):
+    """Picklable reference to a transition of a model class.
+
+    Resolved by model import path and transition attribute name
+    (e.g. `TransitionRef('myapp.models:Order', 'published')`).
+    """
+
+    __slots__ = ("model_path", "name")
+
+    def __init__(self, model_path, name):
+        self.model_path = model_path
+        self.name = name
+
+    @classmethod
+    def for_transition(cls, class_bound_transition):
+        """Make a reference out of `Model.transition` object."""
+        owner = class_bound_transition._sa_fsm_owner_cls
+        model_path = '{}:{}'.format(
+            owner.__module__,
+            getattr(owner, '__qualname__', owner.__name__)
+        )
+        return cls(model_path, class_bound_transition._sa_fsm_name)
+
+    @property
+    def model(self):
+        (module_name, cls_path) = self.model_path.split(':', 1)
+        out = importlib.import_module(module_name)
+        for name in cls_path.split('.'):
+            out = getattr(out, name)
+        return out
+
+    def resolve(self):
+        """Return class-bound transition this reference points to."""
+        return getattr(self.model, self.name)
+
+    def __reduce__(self):
+        return (self.__class__, (self.model_path, self.name))
+
+    def __eq__(self, other):
+        return isinstance(other, TransitionRef) and (
+            (self.model_path, self.name) == (other.model_path, other.name)
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.model_path, self.name))
+
+    def __repr__(self):
+        return "<{} {}.{}>".format(
+            self.__class__.__name__, self.model_path, self.name)
+
+
+class BatchResult(object):
+    """Outcome of the batch `run()`."""
+
+    __slots__ = ("processed", "changed", "conflicts", "failures")
+
+    def __init__(self):
+        self.processed = 0
+        self.changed = 0
+        # Changes not written as the state of the record has changed
+        #   since it was read
+        self.conflicts = 0
+        # List of (primary key, error description) tuples
+        self.failures = []
+
+    def __repr__(self):
+        return "<{} processed={} changed={} conflicts={} " \
+            "failures={}>".format(
+                self.__class__.__name__, self.processed,
+                self.changed, self.conflicts, len(self.failures)
+            )
+
+
+@cache.dictCache
+def CasUpdateCache(key):
+    """UPDATE of the `columns` that only matches if the record
+    is still in the state it was read in."""
+    (pk_column, state_column, columns) = key
+    return pk_column.table.update().where(sqlalchemy.and_(
+        pk_column == sqlalchemy.bindparam('sa_fsm_pk'),
+        state_column.isnot_distinct_from(
+            sqlalchemy.bindparam('sa_fsm_source')),
+    )).values(dict(
+        (column, sqlalchemy.bindparam(_get_value_param(column)))
+        for column in columns
+    ))
+
+
+def _get_value_param(column):
+    return 'sa_fsm_value_{}'.format(column.name)
+
+
+def _write_changes(session, mapper, pk_column, state_column, mappings):
+    """Write (source state, {column: value}) `mappings` of the records
+    with compare-and-swap UPDATEs.
+
+    Returns number of the records written.
+    """
+    by_columns = {}
+    for (pk, source, changes) in mappings:
+        params = dict(
+            (_get_value_param(column), value)
+            for (column, value) in changes.items()
+        )
+        params.update(sa_fsm_pk=pk, sa_fsm_source=source)
+        columns = tuple(sorted(changes, key=lambda column: column.name))
+        by_columns.setdefault(columns, []).append(params)
+
+    multi_rowcount = session.get_bind(
+        mapper).dialect.supports_sane_multi_rowcount
+    out = 0
+    for (columns, params) in by_columns.items():
+        update = CasUpdateCache.getValue((pk_column, state_column, columns))
+        if multi_rowcount:
+            out += statements.execute(session, update, params, mapper).rowcount
+        else:
+            for el in params:
+                out += statements.execute(
+                    session, update, el, mapper).rowcount
+    return out
+
+
+def _get_path_tree(paths):
+    """{'a': {'b': {}}} out of ['a.b'] relationship paths."""
+    out = {}
+    for path in paths:
+        node = out
+        for name in path.split('.'):
+            node = node.setdefault(name, {})
+    return out
+
+
+def _dump_record(record, tree):
+    """Column values of the `record` & the related records in the `tree`."""
+    mapper = sqla_inspect(record).mapper
+    out = dict(
+        (prop.key, getattr(record, prop.key)) for prop in mapper.column_attrs
+    )
+    for (name, sub_tree) in tree.items():
+        value = getattr(record, name)
+        if value is None:
+            out[name] = None
+        elif mapper.relationships[name].uselist:
+            out[name] = [_dump_record(el, sub_tree) for el in value]
+        else:
+            out[name] = _dump_record(value, sub_tree)
+    return out
+
+
+def _load_record(mapper, values):
+    """Detached record made of `_dump_record()` output."""
+    out = mapper.class_manager.new_instance()
+    relationships = mapper.relationships
+    for (key, value) in values.items():
+        if key in relationships and value is not None:
+            rel_mapper = relationships[key].mapper
+            if isinstance(value, list):
+                value = [_load_record(rel_mapper, el) for el in value]
+            else:
+                value = _load_record(rel_mapper, value)
+        set_committed_value(out, key, value)
+    return out
+
+
+def _run_chunk(ref, pk_key, rows, args, kwargs):
+    """Worker-side transition of a single chunk of records.
+
+    Returns a list of `(pk, changed_values, error)` tuples.
+    """
+    mapper = sqla_inspect(ref.model)
+    column_keys = set(prop.key for prop in mapper.column_attrs)
+    out = []
+    for values in rows:
+        record = _load_record(mapper, values)
+        values = dict(
+            (key, value) for (key, value) in values.items()
+            if key in column_keys
+        )
+        try:
+            getattr(record, ref.name).set(*args, **kwargs)
+        except Exception as err:
+            out.append((
+                values[pk_key], None,
+                '{}: {}'.format(type(err).__name__, err)
+            ))
+            continue
+        changes = dict(
+            (key, getattr(record, key))
+            for (key, value) in values.items()
+            if getattr(record, key) != value
+        )
+        out.append((values[pk_key], changes, None))
+    return out
+
+
+def run(
+    session, query, transition, args=(), kwargs=None,
+    chunk_size=1000, max_workers=None, executor=None, max_in_flight=None
+):
+    """Apply `transition` to all records matched by `query`.
+
+    `transition` is the class-bound transition (e.g. `Model.published`),
+    `args` and `kwargs` are passed to its `set()` call.
+
+    Handlers run in worker processes on records that are not attached
+    to any session, so they can only touch column attributes of the
+    record and the relationships the transition declares in `prefetch`
+    (these are loaded once per chunk and shipped to the workers too,
+    changes of the related records are not written back). State change
+    events fire in the worker processes too.
+
+    At most `max_in_flight` chunks (twice the number of workers by default)
+    are submitted to the `executor` at once.
+
+    The resulting changes are written with compare-and-swap UPDATEs
+    that only match if the record is still in the state it was read in,
+    changes of the records that have been moved by someone else since
+    are dropped (and counted in `BatchResult.conflicts`). Models mapped
+    to several tables are written with `bulk_update_mappings()` instead
+    (the last writer wins). Committing is left to the caller.
+    """
+    ref = TransitionRef.for_transition(transition)
+    mapper = sqla_inspect(ref.model)
+    pk_column = util.get_single_pk_column(mapper)
+    pk_key = mapper.get_property_by_column(pk_column).key
+    state_column = COLUMN_CACHE.getValue(ref.model)
+    state_key = mapper.get_property_by_column(state_column).key
+    # Compare-and-swap writes are only made to a single table
+    cas = len(mapper.tables) == 1
+    column_props = mapper.column_attrs
+    columns = [prop.columns[0] for prop in column_props]
+    keys = [prop.key for prop in column_props]
+    kwargs = dict(kwargs or {})
+    prefetch = get_prefetch_options(transition)
+    prefetch_tree = _get_path_tree(get_prefetch_paths(transition))
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    if max_in_flight is None:
+        max_in_flight = 2 * (max_workers or multiprocessing.cpu_count())
+
+    result = BatchResult()
+    # (future, {pk: source state}) of the submitted chunks
+    in_flight = []
+
+    def _apply(chunk):
+        (future, sources) = chunk
+        mappings = []
+        for (pk, changes, error) in future.result():
+            result.processed += 1
+            if error is not None:
+                result.failures.append((pk, error))
+            elif changes and cas:
+                mappings.append((pk, sources[pk], dict(
+                    (mapper.get_property(key).columns[0], value)
+                    for (key, value) in changes.items()
+                )))
+            elif changes:
+                changes[pk_key] = pk
+                mappings.append(changes)
+        if not mappings:
+            return
+        if cas:
+            written = _write_changes(
+                session, mapper, pk_column, state_column, mappings)
+            result.conflicts += len(mappings) - written
+            result.changed += written
+        else:
+            session.bulk_update_mappings(mapper, mappings)
+            result.changed += len(mappings)
+
+    try:
+        for pks in util.iter_pk_chunks(query, pk_column, chunk_size):
+            if prefetch:
+                rows = [
+                    _dump_record(record, prefetch_tree)
+                    for record in session.query(ref.model).filter(
+                        pk_column.in_(pks)).options(*prefetch)
+                ]
+            else:
+                rows = [
+                    dict(zip(keys, row))
+                    for row in session.query(*columns).filter(
+                        pk_column.in_(pks))
+                ]
+            sources = dict((row[pk_key], row[state_key]) for row in rows)
+            in_flight.append((executor.submit(
+                _run_chunk, ref, pk_key, rows, args, kwargs), sources))
+            if len(in_flight) >= max_in_flight:
+                _apply(in_flight.pop(0))
+        while in_flight:
+            _apply(in_flight.pop(0))
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return result
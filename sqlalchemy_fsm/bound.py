@@ -6,12 +6,18 @@ import warnings
 
 import inspect as py_inspect
 from functools import partial
+from timeit import default_timer
 
 from sqlalchemy import inspect as sqla_inspect
+from sqlalchemy.orm.attributes import instance_state
 
 
-from . import exc, util, meta, events, cache
+from . import exc, util, meta, events, cache, coalesce, states, deferred
 from .sqltypes import FSMField
+from .conditions import (
+    PureCondition, ConcurrentCondition, ConditionOrder,
+    get_memo_scope, unwrap, all_passed, cancel_all,
+)
 
 
 @cache.weakValueCache
@@ -34,23 +40,41 @@ def COLUMN_CACHE(table_class):
 
 
 class SqlAlchemyHandle(object):
+    """FSM column & event dispatch of a table class.
+
+    Shared by all records of the class (see `get_sqla_handle()`).
+    """
 
     __slots__ = (
-        "table_class", "record", "fsm_column",
-        "dispatch", "column_name",
+        "table_class", "fsm_column", "column_name",
+        "before_state_change", "after_state_change",
     )
 
-    def __init__(self, table_class, table_record_instance=None):
+    def __init__(self, table_class):
         self.table_class = table_class
-        self.record = table_record_instance
         self.fsm_column = COLUMN_CACHE.getValue(table_class)
         self.column_name = self.fsm_column.name
+        self.before_state_change = events.get_state_change_dispatch(
+            table_class, 'before_state_change')
+        self.after_state_change = events.get_state_change_dispatch(
+            table_class, 'after_state_change')
+
+
+@cache.dictCache
+def SqlAlchemyHandleCache(table_class):
+    return SqlAlchemyHandle(table_class)
+
 
-        if table_record_instance:
-            self.dispatch = events.BoundFSMDispatcher(table_record_instance)
+def get_sqla_handle(table_class):
+    return SqlAlchemyHandleCache.getValue(table_class)
 
 
 class BoundFSMBase(object):
+    """Meta bound to a table class & transition handler.
+
+    These are immutable and shared by all records of the table,
+    the record is passed to every method call instead.
+    """
 
     __slots__ = ("meta", "sqla_handle", "extra_call_args")
 
@@ -63,30 +87,45 @@ class BoundFSMBase(object):
     def target_state(self):
         return self.meta.target
 
-    @property
-    def current_state(self):
-        return getattr(
-            self.sqla_handle.record,
-            self.sqla_handle.column_name
-        )
+    def current_state(self, record):
+        return getattr(record, self.sqla_handle.column_name)
 
-    def transition_possible(self):
-        return (
-            '*' in self.meta.sources
-        ) or (
-            self.current_state in self.meta.sources
-        )
+    def transition_possible(self, record):
+        return self.meta.matches_source(self.current_state(record))
 
 
 class BoundFSMFunction(BoundFSMBase):
 
-    __slots__ = BoundFSMBase.__slots__ + ("set_func", "my_args")
+    __slots__ = BoundFSMBase.__slots__ + (
+        "set_func", "my_args",
+        "inline_conditions", "concurrent_conditions", "condition_order",
+    )
 
     def __init__(self, meta, sqla_handle, set_func, extra_call_args):
-        super(BoundFSMFunction, self).__init__(meta, sqla_handle, extra_call_args)
+        super(BoundFSMFunction, self).__init__(
+            meta, sqla_handle, extra_call_args)
         self.set_func = set_func
-        self.my_args = self.meta.extra_call_args + self.extra_call_args + \
-            (self.sqla_handle.record, )
+        self.my_args = self.meta.extra_call_args + self.extra_call_args
+        self.inline_conditions = tuple(
+            condition for condition in self.meta.conditions
+            if not isinstance(condition, ConcurrentCondition)
+        )
+        self.concurrent_conditions = tuple(
+            condition for condition in self.meta.conditions
+            if isinstance(condition, ConcurrentCondition)
+        )
+        if self.meta.adaptive and any(
+            isinstance(condition, PureCondition)
+            for condition in self.inline_conditions
+        ):
+            self.condition_order = ConditionOrder(self.inline_conditions)
+        else:
+            self.condition_order = None
+
+    def get_condition_orders(self):
+        if self.condition_order is None:
+            return ()
+        return (self.condition_order, )
 
     def get_call_iface_error(self, fn, args, kwargs):
         """Returhs 'Type' error describing function's api mismatch (if one exists)
@@ -99,27 +138,38 @@ class BoundFSMFunction(BoundFSMBase):
             return err
         return None
 
-    def conditions_met(self, args, kwargs):
+    def conditions_met(self, record, args, kwargs, handler_args=()):
+        """`handler_args` (the handler object of transition classes)
+        precede the record in the call args."""
         conditions = self.meta.conditions
         if not conditions:
             # Performance - skip the check
             return True
 
-        args = self.my_args + tuple(args)
+        if handler_args:
+            # The handler object is new for every call, so it is
+            #   left out of the memoized conditions' keys
+            key_args = self.my_args + (record, ) + tuple(args)
+        else:
+            key_args = None
+        args = self.my_args + handler_args + (record, ) + tuple(args)
 
         kwargs = dict(kwargs)
 
-        out = True
-        for condition in conditions:
-            # Check that condition is call-able with args provided
-            if self.get_call_iface_error(condition, args, kwargs):
+        if self.concurrent_conditions:
+            futures = self.start_concurrent_conditions(args, kwargs)
+            if futures is None:
                 out = False
             else:
-                out = condition(*args, **kwargs)
-
-            if not out:
-                # Preconditions failed
-                break
+                try:
+                    out = self.inline_conditions_met(
+                        record, args, kwargs, key_args
+                    ) and all_passed(futures)
+                finally:
+                    # Results of the pending ones are not needed anymore
+                    cancel_all(futures)
+        else:
+            out = self.inline_conditions_met(record, args, kwargs, key_args)
 
         if out:
             # Check that the function itself can be called with these args
@@ -138,33 +188,104 @@ class BoundFSMFunction(BoundFSMBase):
                     )
         return out
 
-    def to_next_state(self, args, kwargs):
-        old_state = self.current_state
-        new_state = self.target_state
+    def inline_conditions_met(self, record, args, kwargs, key_args=None):
+        order = self.condition_order
+        if order is None:
+            conditions = self.inline_conditions
+        else:
+            conditions = order.order
 
-        sqla_target = self.sqla_handle.record
+        out = True
+        memo_scope = None
+        for condition in conditions:
+            if order is not None:
+                started = default_timer()
+            # Check that condition is call-able with args provided
+            if self.get_call_iface_error(unwrap(condition), args, kwargs):
+                out = False
+            elif isinstance(condition, PureCondition):
+                if memo_scope is None:
+                    memo_scope = get_memo_scope(record)
+                if memo_scope is None:
+                    out = condition(*args, **kwargs)
+                else:
+                    out = memo_scope.evaluate(
+                        condition, args, kwargs, key_args)
+            else:
+                out = condition(*args, **kwargs)
+            if order is not None:
+                order.record(condition, default_timer() - started, out)
+
+            if not out:
+                # Preconditions failed
+                break
+
+        if order is not None:
+            order.evaluated()
+        return out
 
-        args = self.my_args + tuple(args)
+    def start_concurrent_conditions(self, args, kwargs):
+        """Submit concurrent conditions to the pool.
 
-        self.sqla_handle.dispatch.before_state_change(
-            source=old_state, target=new_state
+        Returns list of futures or None if the conditions
+        can't be called with the `args`.
+        """
+        for condition in self.concurrent_conditions:
+            if self.get_call_iface_error(unwrap(condition), args, kwargs):
+                return None
+        return [
+            condition.submit(args, kwargs)
+            for condition in self.concurrent_conditions
+        ]
+
+    def run_handler(self, record, args, kwargs, handler_args=()):
+        """Call the handler (or queue it with `defer`).
+
+        Returns the deferred call's future (or None).
+        """
+        my_args = self.my_args + handler_args
+        if self.meta.defer:
+            return deferred.queue(
+                record, self.set_func, my_args, args, kwargs)
+        self.set_func(*(my_args + (record, ) + tuple(args)), **kwargs)
+        return None
+
+    def to_next_state(self, record, args, kwargs, handler_args=()):
+        old_state = self.current_state(record)
+        new_state = self.target_state
+
+        state = instance_state(record)
+
+        self.sqla_handle.before_state_change(
+            state, source=old_state, target=new_state
         )
 
-        self.set_func(*args, **kwargs)
+        coalescer = coalesce.get_coalescer(record)
+        if coalescer is not None:
+            # `after_state_change` is called with the net change on flush
+            out = self.run_handler(record, args, kwargs, handler_args)
+            if new_state != old_state:
+                setattr(record, self.sqla_handle.column_name, new_state)
+            coalescer.record_step(
+                self.sqla_handle, state, old_state, new_state)
+            return out
+
+        out = self.run_handler(record, args, kwargs, handler_args)
         setattr(
-            sqla_target,
+            record,
             self.sqla_handle.column_name,
             new_state
         )
-        self.sqla_handle.dispatch.after_state_change(
-            source=old_state, target=new_state
+        self.sqla_handle.after_state_change(
+            state, source=old_state, target=new_state
         )
+        return out
 
     def __repr__(self):
-        return "<{} meta={!r} instance={!r} function={!r}>".format(
+        return "<{} meta={!r} table={!r} function={!r}>".format(
             self.__class__.__name__,
             self.meta,
-            self.sqla_handle,
+            self.sqla_handle.table_class,
             self.set_func,
         )
 
@@ -185,8 +306,12 @@ class TansitionStateArtithmetics(object):
             return sources_b
         elif '*' in sources_b:
             return sources_a
-        elif sources_a.issuperset(sources_b):
-            return sources_a.intersection(sources_b)
+        elif all(
+            states.source_covered(
+                source, sources_a, self.metaA.source_patterns)
+            for source in sources_b
+        ):
+            return sources_b
         else:
             return False
 
@@ -259,7 +384,10 @@ def InheritedBoundClasses(key):
                 sub_sources, sub_target,
                 arithmetics.joint_conditions(),
                 arithmetics.joint_args(),
-                sub_meta.bound_cls
+                sub_meta.bound_cls,
+                adaptive=parent_meta.adaptive or sub_meta.adaptive,
+                prefetch=util.unique(parent_meta.prefetch + sub_meta.prefetch),
+                defer=parent_meta.defer or sub_meta.defer,
             )
             out.append((merged_sub_meta, transition._sa_fsm_transition_fn))
 
@@ -287,43 +415,64 @@ def InheritedBoundClasses(key):
 
 class BoundFSMClass(BoundFSMBase):
 
-    __slots__ = BoundFSMBase.__slots__ + ("bound_sub_metas", )
+    __slots__ = BoundFSMBase.__slots__ + (
+        "bound_sub_metas", "class_target", "child_cls",
+    )
 
     def __init__(self, meta, sqlalchemy_handle, child_cls, extra_call_args):
         super(BoundFSMClass, self).__init__(
             meta, sqlalchemy_handle, extra_call_args
         )
-        child_cls = InheritedBoundClasses.getValue((child_cls, meta))
-        child_object = child_cls()
-        child_object._sa_fsm_sqlalchemy_handle = sqlalchemy_handle
-        self.bound_sub_metas = [
-            meta.get_bound(
-                sqlalchemy_handle,
-                set_fn,
-                (child_object, )
-            )
-            for (meta, set_fn) in child_object._sa_fsm_sqlalchemy_metas
-        ]
-
-    @cache.caching_attr
-    def target_state(self):
+        self.child_cls = InheritedBoundClasses.getValue((child_cls, meta))
+        # The sub metas are shared, a new handler object is passed
+        #   to them by every call (see `get_handler_args()`)
+        self.set_sub_metas(tuple(
+            meta.get_bound(sqlalchemy_handle, set_fn, extra_call_args)
+            for (meta, set_fn) in self.child_cls._sa_fsm_sqlalchemy_metas
+        ))
+
+    def set_sub_metas(self, bound_sub_metas):
+        self.bound_sub_metas = bound_sub_metas
         targets = tuple(set(meta.meta.target for meta in self.bound_sub_metas))
         assert len(targets) == 1, "One and just one target expected"
-        return targets[0]
+        self.class_target = targets[0]
 
-    def transition_possible(self):
-        return any(sub.transition_possible() for sub in self.bound_sub_metas)
+    @property
+    def target_state(self):
+        return self.class_target
 
-    def conditions_met(self, args, kwargs):
+    def transition_possible(self, record):
         return any(
-            sub.transition_possible() and sub.conditions_met(args, kwargs)
+            sub.transition_possible(record) for sub in self.bound_sub_metas)
+
+    def get_condition_orders(self):
+        return tuple(
+            order
             for sub in self.bound_sub_metas
+            for order in sub.get_condition_orders()
         )
 
-    def to_next_state(self, args, kwargs):
+    def get_handler_args(self):
+        """Handler object of a call, not shared between records
+        (and threads)."""
+        child_object = self.child_cls()
+        child_object._sa_fsm_sqlalchemy_handle = self.sqla_handle
+        return (child_object, )
+
+    def conditions_met(self, record, args, kwargs):
+        handler_args = self.get_handler_args()
+        return any(
+            sub.transition_possible(record) and
+            sub.conditions_met(record, args, kwargs, handler_args)
+            for sub in self.bound_sub_metas
+        )
+
+    def to_next_state(self, record, args, kwargs):
+        handler_args = self.get_handler_args()
         can_transition_with = [
             sub for sub in self.bound_sub_metas
-            if sub.transition_possible() and sub.conditions_met(args, kwargs)
+            if sub.transition_possible(record) and
+            sub.conditions_met(record, args, kwargs, handler_args)
         ]
         if len(can_transition_with) > 1:
             raise exc.SetupError(
@@ -333,4 +482,42 @@ class BoundFSMClass(BoundFSMBase):
             )
         else:
             assert can_transition_with
-        return can_transition_with[0].to_next_state(args, kwargs)
+        return can_transition_with[0].to_next_state(
+            record, args, kwargs, handler_args)
+
+
+class HandlerTable(object):
+    """Handlers of a transition compiled from a data definition.
+
+    Stands in for the class of the class transitions: `handlers` are
+    (meta, handler function) pairs ready to be bound, so there is
+    no `InheritedBoundClasses` scan & class creation.
+    """
+
+    __slots__ = ("__name__", "handlers")
+
+    def __init__(self, name, handlers):
+        self.__name__ = name
+        self.handlers = tuple(handlers)
+
+    def __repr__(self):
+        return "<{} {!r} handlers={!r}>".format(
+            self.__class__.__name__, self.__name__, self.handlers)
+
+
+class BoundFSMHandlers(BoundFSMClass):
+    """`BoundFSMClass` of a `HandlerTable`."""
+
+    __slots__ = ()
+
+    def __init__(self, meta, sqlalchemy_handle, table, extra_call_args):
+        BoundFSMBase.__init__(self, meta, sqlalchemy_handle, extra_call_args)
+        self.child_cls = None
+        self.set_sub_metas(tuple(
+            sub_meta.get_bound(sqlalchemy_handle, set_fn, extra_call_args)
+            for (sub_meta, set_fn) in table.handlers
+        ))
+
+    def get_handler_args(self):
+        # Plain handler functions
+        return ()
@@ -0,0 +1,230 @@
+"""Parent transitions driven by the states of their children.
+
+    cascade.when_all(Shipment.delivered, Order.fulfilled)
+
+moves an order to `fulfilled` once all its shipments are `delivered`.
+Child state changes only mark the parent as a candidate, candidates are
+checked once per flush with a single aggregate (`NOT EXISTS`) query
+per cascade, so a burst of child updates causes one parent check.
+Eligible parents are transitioned after the flush (if the transition's
+conditions allow it), so the changes are written by the next flush
+(e.g. the one `commit()` makes anyway).
+"""
+
+import threading
+
+import sqlalchemy
+import sqlalchemy.event
+
+from sqlalchemy import inspect as sqla_inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import instance_state
+
+from . import exc, statements, util
+from .transition import get_handler_metas, sql_source_filter
+
+
+PENDING_KEY = 'sa_fsm_cascades'
+
+_LOCK = threading.Lock()
+# [Cascade, ...]
+_CASCADES = []
+_INSTALLED = False
+
+
+def get_foreign_key(child_model, parent_model):
+    """The only column attribute of `child_model` referencing
+    the `parent_model`'s primary key."""
+    parent_pk = util.get_single_pk_column(sqla_inspect(parent_model))
+    child_mapper = sqla_inspect(child_model)
+    keys = [
+        child_mapper.get_property_by_column(column).key
+        for column in child_mapper.columns
+        if column.references(parent_pk)
+    ]
+    if len(keys) != 1:
+        raise exc.SetupError(
+            'Single foreign key from {!r} to {!r} expected, '
+            'got {!r}'.format(child_model, parent_model, keys)
+        )
+    return getattr(child_model, keys[0])
+
+
+class Cascade(object):
+    """Transition of a parent when all (or any) of its children reach
+    the child transition's target state."""
+
+    __slots__ = (
+        "child_transition", "parent_transition", "foreign_key", "mode",
+        "eligible_query",
+    )
+
+    MODES = ('all', 'any')
+
+    def __init__(
+        self, child_transition, parent_transition, foreign_key=None,
+        mode='all'
+    ):
+        if mode not in self.MODES:
+            raise NotImplementedError(mode)
+        self.child_transition = child_transition
+        self.parent_transition = parent_transition
+        if foreign_key is None:
+            foreign_key = get_foreign_key(
+                child_transition._sa_fsm_owner_cls,
+                parent_transition._sa_fsm_owner_cls
+            )
+        self.foreign_key = foreign_key
+        self.mode = mode
+        self.eligible_query = None
+
+    @property
+    def child_model(self):
+        return self.child_transition._sa_fsm_owner_cls
+
+    @property
+    def parent_model(self):
+        return self.parent_transition._sa_fsm_owner_cls
+
+    def on_child_change(self, state, source, target):
+        # Parent is not known for sure until the child is flushed
+        state.info.setdefault(PENDING_KEY, set()).add(self)
+
+    def get_parent_id(self, record):
+        return getattr(record, self.foreign_key.key)
+
+    def eligible_filter(self, parent_pk):
+        """SQL filter matching parents the cascade applies to."""
+        child_column = self.child_transition._sa_fsm_sqla_handle.fsm_column
+        in_state = self.child_transition()
+        children = sqlalchemy.select([sqlalchemy.literal(1)]).where(
+            self.foreign_key == parent_pk)
+        if self.mode == 'all':
+            return ~sqlalchemy.exists(children.where(sqlalchemy.or_(
+                ~in_state, child_column.is_(None)
+            )))
+        return sqlalchemy.exists(children.where(in_state))
+
+    def get_eligible_query(self):
+        """Select of the eligible parents among the `sa_fsm_parent_ids`."""
+        parent = self.parent_transition
+        parent_pk = util.get_single_pk_column(sqla_inspect(self.parent_model))
+        parent_column = parent._sa_fsm_sqla_handle.fsm_column
+        return sqlalchemy.select([parent_pk]).where(sqlalchemy.and_(
+            parent_pk.in_(
+                sqlalchemy.bindparam('sa_fsm_parent_ids', expanding=True)),
+            sqlalchemy.or_(*[
+                sql_source_filter(parent_column, meta.sources)
+                for meta in get_handler_metas(
+                    parent._sa_fsm_meta, parent._sa_fsm_transition_fn)
+            ]),
+            self.eligible_filter(parent_pk),
+        ))
+
+    def get_eligible(self, session, parent_ids):
+        """Primary keys of the `parent_ids` the cascade applies to
+        (one query)."""
+        if self.eligible_query is None:
+            self.eligible_query = self.get_eligible_query()
+        result = statements.execute(
+            session, self.eligible_query,
+            dict(sa_fsm_parent_ids=sorted(parent_ids)), self.parent_model
+        )
+        return [row[0] for row in result]
+
+    def apply(self, session, parent_ids):
+        """Transition eligible parents of the `parent_ids`.
+
+        Returns list of transitioned parent records.
+        """
+        out = []
+        with session.no_autoflush:
+            eligible = self.get_eligible(session, parent_ids)
+            if not eligible:
+                return out
+            parent_pk = util.get_single_pk_column(
+                sqla_inspect(self.parent_model))
+            name = self.parent_transition._sa_fsm_name
+            for record in session.query(self.parent_model).filter(
+                parent_pk.in_(eligible)
+            ):
+                transition = getattr(record, name)
+                if transition.can_proceed():
+                    transition.set()
+                    out.append(record)
+        return out
+
+    def remove(self):
+        """Stop the cascade."""
+        sqlalchemy.event.remove(
+            self.child_model, 'after_state_change', self.on_child_change)
+        with _LOCK:
+            _CASCADES.remove(self)
+
+    def __repr__(self):
+        return "<{} {} {!r} -> {!r}>".format(
+            self.__class__.__name__, self.mode,
+            self.child_transition._sa_fsm_meta.target,
+            self.parent_transition._sa_fsm_meta.target,
+        )
+
+
+def when_all(child_transition, parent_transition, foreign_key=None):
+    """Set `parent_transition` once all children reach the target
+    state of the `child_transition`.
+
+    Both are class-bound transitions, `foreign_key` is the child's
+    column attribute referencing the parent (found by default).
+    """
+    return _add(Cascade(
+        child_transition, parent_transition, foreign_key, 'all'))
+
+
+def when_any(child_transition, parent_transition, foreign_key=None):
+    """Set `parent_transition` once any child reaches the target
+    state of the `child_transition`."""
+    return _add(Cascade(
+        child_transition, parent_transition, foreign_key, 'any'))
+
+
+def _add(cascade):
+    global _INSTALLED
+    with _LOCK:
+        if not _INSTALLED:
+            sqlalchemy.event.listen(Session, 'after_flush', _after_flush)
+            sqlalchemy.event.listen(
+                Session, 'after_flush_postexec', _after_flush_postexec)
+            _INSTALLED = True
+        _CASCADES.append(cascade)
+    sqlalchemy.event.listen(
+        cascade.child_model, 'after_state_change', cascade.on_child_change,
+        target_state=cascade.child_transition._sa_fsm_meta.target, raw=True
+    )
+    return cascade
+
+
+def _after_flush(session, flush_context):
+    """Collect parents of the flushed children."""
+    child_models = tuple(set(cascade.child_model for cascade in _CASCADES))
+    if not child_models:
+        return
+    pending = None
+    for record in session.new.union(session.dirty):
+        if not isinstance(record, child_models):
+            continue
+        cascades = instance_state(record).info.pop(PENDING_KEY, None)
+        if not cascades:
+            continue
+        if pending is None:
+            pending = session.info.setdefault(PENDING_KEY, {})
+        for cascade in cascades:
+            parent_id = cascade.get_parent_id(record)
+            if parent_id is not None:
+                pending.setdefault(cascade, set()).add(parent_id)
+
+
+def _after_flush_postexec(session, flush_context):
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending:
+        for (cascade, parent_ids) in pending.items():
+            cascade.apply(session, parent_ids)
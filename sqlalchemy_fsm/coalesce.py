@@ -0,0 +1,181 @@
+"""Coalescing of the state changes made between two flushes.
+
+    coalesce.enable(session)
+    record.validated.set()
+    record.queued.set()
+    session.flush()  # after listeners get one 'new' -> 'queued' change
+
+While coalescing is enabled for a session, `after_state_change`
+listeners of its records are not called on every transition. They are
+called once per record when the session is flushed (or committed) with
+the net (first source, final target) change instead. Records that have
+returned to their first source through other states have no net change
+and are not dispatched. `before_state_change` listeners are still called
+by every `set()`, before the state is changed (so they can veto it).
+Self-loop transitions do not write the state attribute, so they do not
+cause UPDATEs on their own.
+"""
+
+import collections
+
+import sqlalchemy.event
+
+from sqlalchemy.orm import object_session
+
+
+SESSION_COALESCER_KEY = 'sa_fsm_coalescer'
+
+
+class PendingChange(object):
+    """Net state change of a record that is not dispatched yet."""
+
+    __slots__ = ("sqla_handle", "source", "target", "moved", "steps")
+
+    def __init__(self, sqla_handle, source, keep_steps):
+        self.sqla_handle = sqla_handle
+        self.source = source
+        self.target = source
+        # Has any of the steps left its source state
+        self.moved = False
+        # List of (source, target) tuples, if requested
+        self.steps = [] if keep_steps else None
+
+    def __repr__(self):
+        return "<{} source={!r} target={!r} steps={!r}>".format(
+            self.__class__.__name__, self.source, self.target, self.steps)
+
+
+class Coalescer(object):
+    """Collects state changes of the session's records."""
+
+    __slots__ = ("session", "keep_steps", "pending", "dispatching")
+
+    def __init__(self, session, keep_steps=False):
+        self.session = session
+        self.keep_steps = keep_steps
+        # {InstanceState: PendingChange}
+        self.pending = collections.OrderedDict()
+        # Change being dispatched at the moment
+        self.dispatching = None
+
+    def record_step(self, sqla_handle, state, source, target):
+        try:
+            change = self.pending[state]
+        except KeyError:
+            change = self.pending[state] = PendingChange(
+                sqla_handle, source, self.keep_steps)
+        change.target = target
+        if source != target:
+            change.moved = True
+        if change.steps is not None:
+            change.steps.append((source, target))
+
+    def get_steps(self, state):
+        """Return (source, target) steps of the record's pending change."""
+        change = self.pending.get(state)
+        if change is None and self.dispatching is not None and \
+                self.dispatching[0] is state:
+            change = self.dispatching[1]
+        if change is None:
+            return []
+        if change.steps is None:
+            raise NotImplementedError(
+                'Steps are only kept with coalesce.enable(keep_steps=True)')
+        return list(change.steps)
+
+    def dispatch(self):
+        """Call `after_state_change` listeners with net changes
+        of the records in the session.
+
+        Changes made by the listeners themselves are dispatched as well.
+        """
+        session_key = self.session.hash_key
+        while self.pending:
+            pending = self.pending
+            self.pending = collections.OrderedDict()
+            for (state, change) in pending.items():
+                if state.session_id != session_key or state.obj() is None:
+                    # Expunged - the change will not be flushed
+                    continue
+                if change.moved and change.source == change.target:
+                    # Back in the first source state, no net change
+                    continue
+                self.dispatching = (state, change)
+                try:
+                    change.sqla_handle.after_state_change(
+                        state, source=change.source, target=change.target)
+                finally:
+                    self.dispatching = None
+
+    def clear(self):
+        self.pending.clear()
+
+    def __repr__(self):
+        return "<{} pending={}>".format(
+            self.__class__.__name__, len(self.pending))
+
+
+def _dispatch(session, *args):
+    session.info[SESSION_COALESCER_KEY].dispatch()
+
+
+def _clear(session, *args):
+    session.info[SESSION_COALESCER_KEY].clear()
+
+
+# `before_commit` is needed too, as flush of a session that has
+#   only self-loop changes (that are not written) is skipped.
+_SESSION_EVENTS = (
+    ('before_flush', _dispatch),
+    ('before_commit', _dispatch),
+    ('after_soft_rollback', _clear),
+)
+
+
+def enable(session, keep_steps=False):
+    """Enable state change coalescing for the `session`.
+
+    With `keep_steps` the intermediate steps are recorded and can be
+    retrieved with `get_steps()` (e.g. from a listener).
+    """
+    try:
+        out = session.info[SESSION_COALESCER_KEY]
+    except KeyError:
+        pass
+    else:
+        out.keep_steps = keep_steps
+        return out
+
+    out = session.info[SESSION_COALESCER_KEY] = Coalescer(
+        session, keep_steps)
+    for (name, fn) in _SESSION_EVENTS:
+        sqlalchemy.event.listen(session, name, fn)
+    return out
+
+
+def disable(session):
+    """Dispatch the pending changes & disable coalescing for the `session`."""
+    coalescer = session.info.get(SESSION_COALESCER_KEY)
+    if coalescer is None:
+        return
+    coalescer.dispatch()
+    for (name, fn) in _SESSION_EVENTS:
+        sqlalchemy.event.remove(session, name, fn)
+    del session.info[SESSION_COALESCER_KEY]
+
+
+def get_coalescer(record):
+    """Return coalescer active for the `record` (or None)."""
+    session = object_session(record)
+    if session is None:
+        return None
+    return session.info.get(SESSION_COALESCER_KEY)
+
+
+def get_steps(record):
+    """Return intermediate (source, target) steps of the record's
+    not yet dispatched (or being dispatched) state change."""
+    coalescer = get_coalescer(record)
+    if coalescer is None:
+        return []
+    return coalescer.get_steps(sqlalchemy.inspect(record))
@@ -0,0 +1,235 @@
+"""Columnar export of the transition history for analytics.
+
+    columnar.export(session, history, '/data/fsm-history')
+    data = columnar.ColumnarHistory('/data/fsm-history')
+    data.time_in_state('pending')  # seconds, one per visit
+    data.conversion('trial', 'paid')  # (converted, entered) records
+
+`export()` streams the history table (keyset pagination on its id) into
+NumPy `.npy` files, one per column: ids, record ids and timestamps
+as int64 / datetime64, models & states int-coded (the dictionaries
+are saved to `meta.json`). `ColumnarHistory` memory-maps the files,
+so the queries run vectorised without the database and without loading
+the whole history into memory.
+
+Requires NumPy.
+"""
+
+import json
+import os
+
+import sqlalchemy
+
+from . import statements
+from .history import get_model_name
+
+try:
+    import numpy
+    from numpy.lib.format import open_memmap
+except ImportError:
+    numpy = None
+
+
+META_FILE = 'meta.json'
+# Code of the None (initial) source state
+NO_STATE = -1
+
+# (history column, file name, dtype)
+COLUMNS = (
+    ('id', 'ids.npy', 'int64'),
+    ('model', 'models.npy', 'int16'),
+    ('record_id', 'record_ids.npy', 'int64'),
+    ('source', 'sources.npy', 'int32'),
+    ('target', 'targets.npy', 'int32'),
+    ('created_at', 'created_at.npy', 'datetime64[us]'),
+)
+
+
+def require_numpy():
+    if numpy is None:
+        raise ImportError('Columnar history export requires NumPy')
+
+
+def create_array(path, dtype, size):
+    """Writable memory-mapped `.npy` file."""
+    if not size:
+        # Empty files can not be memory-mapped
+        numpy.save(path, numpy.zeros(0, dtype=dtype))
+        return numpy.load(path)
+    return open_memmap(
+        path, mode='w+', dtype=numpy.dtype(dtype), shape=(size, ))
+
+
+class Dictionary(object):
+    """Int codes of the values, in the first seen order."""
+
+    __slots__ = ("codes", "values")
+
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = dict((value, idx) for (idx, value) in enumerate(values))
+
+    def encode(self, value):
+        if value is None:
+            return NO_STATE
+        try:
+            return self.codes[value]
+        except KeyError:
+            out = self.codes[value] = len(self.values)
+            self.values.append(value)
+            return out
+
+
+def export(connection, history, directory, models=None, chunk_size=100000):
+    """Export the `history` table (all of it or just the `models`)
+    to the `directory`.
+
+    `connection` is a session, connection or engine. Rows added
+    while the export is running are not exported.
+    Returns `ColumnarHistory` of the export.
+    """
+    require_numpy()
+    table = history.table
+    criteria = []
+    if models is not None:
+        criteria.append(table.c.model.in_(
+            sorted(get_model_name(model) for model in models)))
+    (count, last_id) = connection.execute(
+        sqlalchemy.select([
+            sqlalchemy.func.count(), sqlalchemy.func.max(table.c.id)
+        ]).where(sqlalchemy.and_(*criteria))
+    ).fetchone()
+    if last_id is not None:
+        criteria.append(table.c.id <= last_id)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    arrays = [
+        create_array(os.path.join(directory, file_name), dtype, count)
+        for (name, file_name, dtype) in COLUMNS
+    ]
+    model_codes = Dictionary()
+    state_codes = Dictionary()
+    columns = [getattr(table.c, name) for (name, _, _) in COLUMNS]
+    # Built once, so that the chunks reuse the compiled statements
+    first_query = sqlalchemy.select(columns).where(
+        sqlalchemy.and_(*criteria)
+    ).order_by(table.c.id).limit(sqlalchemy.bindparam('sa_fsm_limit'))
+    next_query = first_query.where(
+        table.c.id > sqlalchemy.bindparam('sa_fsm_last_id'))
+    params = dict(sa_fsm_limit=chunk_size)
+
+    offset = 0
+    last_seen = None
+    while offset < count:
+        if last_seen is None:
+            chunk = statements.execute(connection, first_query, params)
+        else:
+            params['sa_fsm_last_id'] = last_seen
+            chunk = statements.execute(connection, next_query, params)
+        rows = chunk.fetchall()
+        if not rows:
+            break
+        end = offset + len(rows)
+        (ids, models_, record_ids, sources, targets, times) = zip(*rows)
+        arrays[0][offset:end] = ids
+        arrays[1][offset:end] = [model_codes.encode(el) for el in models_]
+        arrays[2][offset:end] = record_ids
+        arrays[3][offset:end] = [state_codes.encode(el) for el in sources]
+        arrays[4][offset:end] = [state_codes.encode(el) for el in targets]
+        arrays[5][offset:end] = numpy.array(times, dtype='datetime64[us]')
+        offset = end
+        last_seen = ids[-1]
+
+    for array in arrays:
+        if isinstance(array, numpy.memmap):
+            array.flush()
+    del arrays
+    with open(os.path.join(directory, META_FILE), 'w') as fobj:
+        json.dump(dict(
+            count=offset, last_id=last_id,
+            models=model_codes.values, states=state_codes.values,
+        ), fobj)
+    return ColumnarHistory(directory)
+
+
+class ColumnarHistory(object):
+    """Memory-mapped `export()` output."""
+
+    def __init__(self, directory):
+        require_numpy()
+        with open(os.path.join(directory, META_FILE)) as fobj:
+            meta = json.load(fobj)
+        self.directory = directory
+        # Id of the last exported history row (to continue from)
+        self.last_id = meta['last_id']
+        self.models = Dictionary(meta['models'])
+        self.states = Dictionary(meta['states'])
+        count = meta['count']
+        for (name, file_name, _) in COLUMNS:
+            array = numpy.load(
+                os.path.join(directory, file_name), mmap_mode='r')
+            setattr(self, name, array[:count])
+
+    def __len__(self):
+        return len(self.id)
+
+    def state_code(self, state):
+        """Code of the `state` (None if there is no such state)."""
+        if state is None:
+            return NO_STATE
+        return self.states.codes.get(state)
+
+    def record_keys(self):
+        """(model, record id) pairs as one int64 per row."""
+        return self.record_id * len(self.models.values) + self.model
+
+    def time_in_state(self, state):
+        """Seconds each visit of the `state` lasted.
+
+        (Records that are still in the state are not included.)
+        """
+        code = self.state_code(state)
+        if code is None:
+            return numpy.zeros(0)
+        keys = self.record_keys()
+        order = numpy.lexsort((self.id, keys))
+        keys = keys[order]
+        targets = self.target[order]
+        times = self.created_at[order]
+        left = (keys[1:] == keys[:-1]) & (targets[:-1] == code)
+        return (times[1:] - times[:-1])[left] / numpy.timedelta64(1, 's')
+
+    def conversion(self, from_state, to_state):
+        """Return (converted, entered) record numbers: `entered` records
+        entered `from_state`, `converted` of them entered `to_state` later.
+        """
+        from_code = self.state_code(from_state)
+        to_code = self.state_code(to_state)
+        if from_code is None:
+            return (0, 0)
+        keys = self.record_keys()
+
+        from_mask = self.target == from_code
+        (from_keys, first_idx) = numpy.unique(
+            keys[from_mask], return_index=True)
+        if to_code is None:
+            return (0, len(from_keys))
+        # Id of the first entry to `from_state` of each record
+        #   (history is exported in the id order)
+        first_from = self.id[from_mask][first_idx]
+
+        to_mask = self.target == to_code
+        to_keys = keys[to_mask][::-1]
+        (to_keys, last_idx) = numpy.unique(to_keys, return_index=True)
+        last_to = self.id[to_mask][::-1][last_idx]
+
+        (_, from_idx, to_idx) = numpy.intersect1d(
+            from_keys, to_keys, assume_unique=True, return_indices=True)
+        converted = numpy.count_nonzero(
+            last_to[to_idx] > first_from[from_idx])
+        return (int(converted), len(from_keys))
+
+    def __repr__(self):
+        return "<{} {!r} rows={}>".format(
+            self.__class__.__name__, self.directory, len(self))
@@ -0,0 +1,374 @@
+"""Transition condition wrappers and condition evaluation scopes."""
+
+import threading
+
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import sqlalchemy.event
+
+from sqlalchemy.orm import object_session
+
+from . import exc, pool
+
+
+class Condition(object):
+    """Base class for the wrapped transition conditions.
+
+    The wrapped function is called with exactly the same arguments
+    as the plain condition would have been.
+    """
+
+    __slots__ = ("func", )
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def __repr__(self):
+        return "<{} {!r}>".format(self.__class__.__name__, self.func)
+
+
+class PureCondition(Condition):
+    """Side-effect free condition which result can be memoized.
+
+    `key` is called with the condition's arguments and returns
+    the cache key. By default all arguments are used as the key
+    (except for the per-call handler object of transition classes).
+    """
+
+    __slots__ = Condition.__slots__ + ("key_func", )
+
+    def __init__(self, func, key=None):
+        super(PureCondition, self).__init__(func)
+        self.key_func = key
+
+    def cache_key(self, args, kwargs, key_args=None):
+        """`key_args` replace the `args` in the default key."""
+        if self.key_func is None:
+            if key_args is None:
+                key_args = args
+            return (key_args, tuple(sorted(kwargs.items())))
+        return self.key_func(*args, **kwargs)
+
+
+def pure(func=None, key=None):
+    """Mark `func` as a pure condition.
+
+    Can be used either as `pure(func, key=...)` or as a decorator
+    (`@pure` or `@pure(key=...)`).
+    """
+    if func is None:
+        return lambda func: PureCondition(func, key)
+    return PureCondition(func, key)
+
+
+class HybridCondition(Condition):
+    """Condition that also has an SQL form.
+
+    Mirrors `sqlalchemy.ext.hybrid` - the python predicate is
+    decorated with `@hybrid` and the SQL form is attached with
+    `@<predicate>.expression`. The expression is called with the
+    model class followed by the transition call arguments.
+
+    @conditions.hybrid
+    def is_reviewed(instance):
+        return instance.reviewed
+
+    @is_reviewed.expression
+    def is_reviewed(cls):
+        return cls.reviewed.is_(True)
+    """
+
+    __slots__ = Condition.__slots__ + ("expression_func", )
+
+    def __init__(self, func, expression=None):
+        super(HybridCondition, self).__init__(func)
+        self.expression_func = expression
+
+    def expression(self, expression_func):
+        self.expression_func = expression_func
+        return self
+
+    def get_sql(self, model, args, kwargs):
+        if self.expression_func is None:
+            raise exc.SetupError(
+                'Hybrid condition {!r} has no SQL expression'.format(self))
+        return self.expression_func(model, *args, **kwargs)
+
+
+def hybrid(func, expression=None):
+    """Make a condition that can be checked in python and in SQL."""
+    return HybridCondition(func, expression)
+
+
+class ConcurrentCondition(Condition):
+    """I/O-bound condition that is evaluated on the shared thread pool.
+
+    All concurrent conditions of a transition are started at once,
+    so the check takes as long as the slowest of them. They are called
+    from the pool threads, so they must not use the record's session
+    (e.g. lazy-load relationships).
+    """
+
+    __slots__ = Condition.__slots__
+
+    def submit(self, args, kwargs):
+        return pool.get_executor().submit(self.func, *args, **kwargs)
+
+
+def concurrent(func):
+    """Mark `func` as a condition to be evaluated on the thread pool."""
+    return ConcurrentCondition(func)
+
+
+def all_passed(futures):
+    """Wait for the condition `futures` till the first one fails.
+
+    Results of the remaining conditions are ignored (the ones that
+    have not started yet are cancelled). Exceptions are re-raised.
+    """
+    pending = set(futures)
+    try:
+        while pending:
+            (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if not future.result():
+                    return False
+        return True
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def cancel_all(futures):
+    for future in futures:
+        future.cancel()
+
+
+def get_sql(condition, model, args, kwargs):
+    """Return SQL form of the `condition` for the `model`."""
+    if not isinstance(condition, HybridCondition):
+        raise exc.SetupError(
+            'Condition {!r} can not be expressed in SQL'.format(condition))
+    return condition.get_sql(model, args, kwargs)
+
+
+def unwrap(condition):
+    """Return the python function behind the `condition`."""
+    if isinstance(condition, Condition):
+        return condition.func
+    return condition
+
+
+class ConditionStats(object):
+    """Observed cost & rejection rate of a condition."""
+
+    __slots__ = ("calls", "rejections", "total_time")
+
+    def __init__(self):
+        self.calls = 0
+        self.rejections = 0
+        self.total_time = 0.0
+
+    @property
+    def mean_time(self):
+        if not self.calls:
+            return 0.0
+        return self.total_time / self.calls
+
+    @property
+    def rejection_rate(self):
+        # Laplace-smoothed, so that the conditions that
+        #   have not been seen failing yet are still ranked
+        return (self.rejections + 1.0) / (self.calls + 2.0)
+
+    @property
+    def rank(self):
+        """Expected cost per rejection, the lower the earlier to check.
+
+        Ordering independent short-circuited conditions by it
+        minimises the expected cost of the whole check.
+        """
+        return self.mean_time / self.rejection_rate
+
+    def decay(self):
+        self.calls //= 2
+        self.rejections //= 2
+        self.total_time /= 2
+
+    def __repr__(self):
+        return "<{} calls={} rejections={} mean_time={:.6f}>".format(
+            self.__class__.__name__, self.calls, self.rejections,
+            self.mean_time
+        )
+
+
+class ConditionOrder(object):
+    """Evaluation order of a transition's conditions.
+
+    Runs of adjacent pure (side-effect free) conditions are reordered
+    by their observed cost & rejection rate every `reorder_every`
+    evaluations. Other conditions stay where they were declared.
+    Statistics are halved every `window` evaluations to follow
+    changes in the workload. (Updates are not locked, so the
+    statistics are approximate under concurrent use.)
+    """
+
+    __slots__ = (
+        "conditions", "order", "stats", "evaluations",
+        "reorder_every", "window",
+    )
+
+    def __init__(self, conditions, reorder_every=100, window=10000):
+        self.conditions = tuple(conditions)
+        self.order = self.conditions
+        self.stats = dict(
+            (condition, ConditionStats()) for condition in self.conditions
+        )
+        self.evaluations = 0
+        self.reorder_every = reorder_every
+        self.window = window
+
+    def record(self, condition, elapsed, passed):
+        stats = self.stats[condition]
+        stats.calls += 1
+        stats.total_time += elapsed
+        if not passed:
+            stats.rejections += 1
+
+    def evaluated(self):
+        """Called once per conditions check."""
+        self.evaluations += 1
+        if self.evaluations % self.reorder_every == 0:
+            self.reorder()
+        if self.evaluations >= self.window:
+            self.evaluations = 0
+            for stats in self.stats.values():
+                stats.decay()
+
+    def reorder(self):
+
+        def rank(condition):
+            return self.stats[condition].rank
+
+        out = []
+        pure_run = []
+        for condition in self.conditions:
+            if isinstance(condition, PureCondition):
+                pure_run.append(condition)
+            else:
+                out.extend(sorted(pure_run, key=rank))
+                pure_run = []
+                out.append(condition)
+        out.extend(sorted(pure_run, key=rank))
+        self.order = tuple(out)
+
+    def __repr__(self):
+        return "<{} order={!r}>".format(self.__class__.__name__, self.order)
+
+
+class MemoScope(object):
+    """Memoizes results of the pure conditions evaluated within it."""
+
+    __slots__ = ("results", "hits", "misses")
+
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def evaluate(self, condition, args, kwargs, key_args=None):
+        try:
+            key = (condition, condition.cache_key(args, kwargs, key_args))
+            out = self.results[key]
+        except TypeError:
+            # Unhashable arguments - can't be cached
+            self.misses += 1
+            return condition(*args, **kwargs)
+        except KeyError:
+            self.misses += 1
+            out = self.results[key] = condition(*args, **kwargs)
+        else:
+            self.hits += 1
+        return out
+
+    def invalidate(self, condition=None):
+        """Drop memoized results (of the `condition` or all of them)."""
+        if condition is None:
+            self.results.clear()
+        else:
+            for key in [
+                key for key in self.results if key[0] is condition
+            ]:
+                del self.results[key]
+
+    def __enter__(self):
+        _get_scope_stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _get_scope_stack().remove(self)
+
+    def __repr__(self):
+        return "<{} results={} hits={} misses={}>".format(
+            self.__class__.__name__, len(self.results),
+            self.hits, self.misses
+        )
+
+
+_LOCAL = threading.local()
+
+
+def _get_scope_stack():
+    try:
+        return _LOCAL.scopes
+    except AttributeError:
+        out = _LOCAL.scopes = []
+        return out
+
+
+def memoize():
+    """Context manager that memoizes pure conditions within it.
+
+    with conditions.memoize() as scope:
+        ...
+    print(scope.hits, scope.misses)
+    """
+    return MemoScope()
+
+
+SESSION_SCOPE_KEY = 'sa_fsm_memo_scope'
+
+
+def session_scope(session):
+    """Return memo scope bound to the `session`.
+
+    It is used for all records of that session and is invalidated
+    when the session commits or rolls back.
+    """
+    try:
+        return session.info[SESSION_SCOPE_KEY]
+    except KeyError:
+        pass
+
+    out = session.info[SESSION_SCOPE_KEY] = MemoScope()
+
+    def _invalidate(session, *args):
+        out.invalidate()
+
+    sqlalchemy.event.listen(session, 'after_commit', _invalidate)
+    sqlalchemy.event.listen(session, 'after_soft_rollback', _invalidate)
+    return out
+
+
+def get_memo_scope(record):
+    """Return the innermost memo scope active for the `record` (or None)."""
+    stack = _get_scope_stack()
+    if stack:
+        return stack[-1]
+    session = object_session(record)
+    if session is not None:
+        return session.info.get(SESSION_SCOPE_KEY)
+    return None
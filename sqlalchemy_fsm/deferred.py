@@ -0,0 +1,172 @@
+"""Transition handlers deferred until the session commits.
+
+    @transition(source='new', target='published', defer=True)
+    def published(self):
+        send_email(self.author_email)
+
+    future = record.published.set()  # record is 'published' now
+    session.commit()  # the handler is submitted to the pool
+    future.result()
+
+Deferred handlers run on the shared thread pool (see `pool`) after the
+commit, so slow side effects do not extend the transaction. They get a
+detached copy of the record with its committed column values instead of
+the record itself (the session must not be used from the pool threads).
+If the session rolls back, their futures are cancelled (rolling back
+a `begin_nested()` savepoint only cancels the calls queued in it).
+Handler errors are logged and set on the futures.
+"""
+
+import logging
+import threading
+
+from concurrent.futures import Future
+
+import sqlalchemy.event
+
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import instance_state
+
+from . import pool, util
+
+
+PENDING_KEY = 'sa_fsm_deferred'
+
+log = logging.getLogger(__name__)
+
+_LOCK = threading.Lock()
+_INSTALLED = False
+
+
+class DeferredCall(object):
+    """Handler call waiting for the commit."""
+
+    __slots__ = (
+        "future", "func", "args_before", "record", "args", "kwargs",
+        "transaction",
+    )
+
+    def __init__(self, func, args_before, record, args, kwargs):
+        self.future = Future()
+        self.func = func
+        # Handler args preceding the record (e.g. transition class object)
+        self.args_before = args_before
+        self.record = record
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs)
+        # Session transaction the call was queued in
+        self.transaction = None
+
+    def in_transaction(self, transaction):
+        """Was the call queued in the `transaction` (or in one
+        of its subtransactions)."""
+        parent = self.transaction
+        while parent is not None:
+            if parent is transaction:
+                return True
+            parent = parent.parent
+        return False
+
+    def submit(self, executor):
+        executor.submit(self.run, util.detached_copy(self.record))
+
+    def run(self, record):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            out = self.func(
+                *(self.args_before + (record, ) + self.args), **self.kwargs)
+        except Exception as err:
+            log.exception('Deferred handler %r failed', self.func)
+            self.future.set_exception(err)
+        else:
+            self.future.set_result(out)
+
+    def __repr__(self):
+        return "<{} {!r} {!r}>".format(
+            self.__class__.__name__, self.func, self.future)
+
+
+def get_pending(session):
+    """Calls waiting for the session's commit."""
+    try:
+        return session.info[PENDING_KEY]
+    except KeyError:
+        out = session.info[PENDING_KEY] = []
+        return out
+
+
+def add_pending(session, calls):
+    transaction = session.transaction
+    for call in calls:
+        call.transaction = transaction
+    get_pending(session).extend(calls)
+
+
+def queue(record, func, args_before, args, kwargs):
+    """Queue the handler call until the record's session commits.
+
+    Returns future of the call.
+    """
+    _install()
+    call = DeferredCall(func, args_before, record, args, kwargs)
+    session = object_session(record)
+    if session is None:
+        # Picked up when the record is flushed
+        instance_state(record).info.setdefault(PENDING_KEY, []).append(call)
+    else:
+        add_pending(session, [call])
+    return call.future
+
+
+def _install():
+    global _INSTALLED
+    if _INSTALLED:
+        return
+    with _LOCK:
+        if not _INSTALLED:
+            sqlalchemy.event.listen(Session, 'after_flush', _after_flush)
+            sqlalchemy.event.listen(Session, 'after_commit', _after_commit)
+            sqlalchemy.event.listen(
+                Session, 'after_soft_rollback', _after_soft_rollback)
+            _INSTALLED = True
+
+
+def _after_flush(session, flush_context):
+    for record in session.new:
+        calls = instance_state(record).info.pop(PENDING_KEY, None)
+        if calls:
+            add_pending(session, calls)
+
+
+def _after_commit(session):
+    transaction = session.transaction
+    if transaction is not None and transaction.nested:
+        # Released savepoint (SQLAlchemy < 1.4 calls `after_commit`
+        #   for these), the calls wait for the database commit
+        return
+    calls = session.info.pop(PENDING_KEY, None)
+    if calls:
+        executor = pool.get_executor()
+        for call in calls:
+            call.submit(executor)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    if not previous_transaction.nested:
+        # The whole database transaction is rolled back
+        calls = session.info.pop(PENDING_KEY, ())
+    else:
+        calls = []
+        kept = []
+        for call in session.info.get(PENDING_KEY, ()):
+            if call.in_transaction(previous_transaction):
+                calls.append(call)
+            else:
+                kept.append(call)
+        if kept:
+            session.info[PENDING_KEY] = kept
+        else:
+            session.info.pop(PENDING_KEY, None)
+    for call in calls:
+        call.future.cancel()
@@ -0,0 +1,296 @@
+"""Data-driven FSM definitions.
+
+Workflows kept in configuration are compiled straight into the transition
+metas & handler tables (no transition classes are created for them):
+
+    workflows = definition.Registry(functions={'is_paid': is_paid})
+    workflows.add('retail', {
+        'states': ['new', 'paid', 'shipped'],
+        'transitions': {
+            'pay': {'source': 'new', 'target': 'paid',
+                    'conditions': ['is_paid']},
+            'ship': {'source': 'paid', 'target': 'shipped'},
+        },
+    })
+
+    class Order(Base):
+        state = Column(FSMField)
+        workflow = Column(String)
+        fsm = workflows.transitions('workflow')
+
+    order.fsm.pay.set()
+
+The definition of a record is selected by the value of its discriminator
+column (`workflow` above). Definitions are compiled once per content hash,
+so any number of keys (e.g. tenants) can share one compiled definition.
+"""
+
+import hashlib
+import json
+
+import sqlalchemy
+
+from six import string_types
+
+from . import exc, util, states
+from .bound import BoundFSMFunction, BoundFSMHandlers, HandlerTable
+from .meta import FSMMeta
+from .transition import (
+    ClassBoundFsmTransition, InstanceBoundFsmTransition, get_sqla_handle,
+)
+
+
+HANDLER_KEYS = frozenset(('source', 'target', 'conditions', 'handler'))
+
+
+def definition_hash(definition):
+    """SHA-1 of the canonical JSON of the `definition`."""
+    try:
+        data = json.dumps(definition, sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError) as err:
+        raise exc.SetupError(
+            'FSM definition must be JSON-serialisable: {}'.format(err))
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+def no_handler(instance, *args, **kwargs):
+    """Handler of the transitions that only change the state."""
+
+
+class CompiledDefinition(object):
+    """Transition tables compiled from a definition.
+
+    `transitions` is a {name: (meta, HandlerTable)} dict.
+    """
+
+    __slots__ = ("digest", "states", "transitions")
+
+    def __init__(self, digest, states, transitions):
+        self.digest = digest
+        self.states = states
+        self.transitions = transitions
+
+    def get_bound(self, model, name):
+        """Bound meta of the `name` transition for the `model`."""
+        (meta, table) = self.transitions[name]
+        return meta.get_bound(get_sqla_handle(model), table, ())
+
+    def __repr__(self):
+        return "<{} {} transitions={!r}>".format(
+            self.__class__.__name__, self.digest[:10],
+            sorted(self.transitions)
+        )
+
+
+class Registry(object):
+    """Named functions & the definitions referring to them."""
+
+    def __init__(self, functions=None):
+        # {name: condition or handler}
+        self.functions = dict(functions or {})
+        # {discriminator value: CompiledDefinition}
+        self.definitions = {}
+        # {definition hash: CompiledDefinition}
+        self.compiled = {}
+
+    def register(self, func=None, name=None):
+        """Decorator adding the function under its (or the given) name."""
+        if func is None:
+            return lambda func: self.register(func, name)
+        self.functions[name or func.__name__] = func
+        return func
+
+    def add(self, key, definition):
+        """Add the `definition` (a dict or its JSON) for the discriminator
+        value `key`. Returns the compiled definition."""
+        if isinstance(definition, string_types):
+            definition = json.loads(definition)
+        out = self.definitions[key] = self.compile(definition)
+        return out
+
+    def get(self, key):
+        try:
+            return self.definitions[key]
+        except KeyError:
+            raise exc.SetupError('No FSM definition for {!r}'.format(key))
+
+    def compile(self, definition):
+        """Compile the `definition` (cached by its hash)."""
+        digest = definition_hash(definition)
+        try:
+            return self.compiled[digest]
+        except KeyError:
+            pass
+        out = self.compiled[digest] = CompiledDefinition(
+            digest, self.get_states(definition),
+            dict(
+                (name, self.compile_transition(name, spec))
+                for (name, spec) in definition.get('transitions', {}).items()
+            )
+        )
+        if out.states is not None:
+            self.check_states(out)
+        return out
+
+    def get_states(self, definition):
+        names = definition.get('states')
+        if names is None:
+            return None
+        if not all(util.is_valid_fsm_state(name) for name in names):
+            raise NotImplementedError(names)
+        return frozenset(names)
+
+    def resolve(self, name):
+        try:
+            return self.functions[name]
+        except (KeyError, TypeError):
+            raise exc.SetupError('Unknown FSM function {!r}'.format(name))
+
+    def compile_transition(self, name, spec):
+        """Return (meta, HandlerTable) of the transition's `spec`
+        (a handler dict or list of them)."""
+        if isinstance(spec, dict):
+            spec = [spec]
+        handlers = []
+        for handler_spec in spec:
+            unknown = set(handler_spec).difference(HANDLER_KEYS)
+            if unknown:
+                raise exc.SetupError(
+                    'Unknown keys {!r} of transition {!r}'.format(
+                        sorted(unknown), name)
+                )
+            handler_meta = FSMMeta(
+                handler_spec.get('source', '*'), handler_spec.get('target'),
+                [
+                    self.resolve(condition)
+                    for condition in handler_spec.get('conditions', ())
+                ],
+                (), BoundFSMFunction,
+            )
+            handler = handler_spec.get('handler')
+            handlers.append((
+                handler_meta,
+                no_handler if handler is None else self.resolve(handler)
+            ))
+
+        targets = set(handler_meta.target for (handler_meta, _) in handlers)
+        if len(targets) != 1 or None in targets:
+            raise exc.SetupError(
+                'Transition {!r} needs one and just one target, '
+                'got {!r}'.format(name, sorted(targets, key=str))
+            )
+        meta = FSMMeta(
+            [
+                source
+                for (handler_meta, _) in handlers
+                for source in handler_meta.sources
+            ],
+            targets.pop(), (), (), BoundFSMHandlers,
+        )
+        return (meta, HandlerTable(name, handlers))
+
+    def check_states(self, compiled):
+        declared = compiled.states
+        for (name, (meta, table)) in compiled.transitions.items():
+            used = set(meta.sources)
+            used.add(meta.target)
+            used.difference_update(('*', None))
+            for state in used:
+                if states.is_pattern(state):
+                    parent = states.get_pattern_parent(state)
+                    known = any(
+                        states.is_in_state(el, parent) for el in declared)
+                else:
+                    known = state in declared
+                if not known:
+                    raise exc.SetupError(
+                        'Transition {!r} refers to undeclared state '
+                        '{!r}'.format(name, state)
+                    )
+
+    def transitions(self, discriminator):
+        """Return model attribute exposing transitions of the record's
+        definition (selected by the `discriminator` column attribute)."""
+        return DefinitionTransitions(self, discriminator)
+
+
+class DefinitionTransitions(object):
+    """Model attribute of the definition-driven transitions."""
+
+    def __init__(self, registry, discriminator):
+        self.registry = registry
+        self.discriminator = discriminator
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return ClassBoundDefinitions(self, owner)
+        compiled = self.registry.get(getattr(instance, self.discriminator))
+        return InstanceBoundDefinition(compiled, owner, instance)
+
+
+class ClassBoundDefinitions(object):
+
+    __slots__ = ("descriptor", "owner")
+
+    def __init__(self, descriptor, owner):
+        self.descriptor = descriptor
+        self.owner = owner
+
+    def applicable(self, name, *args, **kwargs):
+        """SQL filter matching records the `name` transition of their
+        definition can be applied to (all conditions must be hybrid)."""
+        column = getattr(self.owner, self.descriptor.discriminator)
+        handle = get_sqla_handle(self.owner)
+        by_digest = {}
+        for (key, compiled) in self.descriptor.registry.definitions.items():
+            if name in compiled.transitions:
+                by_digest.setdefault(compiled, []).append(key)
+        return sqlalchemy.or_(*[
+            sqlalchemy.and_(
+                column.in_(sorted(keys)),
+                ClassBoundFsmTransition(
+                    compiled.transitions[name][0], handle,
+                    compiled.transitions[name][1], self.owner
+                ).applicable(*args, **kwargs)
+            )
+            for (compiled, keys) in sorted(
+                by_digest.items(), key=lambda item: item[0].digest)
+        ])
+
+
+class InstanceBoundDefinition(object):
+    """Transitions of a record's definition
+    (`record.fsm.pay` or `record.fsm['pay']`)."""
+
+    __slots__ = ("definition", "owner", "record")
+
+    def __init__(self, definition, owner, record):
+        self.definition = definition
+        self.owner = owner
+        self.record = record
+
+    def __getitem__(self, name):
+        (meta, table) = self.definition.transitions[name]
+        return InstanceBoundFsmTransition(
+            meta, self.definition.get_bound(self.owner, name), table,
+            self.owner, self.record
+        )
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __contains__(self, name):
+        return name in self.definition.transitions
+
+    def __iter__(self):
+        return iter(sorted(self.definition.transitions))
+
+    def available(self, *args, **kwargs):
+        """Names of the transitions that can be `set()` now."""
+        return [
+            name for name in self
+            if self[name].can_proceed(*args, **kwargs)
+        ]
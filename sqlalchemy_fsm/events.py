@@ -1,37 +1,101 @@
-from functools import wraps, partial
-
 from sqlalchemy.orm.instrumentation import register_class
 
 import sqlalchemy.orm.events
 
+from . import exc, util, states
 
-@sqlalchemy.event.dispatcher
-class FSMSchemaEvents(sqlalchemy.orm.events.InstanceEvents):
-    """Define event listeners for FSM Schema (table) objects."""
 
-    def before_state_change(self, source, target):
-        """Event that is fired before the model changes
-        form `source` to `target` state."""
+STATE_CHANGE_EVENTS = ('before_state_change', 'after_state_change')
 
-    def after_state_change(self, source, target):
-        """Event that is fired after the model changes
-        form `source` to `target` state."""
 
+def _as_state_set(value):
+    if util.is_valid_source_state(value):
+        return frozenset((value, ))
+    return frozenset(value)
+
+
+class StateFilteredListener(object):
+    """Listener that is only called for matching (source, target) pairs.
+
+    Registered by passing `source_state` and/or `target_state`
+    to `event.listen()`.
+    """
+
+    __slots__ = (
+        "fn", "sources", "targets", "source_patterns", "target_patterns",
+        "raw", "__weakref__",
+    )
+
+    def __init__(self, fn, sources, targets, raw):
+        self.fn = fn
+        self.sources = _as_state_set(sources)
+        self.targets = _as_state_set(targets)
+        self.source_patterns = states.get_pattern_parents(self.sources)
+        self.target_patterns = states.get_pattern_parents(self.targets)
+        self.raw = raw
+
+    def matches(self, source, target):
+        return states.source_covered(
+            source, self.sources, self.source_patterns
+        ) and states.source_covered(
+            target, self.targets, self.target_patterns
+        )
 
-class InstanceRef(object):
-    """This class has to be passed to the dispatch call as instance.
+    def call_matched(self, state, source, target):
+        if self.raw:
+            instance = state
+        else:
+            instance = state.obj()
+        return self.fn(instance, source=source, target=target)
 
-    No idea why it is required.
+    def __call__(self, state, source, target):
+        if self.matches(source, target):
+            return self.call_matched(state, source, target)
 
+
+# `event.dispatcher` decorator replaces the class object,
+#   so `super()` can not be used in its methods.
+_base_listen = sqlalchemy.orm.events.InstanceEvents._listen.__func__
+
+
+@sqlalchemy.event.dispatcher
+class FSMSchemaEvents(sqlalchemy.orm.events.InstanceEvents):
+    """Define event listeners for FSM Schema (table) objects.
+
+    State change listeners can be limited to particular states with
+    `source_state` and `target_state` arguments (a state, `<state>.*`
+    pattern or a list of them) e.g. `event.listen(Order,
+    'after_state_change', fn, target_state='published')`.
+    (`target` name is taken by `event.listen()` itself.)
     """
 
-    __slots__ = ('target', )
+    @classmethod
+    def _listen(cls, event_key, source_state='*', target_state='*', **kw):
+        StateChangeDispatch.listeners_version += 1
+        if source_state == '*' and target_state == '*':
+            return _base_listen(cls, event_key, **kw)
+
+        if event_key.identifier not in STATE_CHANGE_EVENTS:
+            raise exc.SetupError(
+                '{!r} event does not support source/target filters'.format(
+                    event_key.identifier
+                )
+            )
+        kw.pop('restore_load_context', None)
+        listener = StateFilteredListener(
+            event_key._listen_fn, source_state, target_state,
+            kw.pop('raw', False)
+        )
+        return _base_listen(
+            cls, event_key.with_wrapper(listener), raw=True, **kw)
 
-    def __init__(self, target):
-        self.target = target
+    def before_state_change(self, source, target):
+        """Event that is fired before the model changes
+        form `source` to `target` state."""
 
-    def obj(self):
-        return self.target
+    def after_state_change(self, source, target):
+        """Event that is fired after the model changes
+        form `source` to `target` state."""
 
 
 FSM_EVENT_DISPATCHER_CACHE = {}
@@ -47,18 +111,65 @@ def get_class_bound_dispatcher(target_cls):
     return out_val
 
 
-class BoundFSMDispatcher(object):
-    """Utility method that simplifies sqlalchemy event dispatch."""
+class StateChangeDispatch(object):
+    """Calls only the state change listeners matching (source, target).
 
-    def __init__(self, instance):
-        self.__ref = InstanceRef(instance)
-        self.__cls_dispatcher = get_class_bound_dispatcher(type(instance))
-        for fsm_handle in ('before_state_change', 'after_state_change'):
-            # Precompute fsm handles
-            getattr(self, fsm_handle)
+    Listeners matching each (source, target) pair are precomputed
+    on first use, the tables are rebuilt when listeners are added
+    or removed.
+    """
 
-    def __getattr__(self, name):
-        handle = partial(getattr(self.__cls_dispatcher, name), self.__ref)
-        setattr(self, name, handle)
-        return handle
-        
\ No newline at end of file
+    __slots__ = ("cls_dispatcher", "name", "fingerprint", "table")
+
+    # Incremented on every `listen()` call. Listener removal always
+    #   changes listener count, so it does not need to be tracked.
+    listeners_version = 0
+
+    def __init__(self, cls_dispatcher, name):
+        self.cls_dispatcher = cls_dispatcher
+        self.name = name
+        self.fingerprint = None
+        self.table = {}
+
+    def get_listeners(self, source, target):
+        collection = getattr(self.cls_dispatcher, self.name)
+        fingerprint = (
+            self.listeners_version, id(collection), len(collection))
+        if fingerprint != self.fingerprint:
+            self.table = {}
+            self.fingerprint = fingerprint
+
+        key = (source, target)
+        try:
+            return self.table[key]
+        except KeyError:
+            pass
+
+        out = []
+        for listener in collection:
+            if isinstance(listener, StateFilteredListener):
+                if listener.matches(source, target):
+                    out.append(listener.call_matched)
+            else:
+                out.append(listener)
+        out = self.table[key] = tuple(out)
+        return out
+
+    def __call__(self, state, source, target):
+        """Dispatch the event for `state` (sqlalchemy's `InstanceState`)."""
+        for listener in self.get_listeners(source, target):
+            listener(state, source=source, target=target)
+
+
+STATE_CHANGE_DISPATCH_CACHE = {}
+
+
+def get_state_change_dispatch(target_cls, name):
+    key = (target_cls, name)
+    try:
+        out_val = STATE_CHANGE_DISPATCH_CACHE[key]
+    except KeyError:
+        out_val = StateChangeDispatch(
+            get_class_bound_dispatcher(target_cls), name)
+        STATE_CHANGE_DISPATCH_CACHE[key] = out_val
+    return out_val
@@ -0,0 +1,191 @@
+"""Transition history table.
+
+    history = History(Base.metadata)
+    history.track(Order)
+
+Every state change of a tracked model's record is written to the history
+table (`fsm_history` by default) by the flush that writes the change, so
+the history commits and rolls back together with the records. Coalesced
+changes (see `coalesce`) are written as one net change.
+
+History ids increase monotonically, so the table can be read with keyset
+pagination (see `stream.tail()` and `columnar.export()`).
+"""
+
+import datetime
+
+import sqlalchemy
+import sqlalchemy.event
+
+from sqlalchemy import inspect as sqla_inspect
+from sqlalchemy.orm import Session
+
+from . import exc, statements, util
+
+
+DEFAULT_TABLE_NAME = 'fsm_history'
+
+# {model: History tracking it}
+_TRACKED = {}
+
+# Autoincrement only works for INTEGER primary keys on SQLite
+HistoryIdType = sqlalchemy.BigInteger().with_variant(
+    sqlalchemy.Integer(), 'sqlite')
+
+
+def history_table(metadata, name=DEFAULT_TABLE_NAME):
+    """Return table of the (model, record, source, target, time) changes."""
+    out = sqlalchemy.Table(
+        name, metadata,
+        sqlalchemy.Column('id', HistoryIdType, primary_key=True),
+        sqlalchemy.Column('model', sqlalchemy.String(255), nullable=False),
+        sqlalchemy.Column('record_id', sqlalchemy.BigInteger, nullable=False),
+        sqlalchemy.Column('source', sqlalchemy.String(255)),
+        sqlalchemy.Column('target', sqlalchemy.String(255)),
+        sqlalchemy.Column('created_at', sqlalchemy.DateTime, nullable=False),
+    )
+    sqlalchemy.Index('ix_{}_model_id'.format(name), out.c.model, out.c.id)
+    return out
+
+
+def get_model_name(model):
+    """Name of the `model` in the history table."""
+    return model.__name__
+
+
+def get_history(model):
+    """Return `History` tracking the `model` (or its base class)."""
+    for mapper in sqla_inspect(model).iterate_to_root():
+        try:
+            return _TRACKED[mapper.class_]
+        except KeyError:
+            continue
+    raise exc.SetupError('{!r} history is not tracked'.format(model))
+
+
+class PendingEntry(object):
+    """State change waiting for its flush."""
+
+    __slots__ = ("state", "source", "target", "created_at")
+
+    def __init__(self, state, source, target, created_at):
+        self.state = state
+        self.source = source
+        self.target = target
+        self.created_at = created_at
+
+
+class History(object):
+    """History table & the tracked models.
+
+    Flush listeners are registered on `sessions` (a session,
+    `sessionmaker` or `Session` class - all sessions by default)
+    and removed by `close()`.
+    """
+
+    _SESSION_EVENTS = (
+        ('after_flush', '_after_flush'),
+        ('after_soft_rollback', '_after_soft_rollback'),
+    )
+
+    def __init__(self, metadata, name=DEFAULT_TABLE_NAME, sessions=Session):
+        self.table = history_table(metadata, name)
+        self.insert = self.table.insert()
+        self.sessions = sessions
+        # {model: pk column attribute name}
+        self.models = {}
+        self.info_key = ('sa_fsm_history', id(self))
+        for (event_name, method) in self._SESSION_EVENTS:
+            sqlalchemy.event.listen(
+                sessions, event_name, getattr(self, method))
+
+    def close(self):
+        for model in list(self.models):
+            self.untrack(model)
+        for (event_name, method) in self._SESSION_EVENTS:
+            sqlalchemy.event.remove(
+                self.sessions, event_name, getattr(self, method))
+
+    def track(self, model):
+        """Record state changes of the `model`'s records."""
+        if model in self.models:
+            return
+        mapper = sqla_inspect(model)
+        pk_column = util.get_single_pk_column(mapper)
+        self.models[model] = mapper.get_property_by_column(pk_column).key
+        _TRACKED[model] = self
+        sqlalchemy.event.listen(
+            model, 'after_state_change', self._on_state_change,
+            raw=True, propagate=True
+        )
+
+    def untrack(self, model):
+        del self.models[model]
+        if _TRACKED.get(model) is self:
+            del _TRACKED[model]
+        sqlalchemy.event.remove(
+            model, 'after_state_change', self._on_state_change)
+
+    def get_pending(self, session):
+        try:
+            return session.info[self.info_key]
+        except KeyError:
+            out = session.info[self.info_key] = []
+            return out
+
+    def _on_state_change(self, state, source, target):
+        entry = PendingEntry(
+            state, source, target, datetime.datetime.utcnow())
+        session = state.session
+        if session is None:
+            # Picked up when the record is flushed
+            state.info.setdefault(self.info_key, []).append(entry)
+        else:
+            self.get_pending(session).append(entry)
+
+    def get_model(self, state):
+        """Tracked model (or base model) of the record."""
+        for mapper in state.mapper.iterate_to_root():
+            if mapper.class_ in self.models:
+                return mapper.class_
+        raise exc.SetupError(
+            '{!r} is not tracked'.format(state.mapper.class_))
+
+    def _after_flush(self, session, flush_context):
+        for record in session.new:
+            entries = sqla_inspect(record).info.pop(self.info_key, None)
+            if entries:
+                self.get_pending(session).extend(entries)
+
+        pending = session.info.get(self.info_key)
+        if not pending:
+            return
+        rows = []
+        unflushed = []
+        for entry in pending:
+            obj = entry.state.obj()
+            if obj is None or entry.state.session is not session:
+                # Expunged or garbage collected
+                continue
+            model = self.get_model(entry.state)
+            record_id = getattr(obj, self.models[model])
+            if record_id is None:
+                unflushed.append(entry)
+                continue
+            rows.append(dict(
+                model=get_model_name(model), record_id=record_id,
+                source=entry.source, target=entry.target,
+                created_at=entry.created_at,
+            ))
+        pending[:] = unflushed
+        if rows:
+            statements.execute(session, self.insert, rows)
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        session.info.pop(self.info_key, None)
+
+    def __repr__(self):
+        return "<{} {!r} models={!r}>".format(
+            self.__class__.__name__, self.table.name,
+            sorted(get_model_name(model) for model in self.models)
+        )
@@ -0,0 +1,240 @@
+"""Idempotency keys for transitions of retried (replayed) requests.
+
+    store = idempotency.KeyStore(Base.metadata)
+    idempotency.set_store(store)
+
+    record.published.set(idempotency_key=message.id)
+
+Keys are scoped to the transition and the record: one message can drive
+several transitions and records with the same key. The first `set()`
+with a key inserts (key, transition, record id) into the store's key
+table in the record's session transaction (so the key commits or rolls
+back together with the transition). A repeated `set()` of the same
+transition of the same record with a committed key returns without
+checking the state or calling the handler. Keys committed by this
+process are answered from an in-process LRU cache without a query, the
+others cost one `INSERT ... SELECT ... WHERE NOT EXISTS`. Of concurrent
+first deliveries of a key, all but one fail on the key's primary key
+(with `IntegrityError`), their retries are then duplicates.
+"""
+
+import collections
+import datetime
+import threading
+
+import sqlalchemy
+import sqlalchemy.event
+
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import instance_state
+
+from . import exc, statements
+
+
+DEFAULT_TABLE_NAME = 'fsm_idempotency_key'
+DEFAULT_MAX_CACHED = 10000
+
+_STORE = None
+
+
+def key_table(metadata, name=DEFAULT_TABLE_NAME):
+    """Return table of the used idempotency keys
+    (per transition & record)."""
+    return sqlalchemy.Table(
+        name, metadata,
+        sqlalchemy.Column('key', sqlalchemy.String(255), primary_key=True),
+        sqlalchemy.Column(
+            'transition', sqlalchemy.String(255), primary_key=True),
+        sqlalchemy.Column(
+            'record_id', sqlalchemy.String(255), primary_key=True),
+        sqlalchemy.Column('created_at', sqlalchemy.DateTime),
+    )
+
+
+def get_scoped_key(record, key, name):
+    """(key, transition name, record id) the `key` of the `record`'s
+    `name` transition is stored as."""
+    state = instance_state(record)
+    if state.identity is None:
+        # Pending record, its primary key is assigned by the flush
+        object_session(record).flush([record])
+    # Identity does not load expired records
+    return (key, name, ','.join(str(el) for el in state.identity))
+
+
+class KeyStore(object):
+    """Key table & the LRU cache of the keys known to be committed.
+
+    Keys are (key, transition name, record id) tuples
+    (see `get_scoped_key()`).
+
+    Commit listeners are registered on `sessions` (a session,
+    `sessionmaker` or `Session` class - all sessions by default)
+    and removed by `close()`.
+    """
+
+    _SESSION_EVENTS = (
+        ('after_commit', '_after_commit'),
+        ('after_soft_rollback', '_after_soft_rollback'),
+    )
+
+    def __init__(
+        self, metadata, name=DEFAULT_TABLE_NAME,
+        max_cached=DEFAULT_MAX_CACHED, sessions=Session
+    ):
+        self.table = key_table(metadata, name)
+        self.max_cached = max_cached
+        self.sessions = sessions
+        # {scoped key: None}, most recently used last
+        self.cached = collections.OrderedDict()
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.info_key = ('sa_fsm_idempotency', id(self))
+        self.insert = self.get_insert_statement()
+        self.delete = self.table.delete().where(
+            self.get_key_filter())
+        for (name, method) in self._SESSION_EVENTS:
+            sqlalchemy.event.listen(sessions, name, getattr(self, method))
+
+    def close(self):
+        for (name, method) in self._SESSION_EVENTS:
+            sqlalchemy.event.remove(
+                self.sessions, name, getattr(self, method))
+        self.clear()
+
+    def get_key_params(self):
+        """Bind parameters of the key columns."""
+        columns = self.table.c
+        return [
+            sqlalchemy.bindparam(name, type_=columns[name].type)
+            for name in ('key', 'transition', 'record_id')
+        ]
+
+    def get_key_filter(self):
+        return sqlalchemy.and_(*[
+            self.table.c[param.key] == param
+            for param in self.get_key_params()
+        ])
+
+    def get_insert_statement(self):
+        """INSERT of the key that does nothing if it is there already."""
+        table = self.table
+        return table.insert().from_select(
+            ['key', 'transition', 'record_id', 'created_at'],
+            sqlalchemy.select(self.get_key_params() + [
+                sqlalchemy.bindparam(
+                    'created_at', type_=table.c.created_at.type),
+            ]).where(~sqlalchemy.exists(
+                sqlalchemy.select([table.c.key]).where(self.get_key_filter())
+            ))
+        )
+
+    def get_params(self, scoped_key):
+        (key, name, record_id) = scoped_key
+        return dict(key=key, transition=name, record_id=record_id)
+
+    def is_cached(self, key):
+        with self.lock:
+            if key not in self.cached:
+                return False
+            # Most recently used
+            self.cached[key] = self.cached.pop(key)
+            self.hits += 1
+            return True
+
+    def get_pending(self, session):
+        """Keys claimed in the session's current transaction
+        ({scoped key: None}, in the claim order)."""
+        try:
+            return session.info[self.info_key]
+        except KeyError:
+            out = session.info[self.info_key] = collections.OrderedDict()
+            return out
+
+    def claim(self, session, scoped_key, mapper=None):
+        """Record use of the (key, transition name, record id) `scoped_key`.
+
+        Returns False if the key has been used already.
+        """
+        if self.is_cached(scoped_key):
+            return False
+        pending = self.get_pending(session)
+        if scoped_key in pending:
+            return False
+        params = self.get_params(scoped_key)
+        params['created_at'] = datetime.datetime.utcnow()
+        result = statements.execute(session, self.insert, params, mapper)
+        # Duplicates are cached on commit too
+        pending[scoped_key] = None
+        return result.rowcount == 1
+
+    def release(self, session, scoped_key, mapper=None):
+        """Forget the `scoped_key` claimed by a transition that has failed."""
+        self.get_pending(session).pop(scoped_key, None)
+        statements.execute(
+            session, self.delete, self.get_params(scoped_key), mapper)
+
+    def clear(self):
+        with self.lock:
+            self.cached.clear()
+
+    def _after_commit(self, session):
+        transaction = session.transaction
+        if transaction is not None and transaction.nested:
+            # Released savepoint (SQLAlchemy < 1.4 calls `after_commit`
+            #   for these), the keys can still be rolled back
+            return
+        pending = session.info.pop(self.info_key, None)
+        if not pending:
+            return
+        with self.lock:
+            for key in pending:
+                self.cached.pop(key, None)
+                self.cached[key] = None
+            while len(self.cached) > self.max_cached:
+                self.cached.popitem(last=False)
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        session.info.pop(self.info_key, None)
+
+    def __repr__(self):
+        return "<{} {!r} cached={} hits={}>".format(
+            self.__class__.__name__, self.table.name,
+            len(self.cached), self.hits
+        )
+
+
+def set_store(store):
+    """Set the `KeyStore` used by `set(..., idempotency_key=...)`.
+
+    Returns the old store (or None).
+    """
+    global _STORE
+    (out, _STORE) = (_STORE, store)
+    return out
+
+
+def get_store():
+    if _STORE is None:
+        raise exc.SetupError(
+            'Idempotency keys need a store, see idempotency.set_store()')
+    return _STORE
+
+
+def claim(record, key, name):
+    """Claim the `key` for the `record`'s `name` transition
+    (in its session)."""
+    session = object_session(record)
+    if session is None:
+        raise exc.SetupError(
+            'Idempotency keys need the record to be in a session')
+    store = get_store()
+    return store.claim(
+        session, get_scoped_key(record, key, name), type(record))
+
+
+def release(record, key, name):
+    get_store().release(
+        object_session(record), get_scoped_key(record, key, name),
+        type(record)
+    )
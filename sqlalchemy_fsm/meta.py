@@ -1,24 +1,60 @@
 """FSM meta object."""
 
-import collections
+import datetime
 
-from . import util
+from six import string_types
+
+try:
+    from collections.abc import Iterable
+except ImportError:
+    # Python 2
+    from collections import Iterable
+
+from . import util, cache, states
+
+
+@cache.dictCache
+def BoundMetaCache(key):
+    """Bound metas are stateless, so one is shared by all records."""
+    (meta, sqlalchemy_handle, set_func, extra_args) = key
+    return meta.bound_cls(meta, sqlalchemy_handle, set_func, extra_args)
 
 
 class FSMMeta(object):
 
     __slots__ = (
-        "target", "conditions", "sources",
-        "bound_cls", "extra_call_args",
+        "target", "conditions", "sources", "source_patterns",
+        "bound_cls", "extra_call_args", "after", "adaptive", "prefetch",
+        "defer",
     )
 
     def __init__(
         self, source, target,
-        conditions, extra_args, bound_cls
+        conditions, extra_args, bound_cls, after=None, adaptive=False,
+        prefetch=(), defer=False
     ):
         self.bound_cls = bound_cls
         self.conditions = tuple(conditions)
         self.extra_call_args = tuple(extra_args)
+        self.adaptive = adaptive
+
+        # Relationship paths (e.g. 'customer' or 'items.product')
+        #   conditions & handler use
+        if isinstance(prefetch, string_types) or \
+                not isinstance(prefetch, Iterable):
+            raise NotImplementedError(prefetch)
+        self.prefetch = tuple(prefetch)
+        if not all(util.is_valid_attribute_path(el) for el in self.prefetch):
+            raise NotImplementedError(self.prefetch)
+
+        if after is not None and not isinstance(after, datetime.timedelta):
+            raise NotImplementedError(after)
+        self.after = after
+
+        # Run the handler after commit (see `deferred`)
+        if not isinstance(defer, bool):
+            raise NotImplementedError(defer)
+        self.defer = defer
 
         if target is not None:
             if not util.is_valid_fsm_state(target):
@@ -29,7 +65,7 @@ class FSMMeta(object):
 
         if util.is_valid_source_state(source):
             all_sources = (source, )
-        elif isinstance(source, collections.Iterable):
+        elif isinstance(source, Iterable):
             all_sources = tuple(source)
 
             if not all(
@@ -41,10 +77,23 @@ class FSMMeta(object):
             raise NotImplementedError(source)
 
         self.sources = frozenset(all_sources)
+        # Parents of the `<state>.*` sources
+        self.source_patterns = states.get_pattern_parents(self.sources)
+
+    def matches_source(self, state):
+        """Is the transition possible from the `state`."""
+        return (
+            '*' in self.sources
+        ) or (
+            state in self.sources
+        ) or (
+            self.source_patterns and
+            states.matches_patterns(state, self.source_patterns)
+        )
 
     def get_bound(self, sqlalchemy_handle, set_func, extra_args):
-        return self.bound_cls(
-            self, sqlalchemy_handle, set_func, extra_args
+        return BoundMetaCache.getValue(
+            (self, sqlalchemy_handle, set_func, tuple(extra_args))
         )
 
     def __repr__(self):
@@ -0,0 +1,243 @@
+"""Data migration helpers for renaming & merging FSM states.
+
+Meant to be used from Alembic migrations:
+
+    def upgrade():
+        migration.remap_states(
+            op.get_bind(), models.BlogPost, {'hidden': 'archived'})
+
+All rows are rewritten in bounded primary key chunks, so the table
+is never locked as a whole.
+"""
+
+import time
+import warnings
+
+import sqlalchemy
+
+from sqlalchemy import inspect as sqla_inspect
+from sqlalchemy.engine import Engine
+
+from . import exc, util, states, statements
+from .bound import COLUMN_CACHE
+from .transition import get_model_states
+
+
+def check_chains(mapping):
+    """Reject mappings with new states that are remapped themselves
+    (e.g. `{'a': 'b', 'b': 'c'}`) - rows would be remapped again
+    by a restarted migration."""
+    changed = dict(
+        (old, new) for (old, new) in mapping.items() if old != new)
+    chained = set(changed).intersection(changed.values())
+    if chained:
+        raise exc.SetupError(
+            'States {} are both remapped and remapped to, split the '
+            'mapping into separate migrations'.format(sorted(chained))
+        )
+
+
+def check_mapping(model, mapping):
+    """Validate `{old_state: new_state}` mapping against the model's FSM.
+
+    New states must be known to the current `@transition` graph.
+    Warns about old states that the graph still refers to.
+    """
+    if not mapping:
+        raise exc.SetupError('Empty state mapping')
+    check_chains(mapping)
+    known_states = get_model_states(model)
+    known_patterns = states.get_pattern_parents(known_states)
+    unknown = set(
+        state for state in mapping.values()
+        if not states.source_covered(state, known_states, known_patterns)
+    )
+    if unknown:
+        raise exc.SetupError(
+            'States {} are not used by any transition of {!r}'.format(
+                sorted(unknown), model
+            )
+        )
+    still_used = known_states.intersection(
+        state for (state, new_state) in mapping.items()
+        if state != new_state
+    )
+    if still_used:
+        warnings.warn(
+            'States {} are remapped but are still used by transitions '
+            'of {!r}'.format(sorted(still_used), model)
+        )
+
+
+def _state_case(column, mapping):
+    return sqlalchemy.case(
+        [(column == old, new) for (old, new) in sorted(mapping.items())],
+        else_=column
+    )
+
+
+def remap_column(
+    connection, column, pk_column, mapping,
+    chunk_size=1000, pause=0, start_after=None, on_chunk=None,
+    criteria=None
+):
+    """Rewrite states stored in `column` according to the `mapping`.
+
+    `criteria` (SQL clause) limits the rewritten rows
+    (e.g. `history.c.model == 'BlogPost'` of a shared history table).
+
+    Rows are located with keyset pagination over `pk_column`
+    (filtered by the old states), each chunk is updated in its own
+    transaction and `pause` seconds are waited between the chunks.
+
+    The migration is idempotent: rows that were already remapped no
+    longer match the old states, so an interrupted run can be simply
+    restarted (or resumed from the last `on_chunk(column, last_pk, count)`
+    reported primary key with `start_after`). Mappings with chained
+    states (`{'a': 'b', 'b': 'c'}`) are rejected, as they are not.
+
+    Returns number of the updated rows.
+    """
+    check_chains(mapping)
+    # States mapped to themselves would match (& be rewritten) forever
+    old_states = sorted(state for state in mapping if mapping[state] != state)
+    if not old_states:
+        return 0
+    row_filter = column.in_(old_states)
+    if criteria is not None:
+        row_filter = sqlalchemy.and_(row_filter, criteria)
+    # Built once, so that the chunks reuse the compiled statements
+    first_query = sqlalchemy.select([pk_column]).where(
+        row_filter
+    ).order_by(pk_column).limit(chunk_size)
+    next_query = first_query.where(
+        pk_column > sqlalchemy.bindparam('sa_fsm_last_pk'))
+    chunk_update = column.table.update().where(sqlalchemy.and_(
+        pk_column.between(
+            sqlalchemy.bindparam('sa_fsm_first_pk'),
+            sqlalchemy.bindparam('sa_fsm_last_pk'),
+        ),
+        row_filter,
+    )).values({column.name: _state_case(column, mapping)})
+
+    total = 0
+    last_pk = start_after
+    while True:
+        if last_pk is None:
+            chunk = statements.execute(connection, first_query)
+        else:
+            chunk = statements.execute(
+                connection, next_query, dict(sa_fsm_last_pk=last_pk))
+        pks = [row[0] for row in chunk]
+        if not pks:
+            break
+        with connection.begin():
+            result = statements.execute(connection, chunk_update, dict(
+                sa_fsm_first_pk=pks[0], sa_fsm_last_pk=pks[-1]))
+        total += result.rowcount
+        last_pk = pks[-1]
+        if on_chunk is not None:
+            on_chunk(column, last_pk, result.rowcount)
+        if pause:
+            time.sleep(pause)
+    return total
+
+
+def remap_counters(connection, state_column, count_column, mapping):
+    """Merge per-state counter rows according to the `mapping`.
+
+    Counts of the old state are added to the new state's row
+    (that is created if it does not exist yet).
+    """
+    table = state_column.table
+    old_state = sqlalchemy.bindparam('sa_fsm_old', type_=state_column.type)
+    new_state = sqlalchemy.bindparam('sa_fsm_new', type_=state_column.type)
+    # Built once, so that the states reuse the compiled statements
+    select_count = sqlalchemy.select([count_column]).where(
+        state_column == old_state)
+    add_count = table.update().where(state_column == new_state).values({
+        count_column.name: count_column + sqlalchemy.bindparam(
+            'sa_fsm_count', type_=count_column.type),
+    })
+    delete_old = table.delete().where(state_column == old_state)
+    rename_old = table.update().where(state_column == old_state).values({
+        state_column.name: new_state,
+    })
+    with connection.begin():
+        for (old, new) in sorted(mapping.items()):
+            if old == new:
+                continue
+            params = dict(sa_fsm_old=old, sa_fsm_new=new)
+            old_count = statements.execute(
+                connection, select_count, params).scalar()
+            if old_count is None:
+                continue
+            params['sa_fsm_count'] = old_count
+            updated = statements.execute(
+                connection, add_count, params).rowcount
+            if updated:
+                statements.execute(connection, delete_old, params)
+            else:
+                statements.execute(connection, rename_old, params)
+
+
+def remap_states(
+    bind, model, mapping, chunk_size=1000, pause=0, start_after=None,
+    related=(), counters=(), on_chunk=None, check=True
+):
+    """Rename/merge FSM states of the `model` table.
+
+    `mapping` is `{old_state: new_state}` dict (several old states can be
+    merged into one). `bind` is an engine or a connection
+    (e.g. `op.get_bind()` in Alembic).
+
+    `related` is a list of extra state columns (e.g. `source` & `target`
+    of a history table) that are rewritten the same way, chunked by their
+    own table's primary key. Items can also be `(column, criteria)`
+    pairs, where the SQL `criteria` limits the rewritten rows (e.g. to
+    the model's rows of a history table shared by several models).
+    `counters` is a list of `(state_column, count_column)` pairs of
+    per-state counter tables which rows are merged.
+
+    Use Alembic's `autocommit_block()` for the chunks to be committed
+    separately, otherwise they are all part of the migration transaction.
+
+    Returns `{'table.column': updated row count}` dict.
+    """
+    if check:
+        check_mapping(model, mapping)
+
+    if isinstance(bind, Engine):
+        connection = bind.connect()
+    else:
+        connection = bind
+
+    fsm_column = COLUMN_CACHE.getValue(model)
+    pk_column = util.get_single_pk_column(sqla_inspect(model))
+    if pk_column.table is not fsm_column.table:
+        # State is stored in a side table (see `side_table`)
+        pk_column = util.get_single_table_pk(fsm_column.table)
+    columns = [(fsm_column, pk_column, start_after, None)]
+    for column in related:
+        if isinstance(column, tuple):
+            (column, criteria) = column
+        else:
+            criteria = None
+        columns.append((
+            column, util.get_single_table_pk(column.table), None, criteria))
+
+    out = {}
+    try:
+        for (column, chunk_pk, column_start, criteria) in columns:
+            out[str(column)] = remap_column(
+                connection, column, chunk_pk, mapping,
+                chunk_size=chunk_size, pause=pause,
+                start_after=column_start, on_chunk=on_chunk,
+                criteria=criteria,
+            )
+        for (state_column, count_column) in counters:
+            remap_counters(connection, state_column, count_column, mapping)
+    finally:
+        if connection is not bind:
+            connection.close()
+    return out
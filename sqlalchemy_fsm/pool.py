@@ -0,0 +1,53 @@
+"""Shared thread pool for the I/O-bound work (e.g. concurrent conditions).
+
+The pool is created on the first use. Its size can be changed with
+`configure(max_workers)` or it can be replaced with any
+`concurrent.futures.Executor` via `set_executor()`.
+"""
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_MAX_WORKERS = 8
+
+_LOCK = threading.Lock()
+_EXECUTOR = None
+
+
+def get_executor():
+    """Return the shared executor."""
+    global _EXECUTOR
+    out = _EXECUTOR
+    if out is None:
+        with _LOCK:
+            if _EXECUTOR is None:
+                _EXECUTOR = ThreadPoolExecutor(DEFAULT_MAX_WORKERS)
+            out = _EXECUTOR
+    return out
+
+
+def set_executor(executor):
+    """Replace the shared executor (the old one is not shut down).
+
+    Returns the old executor (or None).
+    """
+    global _EXECUTOR
+    with _LOCK:
+        (out, _EXECUTOR) = (_EXECUTOR, executor)
+    return out
+
+
+def configure(max_workers=DEFAULT_MAX_WORKERS):
+    """Replace the shared executor with a new thread pool."""
+    old = set_executor(ThreadPoolExecutor(max_workers))
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+def shutdown(wait=True):
+    """Shut the shared executor down (a new one is made on the next use)."""
+    old = set_executor(None)
+    if old is not None:
+        old.shutdown(wait=wait)
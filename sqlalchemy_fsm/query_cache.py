@@ -0,0 +1,290 @@
+"""Result cache for the state-list queries.
+
+    cache = query_cache.StateQueryCache(max_size=256)
+    pending = cache.all(session, Order.pending, [Order.owner_id == 5])
+
+Results are cached per (model, state, extra criteria) and are
+invalidated when a session commits an insert, update or delete of a
+record of the model that was (or is) in the state. Bulk UPDATEs and
+DELETEs (e.g. `scheduled.sweep()`) invalidate all entries of the model.
+Sessions with unflushed or uncommitted changes of the model bypass the
+cache (their results are neither read from nor written to it), rollbacks
+invalidate the changed states. Cached records already present in the
+session's identity map are returned as they are, not overwritten.
+
+Extra criteria must only refer to the model's own columns, changes
+of the other tables are not tracked. They are keyed by their compiled
+SQL, which is computed once per clause object - reuse the clauses or
+pass a `key` on the hot paths.
+"""
+
+import collections
+import itertools
+import pickle
+import threading
+import weakref
+
+import sqlalchemy
+import sqlalchemy.event
+
+from sqlalchemy import inspect as sqla_inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from . import cache, exc
+from .bound import COLUMN_CACHE
+
+
+# Invalidates all the states of a model
+ALL_STATES = object()
+
+
+@cache.dictCache
+def StateKeyCache(mapper):
+    """FSM state attribute name of the mapped class (None if not an FSM)."""
+    try:
+        state_column = COLUMN_CACHE.getValue(mapper.class_)
+    except exc.SetupError:
+        return None
+    return mapper.get_property_by_column(state_column).key
+
+
+# {id(clause): (weak reference to the clause, clause key)}
+_CLAUSE_KEYS = {}
+
+
+def clause_key(clause):
+    """Hashable key of the SQL `clause` (SQL text & bound values),
+    compiled once per clause object."""
+    clause_id = id(clause)
+    try:
+        (ref, out) = _CLAUSE_KEYS[clause_id]
+    except KeyError:
+        pass
+    else:
+        if ref() is clause:
+            return out
+    compiled = clause.compile()
+    out = (str(compiled), tuple(sorted(compiled.params.items())))
+    _CLAUSE_KEYS[clause_id] = (
+        weakref.ref(clause, lambda _: _CLAUSE_KEYS.pop(clause_id, None)),
+        out
+    )
+    return out
+
+
+def criteria_key(clauses):
+    """Hashable key of the SQL `clauses`."""
+    return tuple(clause_key(clause) for clause in clauses)
+
+
+class StateQueryCache(object):
+    """LRU-bounded cache of `session.query(Model).filter(Model.state())`
+    results.
+
+    Invalidation listeners are registered on `sessions`
+    (a session, `sessionmaker` or `Session` class - all sessions
+    by default) and removed by `close()`.
+    """
+
+    _SESSION_EVENTS = (
+        ('after_flush', '_after_flush'),
+        ('after_bulk_update', '_after_bulk_change'),
+        ('after_bulk_delete', '_after_bulk_change'),
+        ('after_commit', '_after_commit'),
+        ('after_soft_rollback', '_after_soft_rollback'),
+    )
+
+    def __init__(self, max_size=128, sessions=Session):
+        self.max_size = max_size
+        self.sessions = sessions
+        # {(model, state, criteria key): detached records}
+        self.entries = collections.OrderedDict()
+        # {(model, state): set of entry keys}
+        self.by_state = {}
+        # {(model, state): invalidation count}, protects entries from
+        #   being filled with results that are already stale
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self.info_key = ('sa_fsm_query_cache', id(self))
+        for (name, method) in self._SESSION_EVENTS:
+            sqlalchemy.event.listen(sessions, name, getattr(self, method))
+
+    def close(self):
+        for (name, method) in self._SESSION_EVENTS:
+            sqlalchemy.event.remove(
+                self.sessions, name, getattr(self, method))
+        self.clear()
+
+    def all(self, session, transition, criteria=(), order_by=(), key=None):
+        """Return records in the `transition`'s target state
+        matching the extra `criteria` (list of SQL clauses).
+
+        `key` (hashable) identifies the `criteria` & `order_by` instead
+        of their compiled SQL.
+        """
+        model = transition._sa_fsm_owner_cls
+        state = transition._sa_fsm_meta.target
+        if self.has_changes(session, model):
+            # The session sees its own changes, the cache does not
+            with self.lock:
+                self.misses += 1
+            return self.query(session, transition, criteria, order_by)
+
+        if key is None:
+            key = (criteria_key(criteria), criteria_key(order_by))
+        key = (model, state, key)
+
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                # Most recently used
+                self.entries[key] = self.entries.pop(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                generation = self.get_generation(model, state)
+
+        if cached is not None:
+            return self.get_records(session, pickle.loads(cached))
+
+        out = self.query(session, transition, criteria, order_by)
+        if self.has_pending(session, model):
+            # Flushed, but not committed changes are not cached
+            return out
+        snapshot = pickle.dumps(out, pickle.HIGHEST_PROTOCOL)
+
+        with self.lock:
+            if generation == self.get_generation(model, state):
+                self.entries[key] = snapshot
+                self.by_state.setdefault((model, state), set()).add(key)
+                while len(self.entries) > self.max_size:
+                    self.discard(next(iter(self.entries)))
+        return out
+
+    def query(self, session, transition, criteria, order_by):
+        return session.query(transition._sa_fsm_owner_cls).filter(
+            transition(), *criteria
+        ).order_by(*order_by).all()
+
+    def get_records(self, session, snapshot):
+        """Session's records of the detached `snapshot` records
+        (the ones already in the session are kept as they are)."""
+        identity_map = session.identity_map
+        out = []
+        for record in snapshot:
+            existing = identity_map.get(sqla_inspect(record).key)
+            if existing is None:
+                existing = session.merge(record, load=False)
+            out.append(existing)
+        return out
+
+    def get_generation(self, model, state):
+        return (
+            self.generations.get((model, state), 0),
+            self.generations.get((model, ALL_STATES), 0),
+        )
+
+    def discard(self, key):
+        del self.entries[key]
+        keys = self.by_state[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self.by_state[key[:2]]
+
+    def invalidate(self, model, state=ALL_STATES):
+        """Drop cached results of the `model` in the `state` (or all)."""
+        with self.lock:
+            bump = (model, state)
+            self.generations[bump] = self.generations.get(bump, 0) + 1
+            if state is ALL_STATES:
+                keys = [key for key in self.entries if key[0] is model]
+            else:
+                keys = list(self.by_state.get((model, state), ()))
+            for key in keys:
+                self.discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_state.clear()
+
+    def get_pending(self, session):
+        """(model, state) pairs to invalidate on the session's commit."""
+        try:
+            return session.info[self.info_key]
+        except KeyError:
+            out = session.info[self.info_key] = set()
+            return out
+
+    def _after_flush(self, session, flush_context):
+        pending = None
+        for record in set(session.new).union(
+            session.dirty, session.deleted
+        ):
+            for (model, states) in self.get_record_states(record):
+                if pending is None:
+                    pending = self.get_pending(session)
+                pending.update((model, state) for state in states)
+
+    def has_pending(self, session, model):
+        """Has the session flushed changes of the `model`'s records."""
+        pending = session.info.get(self.info_key)
+        return bool(pending) and any(
+            pending_model is model for (pending_model, _) in pending)
+
+    def has_changes(self, session, model):
+        """Has the session new, dirty, deleted or flushed (& uncommitted)
+        records of the `model`."""
+        return self.has_pending(session, model) or any(
+            isinstance(record, model)
+            for record in itertools.chain(
+                session.new, session.dirty, session.deleted)
+        )
+
+    def get_record_states(self, record):
+        """Yields (model, old & new states) for all classes the record's
+        results can be cached under."""
+        mapper = sqla_inspect(record).mapper
+        state_key = StateKeyCache.getValue(mapper)
+        if state_key is None:
+            return
+        states = set(get_history(record, state_key).sum())
+        for base_mapper in mapper.iterate_to_root():
+            yield (base_mapper.class_, states)
+
+    def add_bulk_change(self, session, mapper):
+        for base_mapper in mapper.iterate_to_root():
+            self.get_pending(session).add((base_mapper.class_, ALL_STATES))
+
+    def _after_bulk_change(self, update_context):
+        self.add_bulk_change(update_context.session, update_context.mapper)
+
+    def _after_commit(self, session):
+        transaction = session.transaction
+        if transaction is not None and transaction.nested:
+            # Released savepoint (SQLAlchemy < 1.4 calls `after_commit`
+            #   for these), not visible to the other sessions yet
+            return
+        pending = session.info.pop(self.info_key, None)
+        if pending:
+            for (model, state) in pending:
+                self.invalidate(model, state)
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        if previous_transaction.nested:
+            # Still written by the outer transaction's commit
+            pending = session.info.get(self.info_key)
+        else:
+            pending = session.info.pop(self.info_key, None)
+        if pending:
+            for (model, state) in pending:
+                self.invalidate(model, state)
+
+    def __repr__(self):
+        return "<{} entries={} hits={} misses={}>".format(
+            self.__class__.__name__, len(self.entries),
+            self.hits, self.misses
+        )
@@ -0,0 +1,254 @@
+"""Time-based (scheduled) transitions.
+
+Models that have an `FSMTimestamp` column next to their `FSMField`
+get it updated on every state change and get a composite
+(state, state_changed_at) index.
+
+Transitions declared with `@transition(..., after=timedelta(...))`
+are applied by `sweep()` to the records that have been in one of
+the transition's source states for longer than `after`.
+"""
+
+import datetime
+
+import sqlalchemy
+
+from sqlalchemy import inspect as sqla_inspect
+from sqlalchemy.orm import Mapper
+
+from . import cache, exc, statements, util
+from .bound import COLUMN_CACHE
+from .sqltypes import FSMField, FSMTimestamp
+from .transition import (
+    get_handler_metas, get_prefetch_options, sql_source_filter,
+)
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def _get_typed_columns(columns, column_type):
+    return [col for col in columns if isinstance(col.type, column_type)]
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.Column, 'after_parent_attach')
+def _add_state_age_index(column, table):
+    """Create (state, state_changed_at) index once both columns are there."""
+    if not isinstance(column.type, (FSMField, FSMTimestamp)):
+        return
+    if not isinstance(table, sqlalchemy.Table):
+        return
+    state_cols = _get_typed_columns(table.columns, FSMField)
+    time_cols = _get_typed_columns(table.columns, FSMTimestamp)
+    if len(state_cols) != 1 or len(time_cols) != 1:
+        return
+    sqlalchemy.Index(
+        'ix_{}_{}_{}'.format(
+            table.name, state_cols[0].name, time_cols[0].name),
+        state_cols[0], time_cols[0]
+    )
+
+
+@sqlalchemy.event.listens_for(Mapper, 'mapper_configured')
+def _maintain_state_timestamp(mapper, cls):
+    time_cols = _get_typed_columns(mapper.columns, FSMTimestamp)
+    state_cols = _get_typed_columns(mapper.columns, FSMField)
+    if not time_cols:
+        return
+    if len(time_cols) > 1 or len(state_cols) != 1:
+        raise exc.SetupError(
+            'One FSMTimestamp and one FSMField expected in {!r}'.format(cls))
+
+    state_key = mapper.get_property_by_column(state_cols[0]).key
+    if mapper.inherits is not None and \
+            mapper.inherits.has_property(state_key):
+        # Listener propagates from the parent class
+        return
+    time_key = mapper.get_property_by_column(time_cols[0]).key
+
+    def on_state_set(target, value, oldvalue, initiator):
+        if value != oldvalue:
+            setattr(target, time_key, utcnow())
+
+    sqlalchemy.event.listen(
+        getattr(cls, state_key), 'set', on_state_set, propagate=True)
+
+
+def get_timestamp_column(model):
+    time_cols = _get_typed_columns(sqla_inspect(model).columns, FSMTimestamp)
+    if len(time_cols) != 1:
+        raise exc.SetupError(
+            'One FSMTimestamp column expected in {!r}'.format(model))
+    return time_cols[0]
+
+
+class SweepResult(object):
+    """Outcome of a `sweep()` call."""
+
+    __slots__ = ("applied", "conflicts", "rejected", "batches")
+
+    def __init__(self):
+        # Records this worker has transitioned
+        self.applied = 0
+        # Records changed (e.g. by other workers) since they were selected
+        self.conflicts = 0
+        # Records the transition raised an exception for
+        self.rejected = 0
+        self.batches = 0
+
+    def __repr__(self):
+        return "<{} applied={} conflicts={} rejected={}>".format(
+            self.__class__.__name__, self.applied,
+            self.conflicts, self.rejected
+        )
+
+
+@cache.dictCache
+def SweepQueryCache(key):
+    """Next batch of the sweep candidates (oldest first).
+
+    The batch size is a bind parameter, so it is not a part of the key.
+    """
+    (pk_column, state_column, time_column, sources, resume) = key
+    criteria = [
+        sql_source_filter(state_column, sources),
+        time_column <= sqlalchemy.bindparam('sa_fsm_cutoff'),
+    ]
+    if resume:
+        last_time = sqlalchemy.bindparam('sa_fsm_last_time')
+        criteria.append(sqlalchemy.or_(
+            time_column > last_time,
+            sqlalchemy.and_(
+                time_column == last_time,
+                pk_column > sqlalchemy.bindparam('sa_fsm_last_pk'),
+            ),
+        ))
+    return sqlalchemy.select(
+        [pk_column, state_column, time_column]
+    ).where(sqlalchemy.and_(*criteria)).order_by(
+        time_column, pk_column
+    ).limit(sqlalchemy.bindparam('sa_fsm_limit')).with_for_update(
+        skip_locked=True)
+
+
+@cache.dictCache
+def ClaimUpdateCache(key):
+    """No-op UPDATE of a record that only matches (and locks the row)
+    if neither its state nor its state timestamp have changed."""
+    (pk_column, state_column, time_column) = key
+    return pk_column.table.update().where(sqlalchemy.and_(
+        pk_column == sqlalchemy.bindparam('sa_fsm_pk'),
+        state_column == sqlalchemy.bindparam('sa_fsm_state'),
+        time_column == sqlalchemy.bindparam('sa_fsm_time'),
+    )).values({time_column: time_column})
+
+
+def sweep(
+    session, transition, now=None, batch_size=100, max_batches=None,
+    args=(), kwargs=None
+):
+    """Apply time-based `transition` (e.g. `Model.expired`) to all records
+    that have spent its `after` time in one of its source states.
+
+    Records are selected in batches of `batch_size`, oldest first, using
+    the (state, state_changed_at) index. Every record is first claimed
+    with a compare-and-swap UPDATE that only succeeds (and locks the row)
+    if neither state nor its timestamp have changed since the record was
+    selected, so many workers can sweep at once. Claimed records are
+    transitioned with `set(*args, **kwargs)`, records it raises
+    `FSMException` for are counted as rejected, other errors propagate.
+    (`FOR UPDATE SKIP LOCKED` is used on the databases that support it
+    to reduce the contention.) Each batch is committed.
+    """
+    meta = transition._sa_fsm_meta
+    if meta.after is None:
+        raise exc.SetupError(
+            '{!r} is not a time-based transition'.format(transition))
+    model = transition._sa_fsm_owner_cls
+    name = transition._sa_fsm_name
+    mapper = sqla_inspect(model)
+    pk_column = util.get_single_pk_column(mapper)
+    state_column = COLUMN_CACHE.getValue(model)
+    time_column = get_timestamp_column(model)
+    state_key = mapper.get_property_by_column(state_column).key
+    time_key = mapper.get_property_by_column(time_column).key
+    kwargs = dict(kwargs or {})
+
+    prefetch = get_prefetch_options(transition)
+
+    if now is None:
+        now = utcnow()
+    sources = set()
+    for handler_meta in get_handler_metas(
+        meta, transition._sa_fsm_transition_fn
+    ):
+        sources.update(handler_meta.sources)
+
+    params = dict(sa_fsm_cutoff=now - meta.after, sa_fsm_limit=batch_size)
+    key = (pk_column, state_column, time_column, frozenset(sources))
+    first_query = SweepQueryCache.getValue(key + (False, ))
+    next_query = SweepQueryCache.getValue(key + (True, ))
+
+    result = SweepResult()
+    last_seen = None
+    while max_batches is None or result.batches < max_batches:
+        if last_seen is None:
+            batch_query = first_query
+        else:
+            batch_query = next_query
+            params.update(sa_fsm_last_pk=last_seen[0],
+                          sa_fsm_last_time=last_seen[1])
+        batch = statements.execute(
+            session, batch_query, params, model).fetchall()
+        if not batch:
+            break
+        if prefetch:
+            # Not used directly: the identity map only holds weak
+            #   references, this list keeps the prefetched records
+            #   (and relationships) alive for the loop below
+            loaded = session.query(model).filter(
+                pk_column.in_([row[0] for row in batch])
+            ).options(*prefetch).all()
+        for (pk, old_state, old_time) in batch:
+            _sweep_record(
+                session, model, name, result, pk, pk_column,
+                (state_column, state_key, old_state),
+                (time_column, time_key, old_time),
+                args, kwargs
+            )
+        session.commit()
+        result.batches += 1
+        last_seen = (batch[-1][0], batch[-1][2])
+    return result
+
+
+def _sweep_record(
+    session, model, name, result, pk, pk_column, state, time, args, kwargs
+):
+    (state_column, state_key, old_state) = state
+    (time_column, time_key, old_time) = time
+    # Claimed before `set()`, so that neither handlers nor state change
+    #   listeners run for the records other workers have moved on
+    claim = ClaimUpdateCache.getValue((pk_column, state_column, time_column))
+    claimed = statements.execute(session, claim, dict(
+        sa_fsm_pk=pk, sa_fsm_state=old_state, sa_fsm_time=old_time,
+    ), model).rowcount
+    if not claimed:
+        result.conflicts += 1
+        return
+
+    record = session.query(model).get(pk)
+    if record is None or (
+        getattr(record, state_key), getattr(record, time_key)
+    ) != (old_state, old_time):
+        result.conflicts += 1
+        return
+
+    try:
+        getattr(record, name).set(*args, **kwargs)
+    except exc.FSMException:
+        result.rejected += 1
+        session.expunge(record)
+        return
+    result.applied += 1
@@ -0,0 +1,64 @@
+"""Storage of the FSM state in a narrow side table.
+
+Every state change of a model with a wide row rewrites the whole row
+(and creates a dead copy of it on MVCC databases). Moving the state
+into its own `(primary key, state)` table keeps the state churn
+on small rows:
+
+    order_table = Table('order', Base.metadata, ...)
+
+    class Order(Base):
+        __table__ = side_table.join(order_table)
+        id = side_table.pk_property(__table__)
+
+The model is mapped to the join of both tables, so `record.state`,
+`Order.published()` filters and `set()` work as usual. The flush only
+UPDATEs the tables which columns have changed.
+"""
+
+import sqlalchemy
+
+from sqlalchemy.orm import column_property
+
+from .sqltypes import FSMField
+from .util import get_single_table_pk
+
+
+def state_table(parent_table, column_name='state', name=None, **column_kw):
+    """Return a narrow table storing the FSM state of `parent_table` rows.
+
+    It is named `<parent table>_<column_name>` by default and is keyed
+    by the parent's primary key (its rows are deleted with the parent's).
+    `column_kw` are passed to the `FSMField` column.
+    """
+    parent_pk = get_single_table_pk(parent_table)
+    if name is None:
+        name = '{}_{}'.format(parent_table.name, column_name)
+    return sqlalchemy.Table(
+        name, parent_table.metadata,
+        sqlalchemy.Column(
+            parent_pk.name, parent_pk.type,
+            sqlalchemy.ForeignKey(parent_pk, ondelete='CASCADE'),
+            primary_key=True, autoincrement=False,
+        ),
+        sqlalchemy.Column(column_name, FSMField, **column_kw),
+    )
+
+
+def join(parent_table, column_name='state', name=None, **column_kw):
+    """Return join of `parent_table` & its new `state_table()`,
+    to be used as model's `__table__`."""
+    return sqlalchemy.join(
+        parent_table,
+        state_table(parent_table, column_name, name, **column_kw)
+    )
+
+
+def pk_property(selectable):
+    """Return property mapping primary keys of both `join()` tables
+    to one attribute (that has to be named as the parent's primary key).
+    """
+    return column_property(
+        get_single_table_pk(selectable.left),
+        get_single_table_pk(selectable.right),
+    )
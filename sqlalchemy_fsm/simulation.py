@@ -0,0 +1,199 @@
+"""Offline replay of recorded transitions through a model's FSM.
+
+    machine = simulation.Machine(Order)
+    report = machine.replay(events, initial='new')
+    report.rejections  # {(transition name, source state): count}
+    report.distribution()  # {state: number of entities}
+
+`Machine` compiles the model's `@transition` graph (function and class
+transitions, `<state>.*` patterns) or a data-driven definition
+(`Machine.from_definition(registry.get(key))`) into lists indexed by
+int state codes, so `replay()` of (entity, transition name)
+events costs a couple of dict & list lookups per event and no ORM
+instrumentation.
+
+Conditions are not evaluated (they need the records), transitions are
+replayed as if their conditions were met. Source states matched by more
+than one handler of a transition class are rejected, like `set()` with
+the conditions of several handlers met.
+"""
+
+import collections
+
+from .states import is_pattern
+from .transition import get_handler_metas, iter_transitions
+
+
+class Machine(object):
+    """Transition tables of the `model` over its states (and the extra
+    `states` the recorded entities can be in).
+
+    `Machine.from_definition()` compiles a data-driven definition.
+    """
+
+    def __init__(self, model, states=()):
+        self.model = model
+        self.compile(
+            [
+                (name, get_handler_metas(
+                    fsm_transition.meta, fsm_transition.set_fn))
+                for (name, fsm_transition) in iter_transitions(model)
+            ],
+            states
+        )
+
+    @classmethod
+    def from_definition(cls, compiled, states=()):
+        """Machine of a `definition.CompiledDefinition`
+        (e.g. `registry.get('retail')`)."""
+        out = cls.__new__(cls)
+        out.model = compiled
+        out.compile(
+            [
+                (name, get_handler_metas(meta, table))
+                for (name, (meta, table)) in compiled.transitions.items()
+            ],
+            set(states).union(compiled.states or ())
+        )
+        return out
+
+    def compile(self, transitions, states):
+        """Build the tables of the (name, handler metas) `transitions`."""
+        all_states = set(states)
+        for (_, metas) in transitions:
+            for meta in metas:
+                all_states.add(meta.target)
+                all_states.update(meta.sources)
+        # Code 0 is the None (initial) state
+        self.states = [None] + sorted(
+            state for state in all_states
+            if state not in ('*', None) and not is_pattern(state)
+        )
+        self.codes = dict(
+            (state, idx) for (idx, state) in enumerate(self.states))
+        # {transition name: [target code per source code]},
+        #   `~source` code if the transition is not possible
+        self.tables = {}
+        # Transitions with conditions (assumed to be met)
+        self.conditional = []
+        for (name, metas) in sorted(transitions, key=lambda item: item[0]):
+            self.tables[name] = [
+                self.get_target(metas, source)
+                for source in range(len(self.states))
+            ]
+            if any(meta.conditions for meta in metas):
+                self.conditional.append(name)
+
+    def get_target(self, metas, source):
+        state = self.states[source]
+        targets = [meta.target for meta in metas if meta.matches_source(state)]
+        if len(targets) != 1:
+            return ~source
+        return self.codes[targets[0]]
+
+    def get_code(self, state):
+        try:
+            return self.codes[state]
+        except KeyError:
+            raise NotImplementedError(
+                'Unknown state {!r}, pass it to Machine(states=...)'.format(
+                    state))
+
+    def step(self, state, name):
+        """State after the `name` transition from the `state`
+        (None if the transition is not possible)."""
+        target = self.tables[name][self.get_code(state)]
+        if target < 0:
+            return None
+        return self.states[target]
+
+    def replay(self, events, initial=None, current=None):
+        """Replay (entity, transition name) `events`.
+
+        Entities start in the `initial` state, unless they are in the
+        `current` {entity: state} mapping (e.g. `Report.final_states`
+        of the previous replay). Returns `Report`.
+        """
+        start = self.get_code(initial)
+        codes = {}
+        if current is not None:
+            codes.update(
+                (entity, self.get_code(state))
+                for (entity, state) in current.items()
+            )
+        tables = self.tables
+        # {transition name: [rejected count per source code]}
+        rejected = dict(
+            (name, [0] * len(self.states)) for name in tables)
+        get_code = codes.get
+        count = 0
+        try:
+            for (count, (entity, name)) in enumerate(events, 1):
+                target = tables[name][get_code(entity, start)]
+                if target < 0:
+                    # Stays in the source state
+                    target = ~target
+                    rejected[name][target] += 1
+                codes[entity] = target
+        except KeyError:
+            if name in tables:
+                raise
+            raise NotImplementedError(
+                '{!r} has no {!r} transition'.format(self.model, name))
+        return Report(self, codes, rejected, count)
+
+    def __repr__(self):
+        return "<{} {!r} states={} transitions={}>".format(
+            self.__class__.__name__, self.model,
+            len(self.states), len(self.tables)
+        )
+
+
+class Report(object):
+    """Outcome of a `Machine.replay()`."""
+
+    __slots__ = ("machine", "codes", "rejected", "events")
+
+    def __init__(self, machine, codes, rejected, events):
+        self.machine = machine
+        # {entity: state code} of the replayed (and `current`) entities
+        self.codes = codes
+        # {transition name: [rejected count per source code]}
+        self.rejected = rejected
+        self.events = events
+
+    @property
+    def final_states(self):
+        """{entity: state} of the replayed (and `current`) entities."""
+        states = self.machine.states
+        return dict(
+            (entity, states[code]) for (entity, code) in self.codes.items())
+
+    @property
+    def rejections(self):
+        """{(transition name, source state): count} of rejected events."""
+        states = self.machine.states
+        return dict(
+            ((name, states[source]), count)
+            for (name, counts) in self.rejected.items()
+            for (source, count) in enumerate(counts) if count
+        )
+
+    @property
+    def rejected_count(self):
+        return sum(sum(counts) for counts in self.rejected.values())
+
+    def distribution(self):
+        """{state: number of entities in it} of the final states."""
+        states = self.machine.states
+        return dict(
+            (states[code], count)
+            for (code, count) in collections.Counter(
+                self.codes.values()).items()
+        )
+
+    def __repr__(self):
+        return "<{} events={} rejected={} entities={}>".format(
+            self.__class__.__name__, self.events,
+            self.rejected_count, len(self.codes)
+        )
@@ -5,3 +5,11 @@ from sqlalchemy import types, events
 
 class FSMField(types.String):
     pass
+
+
+class FSMTimestamp(types.DateTime):
+    """Time of the last state change (naive UTC).
+
+    Maintained automatically whenever the FSMField of the same model
+    changes its value. See `sqlalchemy_fsm.scheduled`.
+    """
@@ -0,0 +1,101 @@
+"""Compiled-statement cache of the SQL issued by sqlalchemy-fsm.
+
+SQLAlchemy compiles a statement every time it is executed, unless the
+connection has a `compiled_cache` - and that is keyed by the statement
+object. So the statements the library issues (compare-and-swap updates,
+history inserts, change feed reads, ...) are built once, with bind
+parameters for the values, and executed with `execute()` that uses the
+bounded LRU `CompiledCache` below.
+
+    statements.get_compiled_cache()  # <CompiledCache size=12/1000 ...>
+    statements.set_compiled_cache(statements.CompiledCache(10000))
+"""
+
+import collections
+import threading
+
+from sqlalchemy.orm import Session
+
+
+DEFAULT_MAX_SIZE = 1000
+
+
+class CompiledCache(object):
+    """Thread-safe LRU mapping of the compiled statements
+    (used as the `compiled_cache` execution option)."""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        if max_size < 1:
+            raise NotImplementedError(
+                'Cache size must be positive, got {!r}'.format(max_size))
+        self.max_size = max_size
+        # Most recently used last
+        self.compiled = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                out = self.compiled.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.compiled[key] = out
+            self.hits += 1
+            return out
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.compiled.pop(key, None)
+            self.compiled[key] = value
+            while len(self.compiled) > self.max_size:
+                self.compiled.popitem(last=False)
+
+    def __len__(self):
+        return len(self.compiled)
+
+    def clear(self):
+        with self.lock:
+            self.compiled.clear()
+            self.hits = self.misses = 0
+
+    def __repr__(self):
+        return "<{} size={}/{} hits={} misses={}>".format(
+            self.__class__.__name__, len(self), self.max_size,
+            self.hits, self.misses
+        )
+
+
+_CACHE = CompiledCache()
+
+
+def get_compiled_cache():
+    return _CACHE
+
+
+def set_compiled_cache(compiled_cache):
+    """Set the cache of the FSM statements (None disables caching).
+
+    Returns the old cache.
+    """
+    global _CACHE
+    (out, _CACHE) = (_CACHE, compiled_cache)
+    return out
+
+
+def execute(bind, statement, params=None, mapper=None):
+    """Execute the `statement` on the `bind` (a session or connection)
+    using the compiled cache.
+
+    `params` is a dict (or a list of dicts for executemany),
+    `mapper` selects the session's bind like in `Session.execute()`.
+    """
+    if isinstance(bind, Session):
+        bind = bind.connection(mapper=mapper, clause=statement)
+    if _CACHE is not None:
+        bind = bind.execution_options(compiled_cache=_CACHE)
+    if params is None:
+        return bind.execute(statement)
+    return bind.execute(statement, params)
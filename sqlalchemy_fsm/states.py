@@ -0,0 +1,101 @@
+"""Hierarchical state names.
+
+States can have dot-separated sub-states (e.g. `shipped.partial`).
+`shipped.*` source pattern matches all the descendants of `shipped`.
+
+Any non-empty string is a valid state name, only the hierarchy features
+(patterns & `in_state()`) need names with no empty or `*` segments.
+"""
+
+import sqlalchemy
+
+from six import string_types
+
+from . import cache
+
+
+SEPARATOR = '.'
+# Sorts right after the separator, so `[state + '.', state + '/')`
+#   is the key range of all the descendants of the state.
+SEPARATOR_UPPER_BOUND = chr(ord(SEPARATOR) + 1)
+PATTERN_SUFFIX = SEPARATOR + '*'
+
+
+def is_valid_name(value):
+    """Non-empty string with no empty or wildcard path segments
+    (a state the hierarchy features work with)."""
+    return isinstance(value, string_types) and all(
+        segment and segment != '*' for segment in value.split(SEPARATOR)
+    )
+
+
+def is_pattern(value):
+    """Is it `<state>.*` (all descendants of the state) pattern."""
+    return isinstance(value, string_types) and \
+        value.endswith(PATTERN_SUFFIX) and \
+        is_valid_name(value[:-len(PATTERN_SUFFIX)])
+
+
+def get_pattern_parent(pattern):
+    return pattern[:-len(PATTERN_SUFFIX)]
+
+
+def get_pattern_parents(state_set):
+    """Frozen set of parents of the `<state>.*` patterns in `state_set`."""
+    return frozenset(
+        get_pattern_parent(state)
+        for state in state_set if is_pattern(state)
+    )
+
+
+@cache.dictCache
+def AncestorsCache(state):
+    """Frozen set of the proper ancestors of the state.
+
+    'a.b.c' -> {'a', 'a.b'}
+    """
+    segments = state.split(SEPARATOR)
+    return frozenset(
+        SEPARATOR.join(segments[:idx]) for idx in range(1, len(segments))
+    )
+
+
+def get_ancestors(state):
+    if not isinstance(state, string_types):
+        return frozenset()
+    return AncestorsCache.getValue(state)
+
+
+def is_in_state(state, parent):
+    """Is `state` the `parent` itself or one of its descendants."""
+    return state == parent or parent in get_ancestors(state)
+
+
+def matches_patterns(state, pattern_parents):
+    """Is `state` a descendant of any of the `pattern_parents`."""
+    return not pattern_parents.isdisjoint(get_ancestors(state))
+
+
+def source_covered(source, sources, pattern_parents):
+    """Is `source` state (or pattern) matched by `sources`."""
+    if '*' in sources or source in sources:
+        return True
+    if is_pattern(source):
+        source = get_pattern_parent(source)
+        if source in pattern_parents:
+            return True
+    return matches_patterns(source, pattern_parents)
+
+
+def sql_descendants_filter(column, state):
+    """Index range scan over all descendants of the `state`."""
+    return sqlalchemy.and_(
+        column >= state + SEPARATOR,
+        column < state + SEPARATOR_UPPER_BOUND,
+    )
+
+
+def sql_in_state_filter(column, state):
+    """SQL filter matching the `state` and all its descendants."""
+    return sqlalchemy.or_(
+        column == state, sql_descendants_filter(column, state))
@@ -0,0 +1,251 @@
+"""Memory-bounded transition runners over large queries
+& the change feed of the transition history."""
+
+import collections
+import datetime
+
+import sqlalchemy
+
+from six import string_types
+from sqlalchemy import inspect as sqla_inspect
+
+from . import cache, statements, util, states as fsm_states
+from .history import get_history, get_model_name
+from .transition import get_prefetch_options, sql_source_filter
+
+
+class StreamProgress(object):
+    """Progress report of the streaming `apply()`."""
+
+    __slots__ = ("processed", "succeeded", "failures", "chunks", "last_pk")
+
+    def __init__(self):
+        self.processed = 0
+        self.succeeded = 0
+        self.chunks = 0
+        # Primary key of the last processed record.
+        #   Can be passed as `start_after` to resume an interrupted run.
+        self.last_pk = None
+        # List of (primary key, exception) tuples
+        self.failures = []
+
+    def __repr__(self):
+        return "<{} processed={} succeeded={} failures={} " \
+            "last_pk={!r}>".format(
+                self.__class__.__name__, self.processed, self.succeeded,
+                len(self.failures), self.last_pk
+            )
+
+
+def apply(
+    session, query, transition, args=(), kwargs=None,
+    chunk_size=1000, start_after=None, on_progress=None
+):
+    """Apply `transition` to every record matched by `query`.
+
+    `transition` is the class-bound transition (e.g. `Model.archived`),
+    `args` and `kwargs` are passed to its `set()` call.
+
+    Records are loaded in primary key chunks (keyset pagination),
+    each chunk is flushed, committed and expunged from the session
+    before the next one is loaded, so the memory use does not depend
+    on the size of the query. Relationships the transition declares
+    in `prefetch` are loaded once per chunk.
+
+    Records the transition fails for are expunged without flushing their
+    changes and are reported in `failures` of the returned progress object.
+    `on_progress(progress)` is called after every committed chunk.
+    """
+    model = transition._sa_fsm_owner_cls
+    name = transition._sa_fsm_name
+    mapper = sqla_inspect(model)
+    pk_column = util.get_single_pk_column(mapper)
+    pk_key = mapper.get_property_by_column(pk_column).key
+    kwargs = dict(kwargs or {})
+
+    prefetch = get_prefetch_options(transition)
+
+    progress = StreamProgress()
+    for pks in util.iter_pk_chunks(
+        query, pk_column, chunk_size, start_after=start_after
+    ):
+        records = query.filter(pk_column.in_(pks)).options(*prefetch).all()
+        for record in records:
+            progress.processed += 1
+            try:
+                getattr(record, name).set(*args, **kwargs)
+            except Exception as err:
+                progress.failures.append((getattr(record, pk_key), err))
+                session.expunge(record)
+            else:
+                progress.succeeded += 1
+
+        session.commit()
+        for record in records:
+            if record in session:
+                session.expunge(record)
+
+        progress.chunks += 1
+        progress.last_pk = pks[-1]
+        if on_progress is not None:
+            on_progress(progress)
+    return progress
+
+
+DEFAULT_CURSOR_TABLE_NAME = 'fsm_stream_cursor'
+
+# State change read from the history (`id` is the history row id)
+Change = collections.namedtuple(
+    'Change', ('pk', 'source', 'target', 'ts', 'id'))
+
+
+@cache.dictCache
+def TailQueryCache(key):
+    """Next batch of a model's changes (after a position).
+
+    Keyed by the `<state>.*` patterns only, the batch size and the
+    state names are bind parameters (so the callers can't grow the cache).
+    """
+    (table, patterns, by_name) = key
+    criteria = [
+        table.c.model == sqlalchemy.bindparam('sa_fsm_model'),
+        table.c.id > sqlalchemy.bindparam('sa_fsm_position'),
+    ]
+    if patterns is not None:
+        clauses = []
+        if by_name:
+            clauses.append(table.c.target.in_(
+                sqlalchemy.bindparam('sa_fsm_states', expanding=True)))
+        if patterns:
+            clauses.append(sql_source_filter(table.c.target, patterns))
+        criteria.append(sqlalchemy.or_(*clauses or [sqlalchemy.false()]))
+    return sqlalchemy.select([
+        table.c.record_id, table.c.source, table.c.target,
+        table.c.created_at, table.c.id,
+    ]).where(sqlalchemy.and_(*criteria)).order_by(
+        table.c.id).limit(sqlalchemy.bindparam('sa_fsm_limit'))
+
+
+def tail(session, model, since=0, states=None, batch_size=1000):
+    """Yields lists of the `Change`s of the `model`'s records made after
+    `since` (a history id or a `Cursor`), in the history order.
+
+    `states` limits the changes to the ones into these target states
+    (a state, or a list of states or `<state>.*` patterns). The history
+    is read with keyset pagination over the history id, the iteration
+    stops once it has caught up.
+
+    The cursor is not moved by `tail()`: a consumer acknowledges each
+    processed batch with `cursor.ack(session, batch)` before committing
+    its session, so it sees every change at least once.
+    Changes of the transactions that commit out of their history id
+    order can be skipped by a concurrent `tail()`.
+    """
+    params = dict(
+        sa_fsm_model=get_model_name(model), sa_fsm_limit=batch_size)
+    if isinstance(states, string_types):
+        # Single state (like `source` of the transitions)
+        states = (states, )
+    if states is None or '*' in states:
+        patterns = None
+    else:
+        names = sorted(
+            state for state in states if not fsm_states.is_pattern(state))
+        patterns = frozenset(states).difference(names)
+        if names:
+            params['sa_fsm_states'] = names
+    query = TailQueryCache.getValue((
+        get_history(model).table, patterns, 'sa_fsm_states' in params))
+
+    if isinstance(since, Cursor):
+        position = since.position
+    else:
+        position = since
+    while True:
+        params['sa_fsm_position'] = position
+        batch = [
+            Change(*row)
+            for row in statements.execute(session, query, params)
+        ]
+        if not batch:
+            break
+        yield batch
+        position = batch[-1].id
+        if len(batch) < batch_size:
+            break
+
+
+class Cursor(object):
+    """Position of a named consumer in the `model`'s change feed."""
+
+    __slots__ = ("store", "name", "model", "position")
+
+    def __init__(self, store, name, model, position=0):
+        self.store = store
+        self.name = name
+        self.model = model
+        self.position = position
+
+    def save(self, session, position):
+        """Move the cursor to the `position` (written to the session)."""
+        self.position = position
+        self.store.save(session, self)
+
+    def ack(self, session, batch):
+        """Move the cursor past the processed `tail()` batch."""
+        self.save(session, batch[-1].id)
+
+    def __repr__(self):
+        return "<{} {!r} {!r} position={}>".format(
+            self.__class__.__name__, self.name,
+            get_model_name(self.model), self.position
+        )
+
+
+def cursor_table(metadata, name=DEFAULT_CURSOR_TABLE_NAME):
+    """Return table of the (consumer, model) cursor positions."""
+    return sqlalchemy.Table(
+        name, metadata,
+        sqlalchemy.Column(
+            'consumer', sqlalchemy.String(255), primary_key=True),
+        sqlalchemy.Column('model', sqlalchemy.String(255), primary_key=True),
+        sqlalchemy.Column('position', sqlalchemy.BigInteger, nullable=False),
+        sqlalchemy.Column('updated_at', sqlalchemy.DateTime),
+    )
+
+
+class CursorStore(object):
+    """Table of the consumer cursors."""
+
+    def __init__(self, metadata, name=DEFAULT_CURSOR_TABLE_NAME):
+        table = self.table = cursor_table(metadata, name)
+        key = sqlalchemy.and_(
+            table.c.consumer == sqlalchemy.bindparam('sa_fsm_consumer'),
+            table.c.model == sqlalchemy.bindparam('sa_fsm_model'),
+        )
+        self.select = sqlalchemy.select([table.c.position]).where(key)
+        self.update = table.update().where(key)
+        self.insert = table.insert()
+
+    def load(self, session, name, model):
+        """Return cursor of the `name` consumer (at 0 if it is new)."""
+        out = Cursor(self, name, model)
+        position = statements.execute(session, self.select, dict(
+            sa_fsm_consumer=name, sa_fsm_model=get_model_name(model),
+        )).scalar()
+        if position is not None:
+            out.position = position
+        return out
+
+    def save(self, session, cursor):
+        values = dict(
+            position=cursor.position,
+            updated_at=datetime.datetime.utcnow(),
+        )
+        (consumer, model) = (cursor.name, get_model_name(cursor.model))
+        updated = statements.execute(session, self.update, dict(
+            values, sa_fsm_consumer=consumer, sa_fsm_model=model,
+        )).rowcount
+        if not updated:
+            statements.execute(session, self.insert, dict(
+                values, consumer=consumer, model=model))
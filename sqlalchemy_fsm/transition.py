@@ -4,10 +4,14 @@ import inspect as py_inspect
 
 from functools import wraps
 
+import sqlalchemy
+
 from sqlalchemy.orm.interfaces import InspectionAttrInfo
-from sqlalchemy.ext.hybrid import HYBRID_METHOD
+from sqlalchemy.ext.hybrid import HYBRID_METHOD, hybrid_method
+
+from sqlalchemy.orm import selectinload as prefetch_loader
 
-from . import bound, util, exc, cache
+from . import bound, util, exc, cache, conditions, states, idempotency
 from .meta import FSMMeta
 
 
@@ -22,6 +26,67 @@ def SqlEqualityCache(key):
     return column == target
 
 
+@cache.dictCache
+def SqlIsCache(key):
+    """Cached `(column == target).is_(value)` expressions."""
+    (column, target, value) = key
+    return SqlEqualityCache.getValue((column, target)).is_(value)
+
+
+@cache.dictCache
+def TransitionNameCache(key):
+    """Name of the attribute `owner` exposes the transition under.
+
+    Transitions are looked up by their meta, so aliased handlers
+    (`published = PublishHandler`) resolve to the alias name.
+    """
+    (owner, meta) = key
+    for cls in py_inspect.getmro(owner):
+        for (name, value) in vars(cls).items():
+            if isinstance(value, FsmTransition) and value.meta is meta:
+                return name
+    raise exc.SetupError(
+        'Transition {!r} is not defined on {!r}'.format(meta, owner))
+
+
+@cache.dictCache
+def SqlInStateCache(key):
+    (column, state) = key
+    return states.sql_in_state_filter(column, state)
+
+
+def sql_source_filter(column, sources):
+    """SQL filter matching records in any of the `sources` states."""
+    if '*' in sources:
+        return sqlalchemy.true()
+    clauses = []
+    names = sorted(
+        state for state in sources
+        if state is not None and not states.is_pattern(state)
+    )
+    if names:
+        clauses.append(column.in_(names))
+    for pattern in sorted(
+        state for state in sources if states.is_pattern(state)
+    ):
+        clauses.append(states.sql_descendants_filter(
+            column, states.get_pattern_parent(pattern)))
+    if None in sources:
+        clauses.append(column.is_(None))
+    return sqlalchemy.or_(*clauses)
+
+
+def sql_meta_filter(meta, column, model, args, kwargs):
+    """SQL filter matching records the `meta` allows transition for."""
+    return sqlalchemy.and_(
+        sql_source_filter(column, meta.sources),
+        *[
+            conditions.get_sql(condition, model, args, kwargs)
+            for condition in meta.conditions
+        ]
+    )
+
+
 class ClassBoundFsmTransition(object):
 
     __slots__ = (
@@ -41,9 +106,42 @@ class ClassBoundFsmTransition(object):
         target = self._sa_fsm_meta.target
         return SqlEqualityCache.getValue((column, target))
 
+    @property
+    def _sa_fsm_name(self):
+        """Attribute name of this transition on the owner class."""
+        return TransitionNameCache.getValue(
+            (self._sa_fsm_owner_cls, self._sa_fsm_meta))
+
+    def applicable(self, *args, **kwargs):
+        """Return a SQLAlchemy filter for records this transition can be
+        applied to (with `set(*args, **kwargs)`).
+
+        All the conditions of the transition must be hybrid ones.
+        """
+        column = self._sa_fsm_sqla_handle.fsm_column
+        model = self._sa_fsm_owner_cls
+        return sqlalchemy.or_(*[
+            sql_meta_filter(meta, column, model, args, kwargs)
+            for meta in get_handler_metas(
+                self._sa_fsm_meta, self._sa_fsm_transition_fn)
+        ])
+
+    def condition_orders(self):
+        """Return adaptive `ConditionOrder`s of the transition's handlers.
+
+        (Empty unless the transition is declared with `adaptive=True`.)
+        """
+        bound_meta = self._sa_fsm_meta.get_bound(
+            self._sa_fsm_sqla_handle, self._sa_fsm_transition_fn, ())
+        return bound_meta.get_condition_orders()
+
     def is_(self, value):
         if isinstance(value, bool):
-            out = self().is_(value)
+            out = SqlIsCache.getValue((
+                self._sa_fsm_sqla_handle.fsm_column,
+                self._sa_fsm_meta.target,
+                value
+            ))
         else:
             warnings.warn("Unexpected is_ argument: {!r}".format(value))
             # Can be used as sqlalchemy filer. Won't match anything
@@ -57,39 +155,120 @@ class InstanceBoundFsmTransition(object):
         "_sa_fsm_self", "_sa_fsm_bound_meta",
     )
 
-    def __init__(self, meta, sqla_handle, transition_fn, ownerCls, instance):
+    def __init__(self, meta, bound_meta, transition_fn, ownerCls, instance):
         self._sa_fsm_meta = meta
         self._sa_fsm_transition_fn = transition_fn
         self._sa_fsm_owner_cls = ownerCls
         self._sa_fsm_self = instance
-        self._sa_fsm_bound_meta = meta.get_bound(
-            sqla_handle, transition_fn, ()
-        )
+        self._sa_fsm_bound_meta = bound_meta
 
     def __call__(self):
         """Check if this is the current state of the object."""
         bound_meta = self._sa_fsm_bound_meta
-        return bound_meta.target_state == bound_meta.current_state
+        return bound_meta.target_state == bound_meta.current_state(
+            self._sa_fsm_self)
 
     def set(self, *args, **kwargs):
-        """Transition the FSM to this new state."""
+        """Transition the FSM to this new state.
+
+        With `idempotency_key` the transition is only made once per key
+        (for this record), repeated calls return without checking
+        the state or calling the handler (see `idempotency`).
+        """
+        key = kwargs.pop('idempotency_key', None)
+        if key is None:
+            return self._sa_fsm_set(args, kwargs)
+
+        record = self._sa_fsm_self
+        name = '{}.{}'.format(
+            self._sa_fsm_owner_cls.__name__,
+            self._sa_fsm_transition_fn.__name__
+        )
+        if not idempotency.claim(record, key, name):
+            # Duplicate delivery
+            return None
+        try:
+            return self._sa_fsm_set(args, kwargs)
+        except Exception:
+            idempotency.release(record, key, name)
+            raise
+
+    def _sa_fsm_set(self, args, kwargs):
         bound_meta = self._sa_fsm_bound_meta
+        record = self._sa_fsm_self
         func = self._sa_fsm_transition_fn
 
-        if not bound_meta.transition_possible():
+        if not bound_meta.transition_possible(record):
             raise exc.InvalidSourceStateError(
                 'Unable to switch from {} using method {}'.format(
-                    bound_meta.current_state, func.__name__
+                    bound_meta.current_state(record), func.__name__
                 )
             )
-        if not bound_meta.conditions_met(args, kwargs):
+        if not bound_meta.conditions_met(record, args, kwargs):
             raise exc.PreconditionError("Preconditions are not satisfied.")
-        return bound_meta.to_next_state(args, kwargs)
+        return bound_meta.to_next_state(record, args, kwargs)
 
     def can_proceed(self, *args, **kwargs):
         bound_meta = self._sa_fsm_bound_meta
-        return bound_meta.transition_possible() and bound_meta.conditions_met(
-            args, kwargs)
+        record = self._sa_fsm_self
+        return bound_meta.transition_possible(record) and \
+            bound_meta.conditions_met(record, args, kwargs)
+
+
+def get_sqla_handle(owner):
+    try:
+        return owner._sa_fsm_sqlalchemy_handle
+    except AttributeError:
+        # Owner class is not bound to sqlalchemy handle object
+        return bound.get_sqla_handle(owner)
+
+
+@cache.dictCache
+def ClassBoundTransitionCache(key):
+    """Class-bound transitions are stateless, so they are shared.
+
+    Keyed by (descriptor, owner class) as subclasses (including
+    polymorphic ones) get their own handles.
+    """
+    (fsm_transition, owner) = key
+    return ClassBoundFsmTransition(
+        fsm_transition.meta, get_sqla_handle(owner),
+        fsm_transition.set_fn, owner
+    )
+
+
+@cache.dictCache
+def BoundMetaByOwnerCache(key):
+    """Bound meta used by the instance-bound transitions."""
+    (fsm_transition, owner) = key
+    return fsm_transition.meta.get_bound(
+        get_sqla_handle(owner), fsm_transition.set_fn, ())
+
+
+def sql_in_state(model, state):
+    """SQL filter matching `model` records that are in the `state`
+    or in any of its sub-states (index range scan friendly)."""
+    if not states.is_valid_name(state):
+        raise NotImplementedError(state)
+    return SqlInStateCache.getValue((get_sqla_handle(model).fsm_column, state))
+
+
+class InStateMixin(object):
+    """Adds `in_state(state)` to the model.
+
+    `record.in_state('shipped')` is True for `shipped` and all its
+    sub-states (e.g. `shipped.partial`), `Model.in_state('shipped')`
+    is the matching SQL filter.
+    """
+
+    @hybrid_method
+    def in_state(self, state):
+        column_name = get_sqla_handle(type(self)).column_name
+        return states.is_in_state(getattr(self, column_name), state)
+
+    @in_state.expression
+    def in_state(cls, state):
+        return sql_in_state(cls, state)
 
 
 class FsmTransition(InspectionAttrInfo):
@@ -103,31 +282,52 @@ class FsmTransition(InspectionAttrInfo):
         self.set_fn = set_function
 
     def __get__(self, instance, owner):
-        try:
-            sql_alchemy_handle = owner._sa_fsm_sqlalchemy_handle
-        except AttributeError:
-            # Owner class is not bound to sqlalchemy handle object
-            sql_alchemy_handle = bound.SqlAlchemyHandle(owner, instance)
-
         if instance is None:
-            return ClassBoundFsmTransition(
-                self.meta, sql_alchemy_handle, self.set_fn, owner)
-        else:
-            return InstanceBoundFsmTransition(
-                self.meta, sql_alchemy_handle, self.set_fn, owner, instance)
+            return ClassBoundTransitionCache.getValue((self, owner))
+
+        return InstanceBoundFsmTransition(
+            self.meta, BoundMetaByOwnerCache.getValue((self, owner)),
+            self.set_fn, owner, instance
+        )
+
+
+def transition(
+    source='*', target=None, conditions=(), after=None, adaptive=False,
+    prefetch=(), defer=False
+):
+    """Transition decorator.
+
+    `after` (a `timedelta`) makes the transition time-based:
+    `scheduled.sweep()` applies it to records that have been
+    in one of the source states for that long.
 
+    With `adaptive` the pure conditions are evaluated cheapest &
+    most selective first (see `conditions.ConditionOrder`).
 
-def transition(source='*', target=None, conditions=()):
+    `prefetch` lists relationships (dot-separated paths for the nested
+    ones) the conditions & handler use. The chunked runners (`batch`,
+    `stream`, `scheduled`) load them for the whole chunk at once.
+
+    With `defer` the state changes right away, but the handler runs
+    on the shared thread pool after the session commits
+    (see `deferred`). `set()` returns its future.
+    """
 
     def inner_transition(subject):
 
         if py_inspect.isfunction(subject):
             meta = FSMMeta(
-                source, target, conditions, (), bound.BoundFSMFunction)
+                source, target, conditions, (), bound.BoundFSMFunction,
+                after=after, adaptive=adaptive, prefetch=prefetch,
+                defer=defer
+            )
         elif py_inspect.isclass(subject):
             # Assume a class with multiple handles for various source states
             meta = FSMMeta(
-                source, target, conditions, (), bound.BoundFSMClass)
+                source, target, conditions, (), bound.BoundFSMClass,
+                after=after, adaptive=adaptive, prefetch=prefetch,
+                defer=defer
+            )
         else:
             raise NotImplementedError(
                 "Do not know how to {!r}".format(subject))
@@ -135,3 +335,87 @@ def transition(source='*', target=None, conditions=()):
         return FsmTransition(meta, subject)
 
     return inner_transition
+
+
+def get_handler_metas(meta, transition_fn):
+    """Return metas of the actual state handlers of a transition.
+
+    That is the transition's own meta for function transitions
+    and merged metas of all sub-handlers for transition classes
+    (and compiled definitions).
+    """
+    if isinstance(transition_fn, bound.HandlerTable):
+        return tuple(sub_meta for (sub_meta, set_fn) in transition_fn.handlers)
+    if not py_inspect.isclass(transition_fn):
+        return (meta, )
+    child_cls = bound.InheritedBoundClasses.getValue((transition_fn, meta))
+    return tuple(
+        sub_meta for (sub_meta, set_fn) in child_cls._sa_fsm_sqlalchemy_metas
+    )
+
+
+def get_prefetch_paths(transition):
+    """Relationship paths the class-bound `transition` declares."""
+    return util.unique(
+        path
+        for meta in get_handler_metas(
+            transition._sa_fsm_meta, transition._sa_fsm_transition_fn)
+        for path in meta.prefetch
+    )
+
+
+@cache.dictCache
+def PrefetchOptionsCache(key):
+    """`selectinload()` loader options for the relationship paths."""
+    (model, paths) = key
+    out = []
+    for path in paths:
+        mapper = sqlalchemy.inspect(model)
+        option = None
+        for name in path.split('.'):
+            prop = mapper.relationships.get(name)
+            if prop is None:
+                raise exc.SetupError(
+                    '{!r} is not a relationship of {!r} (in {!r})'.format(
+                        name, mapper.class_, path)
+                )
+            attr = getattr(mapper.class_, name)
+            if option is None:
+                option = prefetch_loader(attr)
+            else:
+                option = getattr(option, prefetch_loader.__name__)(attr)
+            mapper = prop.mapper
+        out.append(option)
+    return tuple(out)
+
+
+def get_prefetch_options(transition):
+    """Loader options prefetching relationships of the `transition`."""
+    return PrefetchOptionsCache.getValue((
+        transition._sa_fsm_owner_cls, get_prefetch_paths(transition)))
+
+
+def iter_transitions(model):
+    """Yields (name, FsmTransition) pairs of all transitions of the `model`."""
+    seen = set()
+    for cls in py_inspect.getmro(model):
+        for (name, value) in sorted(vars(cls).items()):
+            if name in seen:
+                # Overridden in a subclass
+                continue
+            seen.add(name)
+            if isinstance(value, FsmTransition):
+                yield (name, value)
+
+
+def get_model_states(model):
+    """Return set of all states the `model` transitions refer to."""
+    out = set()
+    for (name, fsm_transition) in iter_transitions(model):
+        for meta in get_handler_metas(
+            fsm_transition.meta, fsm_transition.set_fn
+        ):
+            out.add(meta.target)
+            out.update(meta.sources)
+    out.difference_update(('*', None))
+    return out
@@ -1,7 +1,10 @@
 """Utility functions and consts."""
+import sqlalchemy
+
 from six import string_types
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
 
-from . import exc
+from . import exc, statements
 
 
 def is_valid_fsm_state(value):
@@ -15,3 +18,85 @@ def is_valid_source_state(value):
         and `None` (as this is default  value for sqlalchemy colums)
     """
     return (value == '*') or (value is None) or is_valid_fsm_state(value)
+
+
+def is_valid_attribute_path(value):
+    """Dot-separated attribute names (e.g. `items.product`)."""
+    return isinstance(value, string_types) and all(value.split('.'))
+
+
+def unique(items):
+    """Tuple of the `items` without duplicates (in the original order)."""
+    seen = set()
+    out = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            out.append(item)
+    return tuple(out)
+
+
+def detached_copy(record):
+    """New record (in no session) with the column values loaded
+    in the `record`. Does not load anything."""
+    state = instance_state(record)
+    out = state.mapper.class_manager.new_instance()
+    for prop in state.mapper.column_attrs:
+        if prop.key in state.dict:
+            set_committed_value(out, prop.key, state.dict[prop.key])
+    return out
+
+
+def get_single_pk_column(mapper):
+    """Return the only primary key column of the `mapper`.
+
+    Chunked operations use keyset pagination that requires it.
+    """
+    return _single_pk_column(mapper.primary_key)
+
+
+def get_single_table_pk(table):
+    """Return the only primary key column of the `table`."""
+    return _single_pk_column(list(table.primary_key.columns))
+
+
+def _single_pk_column(pk_columns):
+    if len(pk_columns) != 1:
+        raise exc.SetupError(
+            'Single-column primary key expected, got {!r}'.format(
+                pk_columns
+            )
+        )
+    return pk_columns[0]
+
+
+def iter_pk_chunks(query, pk_column, chunk_size, start_after=None):
+    """Yields lists of primary keys matched by `query`.
+
+    Uses keyset pagination (`pk > last_seen ORDER BY pk LIMIT n`),
+    so every chunk is an index range scan no matter how deep
+    into the table it is.
+    """
+    session = query.session
+    pk_query = query.with_entities(pk_column).order_by(None)
+    limit = sqlalchemy.bindparam('sa_fsm_limit')
+    # Built once, so that the chunks reuse the compiled statements
+    first_query = pk_query.order_by(pk_column).limit(limit).statement
+    next_query = pk_query.filter(
+        pk_column > sqlalchemy.bindparam('sa_fsm_last_pk')
+    ).order_by(pk_column).limit(limit).statement
+    params = dict(sa_fsm_limit=chunk_size)
+    last_pk = start_after
+    while True:
+        if session.autoflush:
+            session.flush()
+        if last_pk is None:
+            chunk = statements.execute(session, first_query, params)
+        else:
+            params['sa_fsm_last_pk'] = last_pk
+            chunk = statements.execute(session, next_query, params)
+        chunk = [row[0] for row in chunk]
+        if not chunk:
+            break
+        yield chunk
+        last_pk = chunk[-1]
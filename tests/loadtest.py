@@ -0,0 +1,399 @@
+"""Load-test harness: concurrent workers racing on transitions of a table.
+
+    python -m tests.loadtest --url sqlite:////tmp/fsm-load.db \\
+        --workers 8 --mode process --operations 2000
+
+Every worker (a thread or a process with its own engine) runs
+a random mix of the operations on the shared table:
+
+ * `set` - load a random record, apply one of its possible transitions
+   with `set()` and commit (transitions to the current state are
+   rolled back as no-ops);
+ * `claim` - compare-and-swap UPDATE of a random record from its
+   observed state to the target of a matching transition;
+ * `query` - count records in the target state of a transition.
+
+Every successful state write is logged (in the same database transaction)
+to `fsm_loadtest_log` table. Writes based on a state that another worker
+has overwritten in the meantime show up as breaks of the per-record
+`source -> target` chains and are reported as lost updates. (Log order
+is the commit order on SQLite. On the databases that allow concurrent
+writers it is only approximately so.)
+
+The FSM shape is the model (`--model module:Class`, `Benchmarked` by
+default) and the transitions of it that are used (`--transitions`).
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+from timeit import default_timer
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import sqlalchemy
+
+from sqlalchemy import inspect as sqla_inspect
+from sqlalchemy.orm import sessionmaker
+
+from sqlalchemy_fsm import FSMField, util
+from sqlalchemy_fsm.batch import TransitionRef
+from sqlalchemy_fsm.bound import COLUMN_CACHE
+from sqlalchemy_fsm.transition import get_handler_metas, iter_transitions
+
+
+DEFAULT_MODEL = 'tests.test_performance:Benchmarked'
+OPERATIONS = ('set', 'claim', 'query')
+
+LOG_METADATA = sqlalchemy.MetaData()
+
+log_table = sqlalchemy.Table(
+    'fsm_loadtest_log', LOG_METADATA,
+    sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('record_id', sqlalchemy.Integer, index=True),
+    sqlalchemy.Column('worker', sqlalchemy.Integer),
+    sqlalchemy.Column('source', FSMField),
+    sqlalchemy.Column('target', FSMField),
+)
+
+
+class OperationStats(object):
+    """Latencies & outcomes of one operation kind."""
+
+    __slots__ = ("latencies", "outcomes", "retries")
+
+    def __init__(self):
+        self.latencies = []
+        # {'ok' | 'conflict' | 'noop' | 'failed': count}
+        self.outcomes = {}
+        self.retries = 0
+
+    def add(self, latency, outcome):
+        self.latencies.append(latency)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        for (outcome, count) in other.outcomes.items():
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+        self.retries += other.retries
+
+    @property
+    def count(self):
+        return len(self.latencies)
+
+    def percentile(self, fraction):
+        """Nearest-rank percentile of the latencies."""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        idx = max(int(round(fraction * len(ordered))) - 1, 0)
+        return ordered[min(idx, len(ordered) - 1)]
+
+
+class Worker(object):
+    """State of one load-test worker."""
+
+    def __init__(self, worker_id, config):
+        self.worker_id = worker_id
+        self.config = config
+        self.random = random.Random(config['seed'] + worker_id)
+        self.engine = sqlalchemy.create_engine(config['url'])
+        self.session = sessionmaker(bind=self.engine)()
+        self.model = TransitionRef(config['model'], None).model
+        mapper = sqla_inspect(self.model)
+        self.pk_column = util.get_single_pk_column(mapper)
+        self.state_column = COLUMN_CACHE.getValue(self.model)
+        self.state_key = mapper.get_property_by_column(self.state_column).key
+        self.transitions = [
+            getattr(self.model, name) for name in config['transitions']
+        ]
+        # (source meta, target) pairs of all the handlers, for the claims
+        self.claims = [
+            (meta, meta.target or transition._sa_fsm_meta.target)
+            for transition in self.transitions
+            for meta in get_handler_metas(
+                transition._sa_fsm_meta, transition._sa_fsm_transition_fn)
+        ]
+        self.operations = [
+            name
+            for (name, weight) in sorted(config['mix'].items())
+            for _ in range(weight)
+        ]
+
+    def log_write(self, pk, source, target):
+        self.session.execute(log_table.insert().values(
+            record_id=pk, worker=self.worker_id,
+            source=source, target=target,
+        ))
+
+    def op_set(self):
+        pk = self.random.choice(self.config['pks'])
+        record = self.session.query(self.model).get(pk)
+        possible = [
+            transition._sa_fsm_name for transition in self.transitions
+            if getattr(record, transition._sa_fsm_name).can_proceed()
+        ]
+        if not possible:
+            self.session.rollback()
+            return 'noop'
+        source = getattr(record, self.state_key)
+        getattr(record, self.random.choice(possible)).set()
+        target = getattr(record, self.state_key)
+        if target == source:
+            # No UPDATE is flushed, so the log write would not be
+            #   serialised with the concurrent state writes
+            self.session.rollback()
+            return 'noop'
+        self.log_write(pk, source, target)
+        self.session.commit()
+        return 'ok'
+
+    def op_claim(self):
+        pk = self.random.choice(self.config['pks'])
+        source = self.session.execute(
+            sqlalchemy.select([self.state_column]).where(
+                self.pk_column == pk)
+        ).scalar()
+        targets = [
+            target for (meta, target) in self.claims
+            if meta.matches_source(source)
+        ]
+        if not targets:
+            self.session.rollback()
+            return 'noop'
+        target = self.random.choice(targets)
+        updated = self.session.query(self.model).filter(
+            self.pk_column == pk, self.state_column == source,
+        ).update({self.state_key: target}, synchronize_session=False)
+        if not updated:
+            self.session.rollback()
+            return 'conflict'
+        self.log_write(pk, source, target)
+        self.session.commit()
+        return 'ok'
+
+    def op_query(self):
+        transition = self.random.choice(self.transitions)
+        self.session.query(self.model).filter(transition()).count()
+        self.session.commit()
+        return 'ok'
+
+    def run(self):
+        stats = dict((name, OperationStats()) for name in OPERATIONS)
+        try:
+            for _ in range(self.config['operations']):
+                name = self.random.choice(self.operations)
+                op_stats = stats[name]
+                started = default_timer()
+                for attempt in range(self.config['retries'] + 1):
+                    try:
+                        outcome = getattr(self, 'op_' + name)()
+                    except sqlalchemy.exc.DBAPIError:
+                        # E.g. "database is locked" or a deadlock
+                        self.session.rollback()
+                        op_stats.retries += 1
+                        time.sleep(self.random.uniform(0, 0.01) * attempt)
+                    else:
+                        break
+                else:
+                    outcome = 'failed'
+                op_stats.add(default_timer() - started, outcome)
+        finally:
+            self.session.close()
+            self.engine.dispose()
+        return stats
+
+
+def run_worker(worker_id, config):
+    return Worker(worker_id, config).run()
+
+
+def prepare(config):
+    """(Re)create the table contents, returns primary keys of the records."""
+    model = TransitionRef(config['model'], None).model
+    mapper = sqla_inspect(model)
+    engine = sqlalchemy.create_engine(config['url'])
+    try:
+        mapper.local_table.metadata.create_all(engine)
+        LOG_METADATA.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.query(model).delete()
+        session.execute(log_table.delete())
+        state_key = mapper.get_property_by_column(
+            COLUMN_CACHE.getValue(model)).key
+        session.bulk_insert_mappings(model, [
+            {state_key: config['initial_state']}
+            for _ in range(config['records'])
+        ])
+        session.commit()
+        pk_column = util.get_single_pk_column(mapper)
+        out = [row[0] for row in session.query(pk_column)]
+        session.close()
+    finally:
+        engine.dispose()
+    return out
+
+
+def find_lost_updates(connection, model, initial_state):
+    """Return (lost update count, records with unexpected final state)."""
+    last_state = {}
+    lost = 0
+    for row in connection.execute(
+        sqlalchemy.select([
+            log_table.c.record_id, log_table.c.source, log_table.c.target,
+        ]).order_by(log_table.c.id)
+    ):
+        if row.source != last_state.get(row.record_id, initial_state):
+            lost += 1
+        last_state[row.record_id] = row.target
+
+    pk_column = util.get_single_pk_column(sqla_inspect(model))
+    state_column = COLUMN_CACHE.getValue(model)
+    mismatched = 0
+    for (pk, state) in connection.execute(
+        sqlalchemy.select([pk_column, state_column])
+    ):
+        if state != last_state.get(pk, initial_state):
+            mismatched += 1
+    return (lost, mismatched)
+
+
+def run(
+    url, model=DEFAULT_MODEL, transitions=None, workers=4, mode='thread',
+    operations=500, records=100, mix=None, initial_state='new',
+    retries=5, seed=0
+):
+    """Run the load test, returns the report dict."""
+    model_cls = TransitionRef(model, None).model
+    if transitions is None:
+        transitions = [name for (name, _) in iter_transitions(model_cls)]
+    config = {
+        'url': url,
+        'model': model,
+        'transitions': list(transitions),
+        'operations': operations,
+        'records': records,
+        'mix': mix or {'set': 5, 'claim': 3, 'query': 2},
+        'initial_state': initial_state,
+        'retries': retries,
+        'seed': seed,
+    }
+    config['pks'] = prepare(config)
+
+    if mode == 'thread':
+        executor = ThreadPoolExecutor(workers)
+    elif mode == 'process':
+        executor = ProcessPoolExecutor(workers)
+    else:
+        raise NotImplementedError(mode)
+
+    started = default_timer()
+    with executor:
+        results = list(executor.map(
+            run_worker, range(workers), [config] * workers))
+    elapsed = default_timer() - started
+
+    stats = dict((name, OperationStats()) for name in OPERATIONS)
+    for worker_stats in results:
+        for (name, op_stats) in worker_stats.items():
+            stats[name].merge(op_stats)
+
+    engine = sqlalchemy.create_engine(url)
+    try:
+        with engine.connect() as connection:
+            (lost, mismatched) = find_lost_updates(
+                connection, model_cls, initial_state)
+    finally:
+        engine.dispose()
+
+    total = sum(op_stats.count for op_stats in stats.values())
+    claims = stats['claim'].count
+    return {
+        'operations': total,
+        'elapsed': elapsed,
+        'throughput': total / elapsed if elapsed else 0.0,
+        'retry_rate': float(sum(
+            op_stats.retries for op_stats in stats.values()
+        )) / total if total else 0.0,
+        'conflict_rate': float(
+            stats['claim'].outcomes.get('conflict', 0)
+        ) / claims if claims else 0.0,
+        'lost_updates': lost,
+        'mismatched_records': mismatched,
+        'by_operation': dict(
+            (name, {
+                'count': op_stats.count,
+                'p50': op_stats.percentile(0.5),
+                'p99': op_stats.percentile(0.99),
+                'outcomes': dict(op_stats.outcomes),
+                'retries': op_stats.retries,
+            })
+            for (name, op_stats) in stats.items()
+        ),
+    }
+
+
+def print_report(report):
+    print('{operations} operations in {elapsed:.2f}s, '
+          '{throughput:.1f} ops/s'.format(**report))
+    print('retry rate {:.2%}, claim conflict rate {:.2%}'.format(
+        report['retry_rate'], report['conflict_rate']))
+    print('lost updates {}, records in unexpected state {}'.format(
+        report['lost_updates'], report['mismatched_records']))
+    for (name, op_report) in sorted(report['by_operation'].items()):
+        print('{:>6}: {:>7} ops  p50 {:8.2f}ms  p99 {:8.2f}ms  {}'.format(
+            name, op_report['count'],
+            op_report['p50'] * 1000, op_report['p99'] * 1000,
+            ', '.join(
+                '{}={}'.format(outcome, count)
+                for (outcome, count) in sorted(op_report['outcomes'].items())
+            )
+        ))
+
+
+def parse_mix(value):
+    out = {}
+    for item in value.split(','):
+        (name, weight) = item.split('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                'Unknown operation {!r}'.format(name))
+        out[name] = int(weight)
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='sqlite:///fsm-loadtest.db')
+    parser.add_argument('--model', default=DEFAULT_MODEL)
+    parser.add_argument(
+        '--transitions', type=lambda value: value.split(','),
+        help='Comma-separated transition names (all by default)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument(
+        '--mode', choices=('thread', 'process'), default='thread')
+    parser.add_argument(
+        '--operations', type=int, default=500, help='Per worker')
+    parser.add_argument('--records', type=int, default=100)
+    parser.add_argument(
+        '--mix', type=parse_mix, default=None,
+        help='Operation weights, e.g. set=5,claim=3,query=2')
+    parser.add_argument('--initial-state', default='new')
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    print_report(run(
+        args.url, model=args.model, transitions=args.transitions,
+        workers=args.workers, mode=args.mode, operations=args.operations,
+        records=args.records, mix=args.mix,
+        initial_state=args.initial_state, retries=args.retries,
+        seed=args.seed,
+    ))
+
+
+if __name__ == '__main__':
+    main()
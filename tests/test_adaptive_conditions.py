@@ -0,0 +1,123 @@
+import time
+
+import pytest
+import sqlalchemy
+
+import sqlalchemy_fsm
+
+from sqlalchemy_fsm.conditions import pure, ConditionOrder, ConditionStats
+
+from tests.conftest import Base
+
+
+@pure
+def slow_check(instance):
+    time.sleep(0.001)
+    return True
+
+
+@pure
+def usually_rejects(instance):
+    return instance.counter % 10 == 0
+
+
+def impure_check(instance):
+    instance.counter += 1
+    return True
+
+
+@pure
+def always_true(instance):
+    return True
+
+
+class AdaptiveModel(Base):
+    __tablename__ = 'adaptive_model'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(sqlalchemy_fsm.FSMField)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        self.counter = 0
+        super(AdaptiveModel, self).__init__(*args, **kwargs)
+
+    @sqlalchemy_fsm.transition(
+        source='*', target='checked', adaptive=True,
+        conditions=[impure_check, always_true, slow_check, usually_rejects]
+    )
+    def checked(self):
+        pass
+
+    @sqlalchemy_fsm.transition(
+        source='*', target='plain', conditions=[slow_check, usually_rejects]
+    )
+    def plain(self):
+        pass
+
+    @sqlalchemy_fsm.transition(target='moved', adaptive=True)
+    class moved(object):
+
+        @sqlalchemy_fsm.transition(
+            source='new', conditions=[slow_check, usually_rejects])
+        def from_new(self, instance):
+            pass
+
+
+class TestAdaptiveOrder(object):
+
+    def test_reordered(self):
+        (order, ) = AdaptiveModel.checked.condition_orders()
+        assert order.order == (
+            impure_check, always_true, slow_check, usually_rejects)
+
+        record = AdaptiveModel()
+        results = []
+        for _ in range(200):
+            results.append(record.checked.can_proceed())
+        assert results.count(True) == 20
+
+        # The impure condition stays in front of the pure ones
+        assert order.order == (
+            impure_check, usually_rejects, always_true, slow_check)
+        stats = order.stats[usually_rejects]
+        assert stats.calls == 200
+        assert stats.rejections == 180
+        assert order.stats[slow_check].calls < 200
+        assert order.stats[slow_check].mean_time >= 0.001
+
+    def test_transition_class(self):
+        (order, ) = AdaptiveModel.moved.condition_orders()
+        record = AdaptiveModel()
+        for idx in range(100):
+            record.counter = idx
+            record.moved.can_proceed()
+        assert order.order[0] is usually_rejects
+
+    def test_not_adaptive(self):
+        assert AdaptiveModel.plain.condition_orders() == ()
+
+
+class TestConditionOrder(object):
+
+    def test_rank(self):
+        stats = ConditionStats()
+        assert stats.rank == 0
+        for idx in range(8):
+            stats.calls += 1
+            stats.total_time += 0.5
+            stats.rejections += idx % 2
+        assert stats.mean_time == 0.5
+        assert stats.rejection_rate == 0.5
+        assert stats.rank == 1.0
+
+        stats.decay()
+        assert (stats.calls, stats.rejections) == (4, 2)
+        assert stats.mean_time == 0.5
+
+    def test_window(self):
+        order = ConditionOrder([always_true], reorder_every=2, window=4)
+        for _ in range(4):
+            order.record(always_true, 0.1, True)
+            order.evaluated()
+        assert order.evaluations == 0
+        assert order.stats[always_true].calls == 2
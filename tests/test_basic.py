@@ -220,3 +220,69 @@ class TestNullSource(object):
         assert model.status == 'published'
         model.endFromAll.set()
         assert model.status == 'end'
+
+
+class PolymorphicPost(Base):
+    __tablename__ = 'polymorphic_post'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    kind = sqlalchemy.Column(sqlalchemy.String)
+    state = sqlalchemy.Column(FSMField)
+
+    __mapper_args__ = {
+        'polymorphic_on': kind,
+        'polymorphic_identity': 'post',
+    }
+
+    @transition(source='*', target='published')
+    def published(self):
+        pass
+
+
+class PolymorphicNews(PolymorphicPost):
+    __mapper_args__ = {
+        'polymorphic_identity': 'news',
+    }
+
+
+class TestClassBoundCache(object):
+
+    def test_accessor_cached(self):
+        assert BlogPost.published is BlogPost.published
+        assert BlogPost.published is not BlogPost.hidden
+
+    def test_bound_meta_shared_by_records(self):
+        (model1, model2) = (BlogPost(), BlogPost())
+        assert model1.published._sa_fsm_bound_meta is \
+            model2.published._sa_fsm_bound_meta
+        model1.published.set()
+        assert model1.published()
+        assert not model2.published()
+
+    def test_expressions_cached(self):
+        assert BlogPost.published() is BlogPost.published()
+        assert BlogPost.published.is_(True) is \
+            BlogPost.published.is_(True)
+        assert BlogPost.published.is_(False) is not \
+            BlogPost.published.is_(True)
+
+    def test_subclass(self, session):
+        base_accessor = PolymorphicPost.published
+        sub_accessor = PolymorphicNews.published
+        assert sub_accessor is not base_accessor
+        assert sub_accessor is PolymorphicNews.published
+        assert base_accessor._sa_fsm_owner_cls is PolymorphicPost
+        assert sub_accessor._sa_fsm_owner_cls is PolymorphicNews
+
+        post = PolymorphicPost()
+        news = PolymorphicNews()
+        post.published.set()
+        news.published.set()
+        session.add_all([post, news, PolymorphicNews(state='new')])
+        session.commit()
+
+        assert set(session.query(PolymorphicPost).filter(
+            PolymorphicPost.published()
+        )) == {post, news}
+        assert session.query(PolymorphicNews).filter(
+            PolymorphicNews.published()
+        ).all() == [news]
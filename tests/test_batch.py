@@ -0,0 +1,151 @@
+import pickle
+
+from concurrent.futures import Executor, Future
+
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import FSMField, transition, batch, exc
+from sqlalchemy_fsm.transition import TransitionNameCache
+
+from tests.conftest import Base
+
+
+def score_is_positive(instance, threshold):
+    return instance.score > threshold
+
+
+class BatchRecord(Base):
+    __tablename__ = 'batch_record'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    score = sqlalchemy.Column(sqlalchemy.Integer)
+    rendered = sqlalchemy.Column(sqlalchemy.String)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(BatchRecord, self).__init__(*args, **kwargs)
+
+    @transition(source='new', target='rendered',
+                conditions=[score_is_positive])
+    def rendered_state(self, threshold):
+        self.rendered = 'score:{}'.format(self.score)
+
+    @transition(source='rendered', target='archived')
+    def archived(self):
+        pass
+
+
+class InlineExecutor(Executor):
+    """Runs the chunks right away, calling `before` first
+    (e.g. to change the records concurrently)."""
+
+    def __init__(self, before=None):
+        self.before = before
+        self.submitted = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted += 1
+        if self.before is not None:
+            self.before()
+        out = Future()
+        out.set_result(fn(*args, **kwargs))
+        return out
+
+
+class TestTransitionRef(object):
+
+    def test_resolve(self):
+        ref = batch.TransitionRef.for_transition(BatchRecord.archived)
+        assert ref.model is BatchRecord
+        assert ref.name == 'archived'
+        assert ref.resolve()._sa_fsm_meta is \
+            BatchRecord.archived._sa_fsm_meta
+
+    def test_pickle(self):
+        ref = batch.TransitionRef.for_transition(
+            BatchRecord.rendered_state)
+        assert pickle.loads(pickle.dumps(ref)) == ref
+
+    def test_unknown_transition(self):
+        class NotOwner(object):
+            pass
+
+        with pytest.raises(exc.SetupError) as err:
+            TransitionNameCache.getValue(
+                (NotOwner, BatchRecord.archived._sa_fsm_meta))
+        assert 'is not defined on' in str(err)
+
+
+class TestBatchRun(object):
+
+    @pytest.fixture
+    def records(self, session):
+        session.query(BatchRecord).delete()
+        out = [BatchRecord(score=idx - 5) for idx in range(25)]
+        session.add_all(out)
+        session.commit()
+        return out
+
+    def test_run(self, session, records):
+        result = batch.run(
+            session, session.query(BatchRecord),
+            BatchRecord.rendered_state, args=(0, ),
+            chunk_size=4, max_workers=2,
+        )
+        session.commit()
+
+        assert result.processed == 25
+        assert result.changed == 19
+        assert len(result.failures) == 6
+        assert all(
+            'PreconditionError' in error for (pk, error) in result.failures
+        )
+
+        session.expire_all()
+        for record in records:
+            if record.score > 0:
+                assert record.state == 'rendered'
+                assert record.rendered == 'score:{}'.format(record.score)
+            else:
+                assert record.state == 'new'
+                assert record.rendered is None
+
+    def test_run_filtered(self, session, records):
+        records[0].score = 100
+        records[0].rendered_state.set(0)
+        session.commit()
+
+        result = batch.run(
+            session,
+            session.query(BatchRecord).filter(BatchRecord.rendered_state()),
+            BatchRecord.archived,
+        )
+        session.commit()
+        assert result.processed == 1
+        assert result.changed == 1
+        session.expire_all()
+        assert records[0].archived()
+
+    def test_conflict(self, session, records):
+        moved = records[-1]
+
+        def move():
+            session.execute(BatchRecord.__table__.update().where(
+                BatchRecord.id == moved.id).values(state='archived'))
+
+        result = batch.run(
+            session, session.query(BatchRecord).filter(
+                BatchRecord.id.in_([records[-2].id, moved.id])),
+            BatchRecord.rendered_state, args=(0, ),
+            executor=InlineExecutor(move), max_in_flight=1,
+        )
+        session.commit()
+        assert (result.processed, result.changed, result.conflicts) == \
+            (2, 1, 1)
+
+        session.expire_all()
+        assert records[-2].rendered_state()
+        # Moved by someone else, not overwritten
+        assert moved.state == 'archived'
+        assert moved.rendered is None
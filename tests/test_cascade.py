@@ -0,0 +1,194 @@
+import pytest
+import sqlalchemy
+import sqlalchemy.event
+
+from sqlalchemy.orm import relationship
+
+from sqlalchemy_fsm import FSMField, transition, cascade, exc
+
+from tests.conftest import Base, engine
+
+
+class CascadeOrder(Base):
+    __tablename__ = 'cascade_order'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    on_hold = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
+
+    shipments = relationship('CascadeShipment')
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'open'
+        self.on_hold = False
+        super(CascadeOrder, self).__init__(*args, **kwargs)
+
+    @transition(source='open', target='in_transit')
+    def in_transit(self):
+        pass
+
+    @transition(
+        source=['open', 'in_transit'], target='fulfilled',
+        conditions=[lambda instance: not instance.on_hold]
+    )
+    def fulfilled(self):
+        pass
+
+
+class CascadeShipment(Base):
+    __tablename__ = 'cascade_shipment'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    order_id = sqlalchemy.Column(
+        sqlalchemy.Integer, sqlalchemy.ForeignKey(CascadeOrder.id))
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(CascadeShipment, self).__init__(*args, **kwargs)
+
+    @transition(source='new', target='sent')
+    def sent(self):
+        pass
+
+    @transition(source=['new', 'sent'], target='delivered')
+    def delivered(self):
+        pass
+
+
+@pytest.fixture
+def fulfilment():
+    out = cascade.when_all(CascadeShipment.delivered, CascadeOrder.fulfilled)
+    yield out
+    out.remove()
+
+
+@pytest.fixture
+def transit():
+    out = cascade.when_any(CascadeShipment.sent, CascadeOrder.in_transit)
+    yield out
+    out.remove()
+
+
+@pytest.fixture
+def orders(session):
+    session.query(CascadeShipment).delete()
+    session.query(CascadeOrder).delete()
+    out = [
+        CascadeOrder(shipments=[CascadeShipment() for _ in range(3)])
+        for _ in range(4)
+    ]
+    session.add_all(out)
+    session.commit()
+    return out
+
+
+@pytest.fixture
+def statements():
+    out = []
+
+    def on_execute(conn, cursor, statement, *args):
+        out.append(statement)
+
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', on_execute)
+    yield out
+    sqlalchemy.event.remove(engine, 'before_cursor_execute', on_execute)
+
+
+class TestSetup(object):
+
+    def test_foreign_key_found(self, fulfilment):
+        assert fulfilment.foreign_key is CascadeShipment.order_id
+
+    def test_no_foreign_key(self):
+        with pytest.raises(exc.SetupError):
+            cascade.when_all(CascadeOrder.fulfilled, CascadeShipment.delivered)
+
+    def test_invalid_mode(self):
+        with pytest.raises(NotImplementedError):
+            cascade.Cascade(
+                CascadeShipment.delivered, CascadeOrder.fulfilled,
+                mode='most'
+            )
+
+
+class TestWhenAll(object):
+
+    def test_all_delivered(self, session, orders, fulfilment):
+        (order, other) = orders[:2]
+        for shipment in order.shipments[:2]:
+            shipment.delivered.set()
+        other.shipments[0].delivered.set()
+        session.commit()
+        assert order.state == 'open'
+
+        order.shipments[2].delivered.set()
+        session.commit()
+        assert order.state == 'fulfilled'
+        assert other.state == 'open'
+
+        session.expire_all()
+        assert order.state == 'fulfilled'
+
+    def test_parent_conditions(self, session, orders, fulfilment):
+        order = orders[0]
+        order.on_hold = True
+        for shipment in order.shipments:
+            shipment.delivered.set()
+        session.commit()
+        assert order.state == 'open'
+
+    def test_parent_source(self, session, orders, fulfilment):
+        order = orders[0]
+        order.state = 'cancelled'
+        for shipment in order.shipments:
+            shipment.delivered.set()
+        session.commit()
+        assert order.state == 'cancelled'
+
+    def test_new_children(self, session, orders, fulfilment):
+        order = CascadeOrder()
+        session.add(order)
+        session.flush()
+        shipment = CascadeShipment(order_id=order.id)
+        shipment.delivered.set()
+        session.add(shipment)
+        session.commit()
+        assert order.state == 'fulfilled'
+
+    def test_one_check_per_flush(
+        self, session, orders, fulfilment, statements
+    ):
+        shipments = [
+            shipment for order in orders for shipment in order.shipments]
+        del statements[:]
+        for shipment in shipments:
+            shipment.delivered.set()
+        session.flush()
+        checks = [stmt for stmt in statements if 'EXISTS' in stmt]
+        assert len(checks) == 1
+        assert [order.state for order in orders] == ['fulfilled'] * 4
+        session.commit()
+
+    def test_removed(self, session, orders):
+        out = cascade.when_all(
+            CascadeShipment.delivered, CascadeOrder.fulfilled)
+        out.remove()
+        order = orders[0]
+        for shipment in order.shipments:
+            shipment.delivered.set()
+        session.commit()
+        assert order.state == 'open'
+
+
+class TestWhenAny(object):
+
+    def test_any_sent(self, session, orders, transit, fulfilment):
+        order = orders[0]
+        order.shipments[0].sent.set()
+        session.commit()
+        assert order.state == 'in_transit'
+        assert [order.state for order in orders[1:]] == ['open'] * 3
+
+        for shipment in order.shipments:
+            shipment.delivered.set()
+        session.commit()
+        assert order.state == 'fulfilled'
@@ -0,0 +1,183 @@
+import pytest
+import sqlalchemy
+import sqlalchemy.event
+
+import sqlalchemy_fsm
+
+from sqlalchemy_fsm import coalesce
+
+from tests.conftest import Base
+
+
+class CoalescedTicket(Base):
+    __tablename__ = 'coalesced_ticket'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(sqlalchemy_fsm.FSMField)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(CoalescedTicket, self).__init__(*args, **kwargs)
+
+    @sqlalchemy_fsm.transition(source='new', target='validated')
+    def validated(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='validated', target='queued')
+    def queued(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='*', target='new')
+    def reset(self):
+        pass
+
+    @sqlalchemy_fsm.transition(target='new')
+    class loop(object):
+
+        @sqlalchemy_fsm.transition(source='new')
+        def from_new(self, instance):
+            pass
+
+
+class TestCoalesce(object):
+
+    @pytest.fixture
+    def log(self):
+        out = []
+
+        def before(instance, source, target):
+            out.append(('before', source, target))
+
+        def after(instance, source, target):
+            out.append(('after', source, target))
+
+        sqlalchemy.event.listen(CoalescedTicket, 'before_state_change', before)
+        sqlalchemy.event.listen(CoalescedTicket, 'after_state_change', after)
+        yield out
+        sqlalchemy.event.remove(CoalescedTicket, 'before_state_change', before)
+        sqlalchemy.event.remove(CoalescedTicket, 'after_state_change', after)
+
+    @pytest.fixture
+    def ticket(self, session):
+        out = CoalescedTicket()
+        session.add(out)
+        session.commit()
+        yield out
+        coalesce.disable(session)
+
+    def test_net_change(self, session, ticket, log):
+        coalesce.enable(session)
+        ticket.validated.set()
+        ticket.queued.set()
+        assert ticket.state == 'queued'
+        # Before listeners are called by every set()
+        assert log == [
+            ('before', 'new', 'validated'),
+            ('before', 'validated', 'queued'),
+        ]
+
+        session.flush()
+        assert log[2:] == [('after', 'new', 'queued')]
+        # Dispatched just once
+        session.commit()
+        assert len(log) == 3
+
+    def test_round_trip_not_dispatched(self, session, ticket, log):
+        coalesce.enable(session)
+        ticket.validated.set()
+        ticket.reset.set()
+        assert ticket.state == 'new'
+        session.commit()
+        assert log == [
+            ('before', 'new', 'validated'),
+            ('before', 'validated', 'new'),
+        ]
+
+    def test_before_vetoes(self, session, ticket):
+        def before(instance, source, target):
+            raise ValueError(target)
+
+        coalesce.enable(session)
+        sqlalchemy.event.listen(
+            CoalescedTicket, 'before_state_change', before)
+        try:
+            with pytest.raises(ValueError):
+                ticket.validated.set()
+        finally:
+            sqlalchemy.event.remove(
+                CoalescedTicket, 'before_state_change', before)
+        assert ticket.state == 'new'
+        assert coalesce.get_coalescer(ticket).pending == {}
+
+    def test_self_loop_not_written(self, session, ticket, log):
+        statements = []
+
+        def on_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        coalesce.enable(session)
+        sqlalchemy.event.listen(
+            session.bind, 'before_cursor_execute', on_execute)
+        try:
+            ticket.loop.set()
+            ticket.loop.set()
+            assert log == [('before', 'new', 'new')] * 2
+            assert ticket not in session.dirty
+            session.commit()
+        finally:
+            sqlalchemy.event.remove(
+                session.bind, 'before_cursor_execute', on_execute)
+
+        assert not [el for el in statements if el.startswith('UPDATE')]
+        # After listeners still get the (net) self-loop on commit
+        assert log[2:] == [('after', 'new', 'new')]
+
+    def test_steps(self, session, ticket, log):
+        steps = []
+
+        def after(instance, source, target):
+            steps.append(coalesce.get_steps(instance))
+
+        sqlalchemy.event.listen(CoalescedTicket, 'after_state_change', after)
+        try:
+            coalesce.enable(session, keep_steps=True)
+            ticket.validated.set()
+            ticket.queued.set()
+            assert coalesce.get_steps(ticket) == [
+                ('new', 'validated'), ('validated', 'queued'),
+            ]
+            session.flush()
+        finally:
+            sqlalchemy.event.remove(
+                CoalescedTicket, 'after_state_change', after)
+        assert log[-1] == ('after', 'new', 'queued')
+        assert steps == [[('new', 'validated'), ('validated', 'queued')]]
+        assert coalesce.get_steps(ticket) == []
+
+    def test_steps_not_kept(self, session, ticket):
+        coalesce.enable(session)
+        ticket.validated.set()
+        with pytest.raises(NotImplementedError):
+            coalesce.get_steps(ticket)
+
+    def test_rollback_and_expunge(self, session, ticket, log):
+        coalesce.enable(session)
+        ticket.validated.set()
+        session.rollback()
+        session.flush()
+        assert log == [('before', 'new', 'validated')]
+
+        ticket.validated.set()
+        session.expunge(ticket)
+        session.flush()
+        assert [el for el in log if el[0] == 'after'] == []
+
+    def test_disable(self, session, ticket, log):
+        coalesce.enable(session)
+        ticket.validated.set()
+        coalesce.disable(session)
+        assert log == [
+            ('before', 'new', 'validated'),
+            ('after', 'new', 'validated'),
+        ]
+        ticket.queued.set()
+        assert log[-1] == ('after', 'validated', 'queued')
@@ -0,0 +1,103 @@
+import datetime
+
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm.history import History
+
+from tests.conftest import Base
+
+numpy = pytest.importorskip('numpy')
+
+from sqlalchemy_fsm import columnar  # noqa: E402
+
+
+history = History(Base.metadata, name='fsm_columnar_history')
+
+START = datetime.datetime(2020, 1, 1)
+
+
+class Funnel(object):
+    """Stand-in model class (only its name is used)."""
+
+
+def entry(record_id, source, target, minutes, model='Funnel'):
+    return dict(
+        model=model, record_id=record_id, source=source, target=target,
+        created_at=START + datetime.timedelta(minutes=minutes),
+    )
+
+
+@pytest.fixture
+def rows(session):
+    session.execute(history.table.delete())
+    out = [
+        entry(1, None, 'trial', 0),
+        entry(2, None, 'trial', 1),
+        entry(1, 'trial', 'paid', 10),
+        entry(3, None, 'trial', 12),
+        entry(2, 'trial', 'cancelled', 31),
+        entry(1, 'paid', 'trial', 40),
+        entry(1, 'trial', 'paid', 45),
+        # Same record id of another model
+        entry(3, None, 'paid', 50, model='Other'),
+    ]
+    session.execute(history.table.insert(), out)
+    session.commit()
+    return out
+
+
+class TestExport(object):
+
+    def test_roundtrip(self, session, rows, tmpdir):
+        data = columnar.export(
+            session, history, str(tmpdir.join('out')), chunk_size=3)
+        assert len(data) == len(rows)
+        assert isinstance(data.target, numpy.memmap)
+        assert data.id.dtype == numpy.int64
+        assert list(data.id) == sorted(data.id)
+        assert data.states.values == ['trial', 'paid', 'cancelled']
+        assert data.models.values == ['Funnel', 'Other']
+        assert [
+            data.states.values[code] if code >= 0 else None
+            for code in data.source
+        ] == [row['source'] for row in rows]
+        assert list(data.record_id) == [row['record_id'] for row in rows]
+        assert data.created_at[2] == numpy.datetime64('2020-01-01T00:10')
+
+        reopened = columnar.ColumnarHistory(str(tmpdir.join('out')))
+        assert list(reopened.target) == list(data.target)
+        assert reopened.last_id == data.id[-1]
+
+    def test_models_filter(self, session, rows, tmpdir):
+        data = columnar.export(
+            session, history, str(tmpdir), models=[Funnel])
+        assert len(data) == len(rows) - 1
+        assert data.models.values == ['Funnel']
+
+    def test_empty(self, session, tmpdir):
+        session.execute(history.table.delete())
+        session.commit()
+        data = columnar.export(session, history, str(tmpdir))
+        assert len(data) == 0
+        assert list(data.time_in_state('trial')) == []
+        assert data.conversion('trial', 'paid') == (0, 0)
+
+
+class TestQueries(object):
+
+    @pytest.fixture
+    def data(self, session, rows, tmpdir):
+        return columnar.export(session, history, str(tmpdir))
+
+    def test_time_in_state(self, data):
+        assert sorted(data.time_in_state('trial')) == [300, 600, 1800]
+        assert list(data.time_in_state('paid')) == [1800]
+        assert list(data.time_in_state('unknown')) == []
+
+    def test_conversion(self, data):
+        assert data.conversion('trial', 'paid') == (1, 3)
+        assert data.conversion('trial', 'cancelled') == (1, 3)
+        assert data.conversion('paid', 'trial') == (1, 2)
+        assert data.conversion('trial', 'unknown') == (0, 3)
+        assert data.conversion('unknown', 'paid') == (0, 0)
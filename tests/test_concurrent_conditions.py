@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+import sqlalchemy
+
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy_fsm
+
+from sqlalchemy_fsm import conditions, pool
+
+from tests.conftest import Base
+
+
+CALLS = []
+
+
+def sleeping(seconds, result=True, name=None):
+
+    @conditions.concurrent
+    def condition(instance, *args, **kwargs):
+        CALLS.append((name, threading.current_thread().name))
+        time.sleep(seconds)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return condition
+
+
+def inline_check(instance, *args, **kwargs):
+    CALLS.append(('inline', threading.current_thread().name))
+    return instance.allowed
+
+
+class GuardedOrder(Base):
+    __tablename__ = 'guarded_order'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(sqlalchemy_fsm.FSMField)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        self.allowed = True
+        super(GuardedOrder, self).__init__(*args, **kwargs)
+
+    @sqlalchemy_fsm.transition(source='new', target='paid', conditions=[
+        sleeping(0.2), sleeping(0.2), sleeping(0.2), inline_check,
+    ])
+    def paid(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='new', target='rejected', conditions=[
+        sleeping(0.5), sleeping(0.01, result=False),
+    ])
+    def rejected(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='new', target='broken', conditions=[
+        sleeping(0.5), sleeping(0.01, result=ValueError('Service down')),
+    ])
+    def broken(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='new', target='queued', conditions=[
+        sleeping(0, result=False, name='first'),
+        sleeping(0.2, name='second'), sleeping(0.2, name='third'),
+    ])
+    def queued(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='new', target='shipped', conditions=[
+        conditions.concurrent(lambda instance, address: bool(address)),
+    ])
+    def shipped(self, address):
+        pass
+
+
+class TestConcurrentConditions(object):
+
+    @pytest.fixture
+    def order(self):
+        del CALLS[:]
+        return GuardedOrder()
+
+    def test_slowest_guard_latency(self, order):
+        start = time.time()
+        assert order.paid.can_proceed()
+        assert time.time() - start < 0.4
+        names = set(thread for (name, thread) in CALLS if name != 'inline')
+        assert threading.current_thread().name not in names
+        assert ('inline', threading.current_thread().name) in CALLS
+
+        order.paid.set()
+        assert order.state == 'paid'
+
+    def test_inline_failure(self, order):
+        order.allowed = False
+        assert not order.paid.can_proceed()
+
+    def test_fail_fast(self, order):
+        start = time.time()
+        assert not order.rejected.can_proceed()
+        assert time.time() - start < 0.4
+
+    def test_exception(self, order):
+        with pytest.raises(ValueError):
+            order.broken.can_proceed()
+
+    def test_pending_cancelled(self, order):
+        old = pool.set_executor(ThreadPoolExecutor(1))
+        try:
+            assert not order.queued.can_proceed()
+        finally:
+            pool.shutdown()
+            pool.set_executor(old)
+        # 'third' condition was still queued when the first one failed
+        assert 'third' not in [name for (name, thread) in CALLS]
+
+    def test_call_args(self, order):
+        assert order.shipped.can_proceed('Home')
+        assert not order.shipped.can_proceed('')
+        assert not order.shipped.can_proceed()
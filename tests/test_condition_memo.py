@@ -0,0 +1,130 @@
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import FSMField, transition, conditions
+
+from tests.conftest import Base
+
+
+CALL_LOG = []
+
+
+@conditions.pure(key=lambda instance: None)
+def feature_enabled(instance):
+    CALL_LOG.append('feature_enabled')
+    return True
+
+
+@conditions.pure
+def owner_allowed(instance):
+    CALL_LOG.append('owner_allowed')
+    return instance.owner != 'banned'
+
+
+@conditions.pure
+def handler_owner_allowed(handler, instance):
+    CALL_LOG.append('handler_owner_allowed')
+    return instance.owner != 'banned'
+
+
+def impure(instance):
+    CALL_LOG.append('impure')
+    return True
+
+
+class MemoBlogPost(Base):
+    __tablename__ = 'memo_blog_post'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    owner = sqlalchemy.Column(sqlalchemy.String)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(MemoBlogPost, self).__init__(*args, **kwargs)
+
+    @transition(source='new', target='published', conditions=[
+        feature_enabled, owner_allowed, impure,
+    ])
+    def published(self):
+        pass
+
+    @transition(target='reviewed')
+    class reviewed(object):
+
+        @transition(source='new', conditions=[handler_owner_allowed])
+        def from_new(self, instance):
+            pass
+
+
+@pytest.fixture(autouse=True)
+def clear_log():
+    del CALL_LOG[:]
+
+
+class TestMemoScope(object):
+
+    def test_no_scope(self):
+        model = MemoBlogPost(owner='joe')
+        assert model.published.can_proceed()
+        assert model.published.can_proceed()
+        assert CALL_LOG == ['feature_enabled', 'owner_allowed', 'impure'] * 2
+
+    def test_context_manager(self):
+        models = [MemoBlogPost(owner='joe') for idx in range(3)]
+        with conditions.memoize() as scope:
+            for model in models:
+                assert model.published.can_proceed()
+                assert model.published.can_proceed()
+        assert CALL_LOG.count('feature_enabled') == 1
+        assert CALL_LOG.count('owner_allowed') == 3
+        assert CALL_LOG.count('impure') == 6
+        assert scope.misses == 4
+        assert scope.hits == 8
+
+        # Scope is no longer active
+        assert models[0].published.can_proceed()
+        assert CALL_LOG.count('feature_enabled') == 2
+
+    def test_failed_condition_memoized(self):
+        model = MemoBlogPost(owner='banned')
+        with conditions.memoize() as scope:
+            assert not model.published.can_proceed()
+            assert not model.published.can_proceed()
+        assert CALL_LOG.count('owner_allowed') == 1
+        assert 'impure' not in CALL_LOG
+        assert scope.hits == 2
+
+    def test_invalidate(self):
+        model = MemoBlogPost(owner='joe')
+        with conditions.memoize() as scope:
+            model.published.can_proceed()
+            scope.invalidate(owner_allowed)
+            model.published.can_proceed()
+            assert CALL_LOG.count('feature_enabled') == 1
+            assert CALL_LOG.count('owner_allowed') == 2
+            scope.invalidate()
+            model.published.can_proceed()
+            assert CALL_LOG.count('feature_enabled') == 2
+
+    def test_session_scope(self, session):
+        model = MemoBlogPost(owner='joe')
+        session.add(model)
+        scope = conditions.session_scope(session)
+        assert conditions.session_scope(session) is scope
+
+        model.published.can_proceed()
+        model.published.can_proceed()
+        assert scope.hits == 2
+
+        session.commit()
+        assert not scope.results
+        model.published.can_proceed()
+        assert scope.misses == 4
+
+    def test_class_transition(self):
+        model = MemoBlogPost(owner='joe')
+        with conditions.memoize() as scope:
+            for _ in range(3):
+                assert model.reviewed.can_proceed()
+        assert CALL_LOG == ['handler_owner_allowed']
+        assert (scope.hits, scope.misses) == (2, 1)
@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import FSMField, transition, exc
+
+from tests.conftest import Base
+
+
+class DeferredPost(Base):
+    __tablename__ = 'deferred_post'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    title = sqlalchemy.Column(sqlalchemy.String)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(DeferredPost, self).__init__(*args, **kwargs)
+
+    @transition(source='new', target='published', defer=True)
+    def published(self, channel='email'):
+        if channel == 'broken':
+            raise ValueError('Can not notify')
+        return (
+            self.id, self.state, self.title, channel,
+            threading.current_thread().name
+        )
+
+    @transition(source='published', target='archived')
+    class archived(object):
+
+        @transition(source='published', defer=True)
+        def notified(self, instance):
+            return instance.state
+
+
+class TestDeferred(object):
+
+    @pytest.fixture
+    def post(self, session):
+        out = DeferredPost(title='Hello')
+        session.add(out)
+        session.commit()
+        return out
+
+    def test_after_commit(self, session, post):
+        future = post.published.set('sms')
+        assert post.state == 'published'
+        assert not future.done()
+
+        session.flush()
+        assert not future.done()
+
+        session.commit()
+        (pk, state, title, channel, thread) = future.result(timeout=5)
+        assert (pk, state, title, channel) == (
+            post.id, 'published', 'Hello', 'sms')
+        assert thread != threading.current_thread().name
+
+    def test_rollback(self, session, post):
+        future = post.published.set()
+        session.rollback()
+        assert future.cancelled()
+        assert post.state == 'new'
+
+    def test_savepoint_rollback(self, session, post):
+        other = DeferredPost(title='Other')
+        session.add(other)
+        session.commit()
+
+        kept = post.published.set()
+        session.begin_nested()
+        cancelled = other.published.set()
+        session.rollback()
+        assert cancelled.cancelled()
+        assert not kept.done()
+        assert other.state == 'new'
+
+        session.commit()
+        assert kept.result(timeout=5)[1] == 'published'
+
+    def test_released_savepoint_rollback(self, session, post):
+        session.begin_nested()
+        future = post.published.set()
+        session.commit()  # Releases the savepoint
+        assert not future.done()
+        session.rollback()
+        assert future.cancelled()
+
+    def test_error(self, session, post):
+        future = post.published.set('broken')
+        session.commit()
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+
+    def test_new_record(self, session):
+        post = DeferredPost(title='New')
+        future = post.published.set()
+        session.add(post)
+        session.commit()
+        (pk, state, title, _, _) = future.result(timeout=5)
+        assert pk == post.id
+        assert (state, title) == ('published', 'New')
+
+    def test_class_transition(self, session, post):
+        post.state = 'published'
+        future = post.archived.set()
+        assert post.state == 'archived'
+        session.commit()
+        assert future.result(timeout=5) == 'archived'
+
+    def test_invalid(self):
+        with pytest.raises(NotImplementedError):
+            transition(target='a', defer='yes')(lambda self: None)
+
+    def test_preconditions_checked_now(self, post):
+        post.state = 'archived'
+        with pytest.raises(exc.InvalidSourceStateError):
+            post.published.set()
@@ -0,0 +1,211 @@
+import json
+
+import pytest
+import sqlalchemy
+import sqlalchemy.event
+
+from sqlalchemy_fsm import FSMField, conditions, exc, definition
+from sqlalchemy_fsm.bound import InheritedBoundClasses
+
+from tests.conftest import Base
+
+
+workflows = definition.Registry()
+
+
+@workflows.register
+def is_paid(instance):
+    return instance.amount_paid >= instance.total
+
+
+@workflows.register(name='has_address')
+@conditions.hybrid
+def has_address_condition(instance):
+    return instance.address is not None
+
+
+@has_address_condition.expression
+def has_address_condition(cls):
+    return cls.address.isnot(None)
+
+
+@workflows.register
+def fill_address(instance, address):
+    instance.address = address
+
+
+RETAIL = {
+    'states': ['new', 'paid', 'shipped', 'shipped.partial'],
+    'transitions': {
+        'pay': {
+            'source': 'new', 'target': 'paid', 'conditions': ['is_paid'],
+        },
+        'ship': {
+            'source': 'paid', 'target': 'shipped',
+            'conditions': ['has_address'],
+        },
+        'ship_partially': {
+            'source': 'paid', 'target': 'shipped.partial',
+        },
+    },
+}
+
+WHOLESALE = {
+    'transitions': {
+        # No payment step, drafts get the address on shipping
+        'ship': [
+            {
+                'source': 'new', 'target': 'shipped',
+                'conditions': ['has_address'],
+            },
+            {
+                'source': 'draft', 'target': 'shipped',
+                'handler': 'fill_address',
+            },
+        ],
+        'reopen': {'source': 'shipped.*', 'target': 'new'},
+    },
+}
+
+
+class DefinedOrder(Base):
+    __tablename__ = 'defined_order'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    workflow = sqlalchemy.Column(sqlalchemy.String)
+    total = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    amount_paid = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    address = sqlalchemy.Column(sqlalchemy.String)
+
+    fsm = workflows.transitions('workflow')
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        self.total = 0
+        self.amount_paid = 0
+        super(DefinedOrder, self).__init__(*args, **kwargs)
+
+
+workflows.add('retail', RETAIL)
+workflows.add('wholesale', json.dumps(WHOLESALE))
+# Same content, shared compiled tables
+workflows.add('tenant-42', dict(RETAIL))
+
+
+class TestCompile(object):
+
+    def test_cached_by_hash(self):
+        assert workflows.get('retail') is workflows.get('tenant-42')
+        assert workflows.get('retail') is not workflows.get('wholesale')
+        assert workflows.compile(json.loads(json.dumps(RETAIL))) is \
+            workflows.get('retail')
+
+    def test_no_classes_created(self):
+        before = len(InheritedBoundClasses.cache)
+        order = DefinedOrder(workflow='wholesale', address='x')
+        order.fsm.ship.set()
+        assert order.state == 'shipped'
+        assert len(InheritedBoundClasses.cache) == before
+
+    def test_metas(self):
+        (meta, table) = workflows.get('wholesale').transitions['ship']
+        assert meta.sources == frozenset(['new', 'draft'])
+        assert meta.target == 'shipped'
+        assert len(table.handlers) == 2
+        assert table.handlers[1][1] is fill_address
+
+    @pytest.mark.parametrize('bad, message', [
+        ({'transitions': {'a': {'target': 'b', 'conditions': ['nope']}}},
+         'Unknown FSM function'),
+        ({'transitions': {'a': {'target': 'b', 'when': 'x'}}},
+         'Unknown keys'),
+        ({'transitions': {'a': {'source': 'b'}}}, 'one and just one target'),
+        ({'transitions': {'a': [{'target': 'b'}, {'target': 'c'}]}},
+         'one and just one target'),
+        ({'states': ['a'], 'transitions': {'a': {'target': 'b'}}},
+         'undeclared state'),
+        ({'transitions': {'a': {'target': lambda: None}}},
+         'JSON-serialisable'),
+    ])
+    def test_invalid(self, bad, message):
+        with pytest.raises(exc.SetupError) as err:
+            workflows.compile(bad)
+        assert message in str(err)
+
+    def test_invalid_state_name(self):
+        with pytest.raises(NotImplementedError):
+            workflows.compile({'transitions': {'a': {'target': 42}}})
+
+
+class TestInstance(object):
+
+    def test_retail(self):
+        order = DefinedOrder(workflow='retail', total=10)
+        assert list(order.fsm) == ['pay', 'ship', 'ship_partially']
+        assert 'reopen' not in order.fsm
+        assert order.fsm.available() == []
+
+        with pytest.raises(exc.PreconditionError):
+            order.fsm.pay.set()
+        order.amount_paid = 10
+        order.fsm['pay'].set()
+        assert order.state == 'paid'
+        assert order.fsm.pay() is True
+        assert order.fsm.available() == ['ship_partially']
+
+        with pytest.raises(exc.InvalidSourceStateError):
+            order.fsm.pay.set()
+
+    def test_wholesale(self):
+        order = DefinedOrder(workflow='wholesale', state='draft')
+        with pytest.raises(AttributeError):
+            order.fsm.pay
+        order.fsm.ship.set('Main st. 1')
+        assert order.address == 'Main st. 1'
+        assert order.state == 'shipped'
+
+        order.state = 'shipped.partial'
+        assert order.fsm.available() == ['reopen']
+        order.fsm.reopen.set()
+        assert order.state == 'new'
+
+    def test_unknown_discriminator(self):
+        order = DefinedOrder(workflow='unknown')
+        with pytest.raises(exc.SetupError):
+            order.fsm
+
+    def test_events(self):
+        seen = []
+
+        def on_change(instance, source, target):
+            seen.append((source, target))
+
+        sqlalchemy.event.listen(DefinedOrder, 'after_state_change', on_change)
+        try:
+            order = DefinedOrder(workflow='retail', total=0)
+            order.fsm.pay.set()
+            order.fsm.ship_partially.set()
+        finally:
+            sqlalchemy.event.remove(
+                DefinedOrder, 'after_state_change', on_change)
+        assert seen == [('new', 'paid'), ('paid', 'shipped.partial')]
+
+
+class TestQuery(object):
+
+    def test_applicable(self, session):
+        session.query(DefinedOrder).delete()
+        orders = [
+            DefinedOrder(workflow='retail', state='paid', address='a'),
+            DefinedOrder(workflow='retail', state='paid'),
+            DefinedOrder(workflow='tenant-42', state='paid', address='b'),
+            DefinedOrder(workflow='wholesale', address='c'),
+            DefinedOrder(workflow='wholesale', state='paid', address='d'),
+        ]
+        session.add_all(orders)
+        session.commit()
+
+        matched = session.query(DefinedOrder).filter(
+            DefinedOrder.fsm.applicable('ship')
+        ).order_by(DefinedOrder.id).all()
+        assert matched == [orders[0], orders[2], orders[3]]
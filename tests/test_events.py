@@ -232,3 +232,99 @@ class TestEventsLeakage(object):
         assert len(event_result) == 2
         assert len(tr_cls_result) == 2
         assert len(joint_result) == 4
+
+
+class FilteredEventModel(Base):
+    __tablename__ = 'filtered_event_model'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(sqlalchemy_fsm.FSMField)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(FilteredEventModel, self).__init__(*args, **kwargs)
+
+    @sqlalchemy_fsm.transition(source='*', target='published')
+    def published(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='*', target='hidden')
+    def hidden(self):
+        pass
+
+
+class TestFilteredListeners(object):
+
+    @pytest.fixture
+    def model(self):
+        return FilteredEventModel()
+
+    @pytest.mark.parametrize('event_name', [
+        'before_state_change',
+        'after_state_change',
+    ])
+    def test_filters(self, model, event_name):
+        log = []
+
+        def make_listener(name):
+            def listener(instance, source, target):
+                assert instance is model
+                log.append((name, source, target))
+            return listener
+
+        listeners = [
+            (make_listener('any'), {}),
+            (make_listener('to_pub'), {'target_state': 'published'}),
+            (make_listener('from_new'), {'source_state': 'new'}),
+            (make_listener('pub_to_hidden'), {
+                'source_state': ['published'], 'target_state': 'hidden'}),
+        ]
+        for (listener, filters) in listeners:
+            sqlalchemy.event.listen(
+                FilteredEventModel, event_name, listener, **filters)
+
+        model.published.set()
+        model.hidden.set()
+        model.published.set()
+        assert log == [
+            ('any', 'new', 'published'),
+            ('to_pub', 'new', 'published'),
+            ('from_new', 'new', 'published'),
+            ('any', 'published', 'hidden'),
+            ('pub_to_hidden', 'published', 'hidden'),
+            ('any', 'hidden', 'published'),
+            ('to_pub', 'hidden', 'published'),
+        ]
+
+        # Removal of the filtered listeners works as usual
+        del log[:]
+        sqlalchemy.event.remove(
+            FilteredEventModel, event_name, listeners[1][0])
+        model.published.set()
+        assert log == [('any', 'published', 'published')]
+
+        del log[:]
+        for (listener, filters) in listeners[:1] + listeners[2:]:
+            sqlalchemy.event.remove(FilteredEventModel, event_name, listener)
+        model.hidden.set()
+        assert log == []
+
+    def test_raw(self, model):
+        log = []
+
+        @sqlalchemy.event.listens_for(
+            FilteredEventModel, 'after_state_change',
+            raw=True, target_state='hidden')
+        def on_hidden(state, source, target):
+            log.append(state.obj())
+
+        model.hidden.set()
+        model.published.set()
+        assert log == [model]
+        sqlalchemy.event.remove(
+            FilteredEventModel, 'after_state_change', on_hidden)
+
+    def test_filter_on_non_fsm_event(self):
+        with pytest.raises(sqlalchemy_fsm.exc.SetupError):
+            sqlalchemy.event.listen(
+                FilteredEventModel, 'load',
+                lambda *args: None, target_state='published')
@@ -0,0 +1,196 @@
+import pytest
+import sqlalchemy
+import sqlalchemy.event
+
+import sqlalchemy_fsm
+
+from sqlalchemy_fsm import states, util, migration, exc
+
+from tests.conftest import Base
+
+
+class Shipment(sqlalchemy_fsm.InStateMixin, Base):
+    __tablename__ = 'hierarchical_shipment'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(sqlalchemy_fsm.FSMField)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'paid'
+        super(Shipment, self).__init__(*args, **kwargs)
+
+    @sqlalchemy_fsm.transition(source='paid', target='shipped.partial')
+    def ship_partial(self):
+        pass
+
+    @sqlalchemy_fsm.transition(
+        source=['paid', 'shipped.partial'], target='shipped.full')
+    def ship_full(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='shipped.*', target='delivered')
+    def delivered(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='shipped.*', target='returned')
+    class returned(object):
+
+        @sqlalchemy_fsm.transition(source='shipped.full')
+        def from_full(self, instance):
+            pass
+
+        @sqlalchemy_fsm.transition(source='shipped.partial.*')
+        def from_partial(self, instance):
+            pass
+
+
+class TestStateNames(object):
+
+    @pytest.mark.parametrize('value, valid, hierarchical', [
+        ('shipped', True, True),
+        ('shipped.partial', True, True),
+        ('shipped..partial', True, False),
+        ('.shipped', True, False),
+        ('shipped.', True, False),
+        ('shipped.*', True, False),
+        ('a*b', True, True),
+        ('', False, False),
+        (None, False, False),
+    ])
+    def test_valid_state(self, value, valid, hierarchical):
+        # Plain state names are not restricted by the hierarchy
+        assert bool(util.is_valid_fsm_state(value)) == valid
+        assert bool(states.is_valid_name(value)) == hierarchical
+
+    @pytest.mark.parametrize('value, pattern', [
+        ('shipped.*', True),
+        ('shipped.partial.*', True),
+        ('*.partial', False),
+        ('.*', False),
+        ('shipped..*', False),
+    ])
+    def test_pattern(self, value, pattern):
+        assert util.is_valid_source_state(value)
+        assert states.is_pattern(value) == pattern
+
+    def test_plain_names(self):
+        meta = sqlalchemy_fsm.transition(
+            source=['a..b', '*.partial'], target='shipped.'
+        )(lambda self: None).meta
+        assert meta.target == 'shipped.'
+        assert meta.matches_source('a..b')
+        assert meta.matches_source('*.partial')
+        assert not meta.matches_source('a.b')
+
+    def test_ancestors(self):
+        assert states.get_ancestors('a.b.c') == frozenset(['a', 'a.b'])
+        assert states.get_ancestors('a') == frozenset()
+        assert states.get_ancestors(None) == frozenset()
+        assert states.is_in_state('a.b', 'a')
+        assert states.is_in_state('a', 'a')
+        assert not states.is_in_state('ab', 'a')
+        assert not states.is_in_state('a', 'a.b')
+
+
+class TestHierarchicalTransitions(object):
+
+    @pytest.fixture
+    def shipment(self):
+        return Shipment()
+
+    def test_pattern_source(self, shipment):
+        assert not shipment.delivered.can_proceed()
+        shipment.ship_partial.set()
+        assert shipment.in_state('shipped')
+        assert not shipment.in_state('shipped.full')
+        assert shipment.delivered.can_proceed()
+        shipment.delivered.set()
+        assert shipment.state == 'delivered'
+        assert not shipment.in_state('shipped')
+
+    def test_transition_class(self, shipment):
+        shipment.ship_full.set()
+        shipment.returned.set()
+        assert shipment.state == 'returned'
+
+        shipment = Shipment()
+        shipment.ship_partial.set()
+        # Only sub-states of 'shipped.partial' are matched by the handler
+        assert not shipment.returned.can_proceed()
+
+    def test_listener_patterns(self, shipment):
+        log = []
+
+        def on_change(instance, source, target):
+            log.append((source, target))
+
+        sqlalchemy.event.listen(
+            Shipment, 'after_state_change', on_change,
+            source_state='shipped.*'
+        )
+        try:
+            shipment.ship_partial.set()
+            shipment.ship_full.set()
+            shipment.delivered.set()
+        finally:
+            sqlalchemy.event.remove(
+                Shipment, 'after_state_change', on_change)
+        assert log == [
+            ('shipped.partial', 'shipped.full'),
+            ('shipped.full', 'delivered'),
+        ]
+
+    def test_migration_check(self):
+        migration.check_mapping(Shipment, {'shipped.partial.x': 'shipped.y'})
+        with pytest.raises(exc.SetupError):
+            migration.check_mapping(Shipment, {'shipped.partial': 'lost'})
+
+
+class TestInStateQueries(object):
+
+    @pytest.fixture
+    def shipments(self, session):
+        session.query(Shipment).delete()
+        out = []
+        for state in (
+            'paid', 'shipped', 'shipped.partial', 'shipped.full',
+            'shipped-by-mail', 'shippedx', 'delivered',
+        ):
+            shipment = Shipment()
+            shipment.state = state
+            out.append(shipment)
+        session.add_all(out)
+        session.commit()
+        return out
+
+    def get_states(self, session, *filters):
+        return sorted(
+            el.state for el in session.query(Shipment).filter(*filters))
+
+    def test_in_state(self, session, shipments):
+        assert self.get_states(session, Shipment.in_state('shipped')) == [
+            'shipped', 'shipped.full', 'shipped.partial',
+        ]
+        assert self.get_states(
+            session, Shipment.in_state('shipped.full')
+        ) == ['shipped.full']
+
+    def test_range_scan(self):
+        sql = str(Shipment.in_state('shipped').compile(
+            compile_kwargs={'literal_binds': True}))
+        assert sql == (
+            "hierarchical_shipment.state = 'shipped' OR "
+            "hierarchical_shipment.state >= 'shipped.' AND "
+            "hierarchical_shipment.state < 'shipped/'"
+        )
+        assert Shipment.in_state('shipped') is Shipment.in_state('shipped')
+
+    def test_applicable(self, session, shipments):
+        assert self.get_states(session, Shipment.delivered.applicable()) == [
+            'shipped.full', 'shipped.partial',
+        ]
+
+    def test_invalid_state(self):
+        with pytest.raises(NotImplementedError):
+            Shipment.in_state('shipped.*')
+        with pytest.raises(NotImplementedError):
+            Shipment.in_state('shipped..partial')
@@ -0,0 +1,107 @@
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import FSMField, transition, coalesce
+from sqlalchemy_fsm.history import History
+
+from tests.conftest import Base
+
+
+history = History(Base.metadata, name='fsm_test_history')
+
+
+class HistoryTicket(Base):
+    __tablename__ = 'history_ticket'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+
+    @transition(source=None, target='open')
+    def opened(self):
+        pass
+
+    @transition(source='open', target='in_progress')
+    def started(self):
+        pass
+
+    @transition(source='in_progress', target='closed')
+    def closed(self):
+        pass
+
+
+history.track(HistoryTicket)
+
+
+def get_rows(session):
+    table = history.table
+    return [
+        (row.model, row.record_id, row.source, row.target)
+        for row in session.execute(
+            sqlalchemy.select([table]).order_by(table.c.id))
+    ]
+
+
+class TestHistory(object):
+
+    @pytest.fixture(autouse=True)
+    def clean(self, session):
+        session.execute(history.table.delete())
+        session.query(HistoryTicket).delete()
+        session.commit()
+
+    def test_recorded(self, session):
+        ticket = HistoryTicket()
+        ticket.opened.set()
+        session.add(ticket)
+        session.flush()
+        ticket.started.set()
+        session.commit()
+
+        ticket.closed.set()
+        session.commit()
+        assert get_rows(session) == [
+            ('HistoryTicket', ticket.id, None, 'open'),
+            ('HistoryTicket', ticket.id, 'open', 'in_progress'),
+            ('HistoryTicket', ticket.id, 'in_progress', 'closed'),
+        ]
+
+    def test_rollback(self, session):
+        ticket = HistoryTicket()
+        session.add(ticket)
+        session.commit()
+        ticket.opened.set()
+        session.flush()
+        session.rollback()
+        ticket.opened.set()
+        session.commit()
+        assert get_rows(session) == [
+            ('HistoryTicket', ticket.id, None, 'open'),
+        ]
+
+    def test_coalesced(self, session):
+        ticket = HistoryTicket()
+        session.add(ticket)
+        session.commit()
+        coalesce.enable(session)
+        try:
+            ticket.opened.set()
+            ticket.started.set()
+            session.commit()
+        finally:
+            coalesce.disable(session)
+        assert get_rows(session) == [
+            ('HistoryTicket', ticket.id, None, 'in_progress'),
+        ]
+
+    def test_monotonic_ids(self, session):
+        tickets = [HistoryTicket() for _ in range(5)]
+        session.add_all(tickets)
+        session.flush()
+        for ticket in tickets:
+            ticket.opened.set()
+        session.commit()
+        ids = [
+            row[0] for row in session.execute(
+                sqlalchemy.select([history.table.c.id]))
+        ]
+        assert len(ids) == 5
+        assert ids == sorted(ids)
@@ -0,0 +1,142 @@
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import FSMField, transition, conditions, exc
+
+from tests.conftest import Base
+
+
+@conditions.hybrid
+def is_reviewed(instance):
+    return instance.reviewed
+
+
+@is_reviewed.expression
+def is_reviewed(cls):
+    return cls.reviewed.is_(True)
+
+
+@conditions.hybrid
+def min_score(instance, score):
+    return instance.score >= score
+
+
+@min_score.expression
+def min_score(cls, score):
+    return cls.score >= score
+
+
+@conditions.hybrid
+def class_min_score(self, instance, score):
+    return instance.score >= score
+
+
+@class_min_score.expression
+def class_min_score(cls, score):
+    return cls.score >= score
+
+
+def python_only(instance):
+    return True
+
+
+class HybridBlogPost(Base):
+    __tablename__ = 'hybrid_blog_post'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    reviewed = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
+    score = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+
+    @transition(source='new', target='published', conditions=[is_reviewed])
+    def published(self):
+        pass
+
+    @transition(source=['new', None], target='ranked', conditions=[
+        min_score,
+    ])
+    def ranked(self, score):
+        pass
+
+    @transition(source='*', target='deleted')
+    def deleted(self):
+        pass
+
+    @transition(source='new', target='hidden', conditions=[python_only])
+    def hidden(self):
+        pass
+
+    @transition(target='featured')
+    class featured(object):
+
+        @transition(source='published', conditions=[class_min_score])
+        def from_published(self, instance, score):
+            pass
+
+        @transition(source='ranked')
+        def from_ranked(self, instance, score):
+            pass
+
+
+class TestApplicable(object):
+
+    @pytest.fixture
+    def records(self, session):
+        session.query(HybridBlogPost).delete()
+        out = {
+            'new_reviewed': HybridBlogPost(
+                state='new', reviewed=True, score=1),
+            'new_unreviewed': HybridBlogPost(state='new', score=10),
+            'none': HybridBlogPost(state=None, score=5),
+            'published_low': HybridBlogPost(state='published', score=1),
+            'published_high': HybridBlogPost(state='published', score=10),
+            'ranked': HybridBlogPost(state='ranked', score=0),
+        }
+        session.add_all(out.values())
+        session.commit()
+        return out
+
+    def names(self, session, records, sql_filter):
+        matched = set(
+            session.query(HybridBlogPost).filter(sql_filter).all())
+        # The SQL filter must agree with the python-side check
+        return set(
+            name for (name, record) in records.items()
+            if record in matched
+        )
+
+    def test_function_transition(self, session, records):
+        assert self.names(
+            session, records, HybridBlogPost.published.applicable()
+        ) == {'new_reviewed'}
+        assert records['new_reviewed'].published.can_proceed()
+        assert not records['new_unreviewed'].published.can_proceed()
+
+    def test_args(self, session, records):
+        assert self.names(
+            session, records, HybridBlogPost.ranked.applicable(5)
+        ) == {'new_unreviewed', 'none'}
+        assert records['none'].ranked.can_proceed(5)
+        assert not records['new_reviewed'].ranked.can_proceed(5)
+
+    def test_any_source(self, session, records):
+        assert self.names(
+            session, records, HybridBlogPost.deleted.applicable()
+        ) == set(records)
+
+    def test_class_transition(self, session, records):
+        assert self.names(
+            session, records, HybridBlogPost.featured.applicable(5)
+        ) == {'published_high', 'ranked'}
+        assert records['published_high'].featured.can_proceed(5)
+        assert not records['published_low'].featured.can_proceed(5)
+
+    def test_python_only_condition(self):
+        with pytest.raises(exc.SetupError) as err:
+            HybridBlogPost.hidden.applicable()
+        assert 'can not be expressed in SQL' in str(err)
+
+    def test_missing_expression(self):
+        condition = conditions.hybrid(python_only)
+        with pytest.raises(exc.SetupError) as err:
+            condition.get_sql(HybridBlogPost, (), {})
+        assert 'has no SQL expression' in str(err)
@@ -0,0 +1,197 @@
+import pytest
+import sqlalchemy
+import sqlalchemy.event
+
+from sqlalchemy_fsm import FSMField, transition, idempotency, exc
+
+from tests.conftest import Base, engine
+
+
+store = idempotency.KeyStore(Base.metadata, max_cached=3)
+
+
+class IdempotentMessage(Base):
+    __tablename__ = 'idempotent_message'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    deliveries = sqlalchemy.Column(sqlalchemy.Integer)
+    blocked = sqlalchemy.Column(sqlalchemy.Boolean)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        self.deliveries = 0
+        self.blocked = False
+        super(IdempotentMessage, self).__init__(*args, **kwargs)
+
+    @transition(source='*', target='delivered')
+    def delivered(self, count=1):
+        self.deliveries += count
+
+    @transition(
+        source='new', target='published',
+        conditions=[lambda instance: not instance.blocked]
+    )
+    def published(self):
+        pass
+
+
+def delivered_key(message, key):
+    return (key, 'IdempotentMessage.delivered', str(message.id))
+
+
+@pytest.fixture
+def installed():
+    old = idempotency.set_store(store)
+    yield store
+    store.clear()
+    idempotency.set_store(old)
+
+
+@pytest.fixture
+def message(session, installed):
+    session.execute(store.table.delete())
+    session.query(IdempotentMessage).delete()
+    out = IdempotentMessage()
+    session.add(out)
+    session.commit()
+    return out
+
+
+@pytest.fixture
+def statements():
+    out = []
+
+    def on_execute(conn, cursor, statement, *args):
+        out.append(statement)
+
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', on_execute)
+    yield out
+    sqlalchemy.event.remove(engine, 'before_cursor_execute', on_execute)
+
+
+class TestIdempotencyKeys(object):
+
+    def test_same_transaction(self, session, message):
+        message.delivered.set(2, idempotency_key='m-1')
+        message.delivered.set(2, idempotency_key='m-1')
+        assert message.deliveries == 2
+        message.delivered.set(idempotency_key='m-2')
+        assert message.deliveries == 3
+        session.commit()
+        assert session.query(store.table).count() == 2
+
+    def test_cached_after_commit(self, session, message, statements):
+        message.delivered.set(idempotency_key='m-1')
+        session.commit()
+
+        del statements[:]
+        # Expired state is not loaded either
+        message.delivered.set(idempotency_key='m-1')
+        assert statements == []
+        assert store.hits == 1
+        assert message.deliveries == 1
+
+    def test_committed_elsewhere(self, session, message, statements):
+        message.delivered.set(idempotency_key='m-1')
+        session.commit()
+        # As if it was committed by another process
+        store.clear()
+
+        del statements[:]
+        message.delivered.set(idempotency_key='m-1')
+        assert len(statements) == 1
+        assert statements[0].startswith('INSERT INTO fsm_idempotency_key')
+        assert message.deliveries == 1
+
+    def test_plain_set(self, message):
+        message.delivered.set()
+        message.delivered.set()
+        assert message.deliveries == 2
+
+    def test_failure_releases_key(self, session, message):
+        message.blocked = True
+        with pytest.raises(exc.PreconditionError):
+            message.published.set(idempotency_key='p-1')
+        message.blocked = False
+        message.published.set(idempotency_key='p-1')
+        assert message.state == 'published'
+        with pytest.raises(exc.InvalidSourceStateError):
+            message.published.set()
+        message.published.set(idempotency_key='p-1')
+        session.commit()
+
+    def test_rollback(self, session, message):
+        message.delivered.set(idempotency_key='m-1')
+        session.rollback()
+        assert not store.is_cached(delivered_key(message, 'm-1'))
+
+        message.delivered.set(idempotency_key='m-1')
+        assert message.deliveries == 1
+        session.commit()
+        assert store.is_cached(delivered_key(message, 'm-1'))
+
+    def test_savepoint_release(self, session, message):
+        session.begin_nested()
+        message.delivered.set(idempotency_key='m-1')
+        session.commit()  # Releases the savepoint
+        assert not store.is_cached(delivered_key(message, 'm-1'))
+        session.rollback()
+        assert not store.is_cached(delivered_key(message, 'm-1'))
+
+        message.delivered.set(idempotency_key='m-1')
+        assert message.deliveries == 1
+        session.commit()
+        assert store.is_cached(delivered_key(message, 'm-1'))
+
+    def test_scoped_to_record(self, session, message):
+        other = IdempotentMessage()
+        session.add(other)
+        session.commit()
+        message.delivered.set(idempotency_key='m-1')
+        other.delivered.set(idempotency_key='m-1')
+        session.commit()
+        assert (message.deliveries, other.deliveries) == (1, 1)
+        other.delivered.set(idempotency_key='m-1')
+        assert other.deliveries == 1
+
+    def test_scoped_to_transition(self, session, message):
+        message.delivered.set(idempotency_key='m-1')
+        message.state = 'new'
+        message.published.set(idempotency_key='m-1')
+        assert message.state == 'published'
+        session.commit()
+        assert session.query(store.table).count() == 2
+
+    def test_new_record(self, session, installed):
+        message = IdempotentMessage()
+        session.add(message)
+        message.delivered.set(idempotency_key='m-1')
+        assert message.id is not None
+        message.delivered.set(idempotency_key='m-1')
+        assert message.deliveries == 1
+        session.rollback()
+
+    def test_lru(self, session, message):
+        for idx in range(5):
+            message.delivered.set(idempotency_key='m-{}'.format(idx))
+        session.commit()
+        assert list(store.cached) == [
+            delivered_key(message, 'm-{}'.format(idx)) for idx in (2, 3, 4)
+        ]
+        # Evicted keys are still in the table
+        message.delivered.set(idempotency_key='m-0')
+        assert message.deliveries == 5
+
+
+class TestSetup(object):
+
+    def test_no_store(self, session):
+        message = IdempotentMessage()
+        session.add(message)
+        with pytest.raises(exc.SetupError):
+            message.delivered.set(idempotency_key='x')
+        session.rollback()
+
+    def test_no_session(self, installed):
+        with pytest.raises(exc.SetupError):
+            IdempotentMessage().delivered.set(idempotency_key='x')
@@ -0,0 +1,39 @@
+import sqlalchemy
+
+from tests import loadtest
+from tests.test_performance import Benchmarked
+
+
+class TestLoadTest(object):
+
+    def test_run(self, tmpdir):
+        url = 'sqlite:///{}'.format(tmpdir.join('load.db'))
+        report = loadtest.run(
+            url, workers=2, operations=20, records=5,
+            mix={'set': 1, 'claim': 1, 'query': 1},
+        )
+        assert report['operations'] == 40
+        assert sum(
+            el['count'] for el in report['by_operation'].values()) == 40
+        assert report['mismatched_records'] == 0
+        assert 0 <= report['conflict_rate'] <= 1
+        assert report['by_operation']['query']['outcomes'] == {
+            'ok': report['by_operation']['query']['count']}
+
+    def test_lost_update_detection(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        Benchmarked.__table__.create(engine)
+        loadtest.log_table.create(engine)
+        with engine.connect() as connection:
+            connection.execute(Benchmarked.__table__.insert(), [
+                {'id': 1, 'state': 'hidden'},
+                {'id': 2, 'state': 'published'},
+            ])
+            connection.execute(loadtest.log_table.insert(), [
+                {'record_id': 1, 'source': 'new', 'target': 'published'},
+                # Based on an overwritten state
+                {'record_id': 1, 'source': 'new', 'target': 'hidden'},
+                {'record_id': 2, 'source': 'new', 'target': 'published'},
+            ])
+            assert loadtest.find_lost_updates(
+                connection, Benchmarked, 'new') == (1, 0)
@@ -0,0 +1,183 @@
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import FSMField, transition, migration, exc
+
+from tests.conftest import Base, engine
+
+
+class RemappedPost(Base):
+    __tablename__ = 'remapped_post'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+
+    @transition(source='new', target='published')
+    def published(self):
+        pass
+
+    @transition(source=['published', 'new'], target='archived')
+    def archived(self):
+        pass
+
+
+remapped_history = sqlalchemy.Table(
+    'remapped_post_history', Base.metadata,
+    sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('source', FSMField),
+    sqlalchemy.Column('target', FSMField),
+    sqlalchemy.Column('model', sqlalchemy.String),
+)
+
+remapped_counters = sqlalchemy.Table(
+    'remapped_post_counters', Base.metadata,
+    sqlalchemy.Column('state', FSMField, primary_key=True),
+    sqlalchemy.Column('count', sqlalchemy.Integer),
+)
+
+
+class TestCheckMapping(object):
+
+    def test_unknown_target(self):
+        with pytest.raises(exc.SetupError) as err:
+            migration.check_mapping(RemappedPost, {'hidden': 'gone'})
+        assert "['gone'] are not used by any transition" in str(err)
+
+    def test_empty(self):
+        with pytest.raises(exc.SetupError):
+            migration.check_mapping(RemappedPost, {})
+
+    @pytest.mark.parametrize('mapping', [
+        {'hidden': 'new', 'new': 'archived'},
+        {'new': 'published', 'published': 'new'},
+    ])
+    def test_chained(self, mapping):
+        with pytest.raises(exc.SetupError) as err:
+            migration.check_mapping(RemappedPost, mapping)
+        assert 'split the mapping' in str(err)
+        # Not even with the check off
+        with pytest.raises(exc.SetupError):
+            migration.remap_states(engine, RemappedPost, mapping, check=False)
+
+    def test_old_state_still_used(self):
+        with pytest.warns(UserWarning) as warn:
+            migration.check_mapping(RemappedPost, {'new': 'archived'})
+        assert "['new'] are remapped" in str(warn.list[0].message)
+
+
+class TestRemapStates(object):
+
+    @pytest.fixture
+    def populated(self, session):
+        session.query(RemappedPost).delete()
+        session.execute(remapped_history.delete())
+        session.execute(remapped_counters.delete())
+        states = ['hidden', 'new', 'deleted', 'published'] * 10
+        session.add_all([RemappedPost(state=state) for state in states])
+        session.execute(remapped_history.insert(), [
+            {'source': 'new', 'target': 'hidden'},
+            {'source': 'hidden', 'target': 'deleted'},
+        ])
+        session.execute(remapped_counters.insert(), [
+            {'state': 'hidden', 'count': 10},
+            {'state': 'deleted', 'count': 10},
+            {'state': 'archived', 'count': 1},
+            {'state': 'new', 'count': 10},
+        ])
+        session.commit()
+        return states
+
+    def get_states(self, session):
+        return sorted(
+            state for (state, ) in session.query(RemappedPost.state))
+
+    def test_remap(self, session, populated):
+        chunks = []
+        result = migration.remap_states(
+            engine, RemappedPost,
+            {'hidden': 'archived', 'deleted': 'archived'},
+            chunk_size=3,
+            related=[remapped_history.c.source, remapped_history.c.target],
+            counters=[(remapped_counters.c.state, remapped_counters.c.count)],
+            on_chunk=lambda column, pk, count: chunks.append(count),
+        )
+        assert result == {
+            'remapped_post.state': 20,
+            'remapped_post_history.source': 1,
+            'remapped_post_history.target': 2,
+        }
+        assert sum(chunks) == 23
+        assert max(chunks) == 3
+
+        session.expire_all()
+        assert self.get_states(session) == sorted(
+            ['archived'] * 20 + ['new', 'published'] * 10)
+        assert sorted(session.execute(
+            sqlalchemy.select([
+                remapped_history.c.source, remapped_history.c.target])
+        ).fetchall()) == [('archived', 'archived'), ('new', 'archived')]
+        assert sorted(session.execute(
+            sqlalchemy.select([remapped_counters])
+        ).fetchall()) == [('archived', 21), ('new', 10)]
+
+    def test_resume(self, session, populated):
+        first_run = []
+
+        def interrupt(column, pk, count):
+            first_run.append(count)
+            if len(first_run) == 2:
+                raise KeyboardInterrupt()
+
+        with pytest.raises(KeyboardInterrupt):
+            migration.remap_states(
+                engine, RemappedPost, {'hidden': 'archived'},
+                chunk_size=4, on_chunk=interrupt,
+            )
+        session.expire_all()
+        assert self.get_states(session).count('archived') == 8
+
+        # Restart from scratch - already remapped rows are skipped
+        result = migration.remap_states(
+            engine, RemappedPost, {'hidden': 'archived'}, chunk_size=4)
+        assert result == {'remapped_post.state': 2}
+        session.expire_all()
+        assert self.get_states(session).count('archived') == 10
+        assert 'hidden' not in self.get_states(session)
+
+    def test_identity_entries_skipped(self, session, populated):
+        result = migration.remap_states(
+            engine, RemappedPost, {'hidden': 'archived', 'new': 'new'},
+            check=False,
+        )
+        assert result == {'remapped_post.state': 10}
+        assert migration.remap_column(
+            engine, RemappedPost.__table__.c.state,
+            RemappedPost.__table__.c.id, {'new': 'new'}
+        ) == 0
+
+    def test_related_criteria(self, session, populated):
+        session.execute(remapped_history.update().values(model='RemappedPost'))
+        session.execute(remapped_history.insert(), [
+            {'source': 'hidden', 'target': 'new', 'model': 'Other'},
+        ])
+        session.commit()
+        model_rows = remapped_history.c.model == 'RemappedPost'
+        result = migration.remap_states(
+            engine, RemappedPost, {'hidden': 'archived'},
+            related=[
+                (remapped_history.c.source, model_rows),
+                (remapped_history.c.target, model_rows),
+            ],
+        )
+        assert result == {
+            'remapped_post.state': 10,
+            'remapped_post_history.source': 1,
+            'remapped_post_history.target': 1,
+        }
+        assert sorted(session.execute(sqlalchemy.select([
+            remapped_history.c.model, remapped_history.c.source,
+            remapped_history.c.target,
+        ])).fetchall()) == [
+            ('Other', 'hidden', 'new'),
+            ('RemappedPost', 'archived', 'deleted'),
+            ('RemappedPost', 'new', 'archived'),
+        ]
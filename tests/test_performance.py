@@ -1,9 +1,12 @@
 import gc
+import time
 import pytest
 import sqlalchemy
 
 import sqlalchemy_fsm
 
+from sqlalchemy_fsm import side_table, statements, simulation
+
 from tests.conftest import Base
 
 
@@ -93,3 +96,204 @@ class TestPerformanceSimple(object):
             # model.cls_move.set()
 
         benchmark.pedantic(set_fn, rounds=10000)
+
+
+@pytest.mark.skip
+class TestPerformanceMemory(object):
+
+    record_count = 1000000
+
+    @pytest.fixture
+    def records(self, session):
+        session.query(Benchmarked).delete()
+        session.bulk_insert_mappings(Benchmarked, [
+            {'state': 'new'} for idx in range(self.record_count)
+        ])
+        session.commit()
+        return session.query(Benchmarked).all()
+
+    def test_bytes_per_record(self, records):
+        import tracemalloc
+
+        # Warm up class-level caches
+        records[0].published.can_proceed()
+        records[0].cls_move.can_proceed()
+        gc.collect()
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        handles = []
+        for record in records:
+            record.published()
+            record.cls_move.can_proceed()
+            handles.append(record.published._sa_fsm_bound_meta)
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        allocated = sum(
+            stat.size_diff for stat in after.compare_to(before, 'filename')
+            if 'sqlalchemy_fsm' in str(stat.traceback)
+        )
+        per_record = float(allocated) / len(records)
+        print("FSM bytes per record: {:.3f}".format(per_record))
+        assert len(set(id(handle) for handle in handles)) == 1
+        assert per_record < 1
+
+
+wide_columns = [
+    sqlalchemy.Column('field_{}'.format(idx), sqlalchemy.Text)
+    for idx in range(30)
+]
+
+
+class BenchmarkedWide(Base):
+    __table__ = sqlalchemy.Table(
+        'benchmark_wide', Base.metadata,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column('state', sqlalchemy_fsm.FSMField),
+        *[col.copy() for col in wide_columns]
+    )
+
+    @sqlalchemy_fsm.transition(source='*', target='published')
+    def published(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='*', target='hidden')
+    def hidden(self):
+        pass
+
+
+class BenchmarkedSideTable(Base):
+    __table__ = side_table.join(sqlalchemy.Table(
+        'benchmark_side', Base.metadata,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        *[col.copy() for col in wide_columns]
+    ))
+    id = side_table.pk_property(__table__)
+
+    @sqlalchemy_fsm.transition(source='*', target='published')
+    def published(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='*', target='hidden')
+    def hidden(self):
+        pass
+
+
+@pytest.mark.skip
+class TestPerformanceSideTable(object):
+    """State update throughput of a wide row vs. a narrow side table.
+
+    Use a file-backed database, with `:memory:` SQLite
+    the row size hardly matters. Records are not expired on commit,
+    so that row reloads are not measured.
+    """
+
+    record_count = 1000
+
+    @pytest.fixture(params=[BenchmarkedWide, BenchmarkedSideTable])
+    def records(self, request, session):
+        model = request.param
+        session.expire_on_commit = False
+        out = []
+        for _ in range(self.record_count):
+            record = model(state='new')
+            for col in wide_columns:
+                setattr(record, col.name, 'x' * 200)
+            out.append(record)
+        session.add_all(out)
+        session.commit()
+        return out
+
+    def test_update_throughput(self, benchmark, session, records):
+
+        def update_fn():
+            for record in records:
+                if record.published():
+                    record.hidden.set()
+                else:
+                    record.published.set()
+            session.commit()
+
+        benchmark.pedantic(update_fn, rounds=20)
+
+
+def _sleeping_guard(instance):
+    time.sleep(0.02)
+    return True
+
+
+class BenchmarkedGuards(Base):
+    __tablename__ = 'benchmark_guards'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(sqlalchemy_fsm.FSMField)
+
+    @sqlalchemy_fsm.transition(
+        source='*', target='sequential', conditions=[_sleeping_guard] * 5)
+    def sequential(self):
+        pass
+
+    @sqlalchemy_fsm.transition(
+        source='*', target='concurrent',
+        conditions=[sqlalchemy_fsm.conditions.concurrent(_sleeping_guard)] * 5
+    )
+    def concurrent(self):
+        pass
+
+
+@pytest.mark.skip
+class TestPerformanceConcurrentConditions(object):
+    """Five 20ms I/O-bound guards: ~100ms in sequence, ~20ms on the pool."""
+
+    @pytest.mark.parametrize('name', ['sequential', 'concurrent'])
+    def test_can_proceed(self, benchmark, name):
+        record = BenchmarkedGuards()
+        benchmark.pedantic(
+            lambda: getattr(record, name).can_proceed(), rounds=50)
+
+
+@pytest.mark.skip
+class TestPerformanceCompiledCache(object):
+    """Statement-compile overhead per transition: a state UPDATE
+    executed with and without the compiled cache."""
+
+    @pytest.fixture(params=[True, False], ids=['cached', 'compiled'])
+    def compiled_cache(self, request):
+        new = statements.CompiledCache() if request.param else None
+        old = statements.set_compiled_cache(new)
+        yield new
+        statements.set_compiled_cache(old)
+
+    def test_state_update(self, benchmark, session, compiled_cache):
+        record = Benchmarked()
+        session.add(record)
+        session.commit()
+        table = Benchmarked.__table__
+        update = table.update().where(
+            table.c.id == sqlalchemy.bindparam('sa_fsm_pk'))
+        states = ['published', 'hidden']
+
+        def update_fn():
+            states.reverse()
+            statements.execute(
+                session, update, dict(state=states[0], sa_fsm_pk=record.id))
+
+        benchmark.pedantic(update_fn, rounds=10000)
+        session.commit()
+
+
+@pytest.mark.skip
+class TestPerformanceReplay(object):
+    """Offline replay throughput (events per second = 1M / round time)."""
+
+    def test_replay(self, benchmark):
+        machine = simulation.Machine(Benchmarked)
+        names = ['published', 'hidden', 'cls_move']
+        events = [
+            (idx % 10000, names[idx % len(names)])
+            for idx in range(1000000)
+        ]
+        report = benchmark.pedantic(
+            lambda: machine.replay(events, initial='new'), rounds=5)
+        assert report.events == len(events)
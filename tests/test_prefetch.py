@@ -0,0 +1,208 @@
+import pytest
+import sqlalchemy
+import sqlalchemy.event
+
+from sqlalchemy.orm import relationship
+
+from sqlalchemy_fsm import FSMField, transition, stream, batch, exc
+from sqlalchemy_fsm.transition import get_prefetch_paths
+
+from tests.conftest import Base, engine
+
+
+def customer_not_blocked(instance):
+    return not instance.customer.is_blocked
+
+
+def has_items(instance):
+    return len(instance.items) > 0
+
+
+class PrefetchCustomer(Base):
+    __tablename__ = 'prefetch_customer'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    is_blocked = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
+
+
+class PrefetchOrder(Base):
+    __tablename__ = 'prefetch_order'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    customer_id = sqlalchemy.Column(
+        sqlalchemy.Integer, sqlalchemy.ForeignKey(PrefetchCustomer.id))
+    total = sqlalchemy.Column(sqlalchemy.Integer)
+
+    customer = relationship(PrefetchCustomer)
+    items = relationship('PrefetchItem', order_by='PrefetchItem.id')
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(PrefetchOrder, self).__init__(*args, **kwargs)
+
+    @transition(
+        source='new', target='accepted',
+        conditions=[customer_not_blocked, has_items],
+        prefetch=['customer', 'items'],
+    )
+    def accepted(self):
+        self.total = sum(item.price for item in self.items)
+
+    @transition(source='new', target='rejected')
+    def rejected(self):
+        pass
+
+
+class PrefetchItem(Base):
+    __tablename__ = 'prefetch_item'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    order_id = sqlalchemy.Column(
+        sqlalchemy.Integer, sqlalchemy.ForeignKey(PrefetchOrder.id))
+    price = sqlalchemy.Column(sqlalchemy.Integer)
+
+
+class PrefetchTransitions(object):
+
+    @transition(target='reviewed', prefetch=['customer'])
+    def from_new(self):
+        pass
+
+    @transition(target='reviewed', prefetch=['items', 'customer'])
+    def from_accepted(self):
+        pass
+
+
+class PrefetchReviewedOrder(Base):
+    __tablename__ = 'prefetch_reviewed_order'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+
+    @transition(source=['new', 'accepted'], target='reviewed')
+    def reviewed(self):
+        pass
+
+    @transition(source='*', target='reviewed')
+    class reviewed_multi(PrefetchTransitions):
+        pass
+
+
+class TestDeclaration(object):
+
+    def test_meta(self):
+        meta = PrefetchOrder.accepted._sa_fsm_meta
+        assert meta.prefetch == ('customer', 'items')
+        assert PrefetchOrder.rejected._sa_fsm_meta.prefetch == ()
+
+    def test_class_merged(self):
+        bound = PrefetchReviewedOrder().reviewed_multi
+        assert sorted(
+            handler.meta.prefetch
+            for handler in bound._sa_fsm_bound_meta.bound_sub_metas
+        ) == [('customer', ), ('items', 'customer')]
+        paths = get_prefetch_paths(PrefetchReviewedOrder.reviewed_multi)
+        assert sorted(paths) == ['customer', 'items']
+
+    @pytest.mark.parametrize(
+        'value', [7, 'customer', ['customer', 7], ['a..b']])
+    def test_invalid_type(self, value):
+        with pytest.raises(NotImplementedError):
+            transition(source='*', target='a', prefetch=value)(
+                lambda self: None)
+
+    def test_unknown_relationship(self, session):
+        class PrefetchBroken(Base):
+            __tablename__ = 'prefetch_broken'
+            id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+            state = sqlalchemy.Column(FSMField)
+
+            @transition(source='*', target='a', prefetch=['owner'])
+            def to_a(self):
+                pass
+
+        with pytest.raises(exc.SetupError) as err:
+            stream.apply(
+                session, session.query(PrefetchBroken),
+                PrefetchBroken.to_a
+            )
+        assert 'owner' in str(err)
+
+
+class TestPrefetch(object):
+
+    @pytest.fixture
+    def orders(self, session):
+        session.query(PrefetchItem).delete()
+        session.query(PrefetchOrder).delete()
+        session.query(PrefetchCustomer).delete()
+        customers = [
+            PrefetchCustomer(is_blocked=(idx % 3 == 0)) for idx in range(5)
+        ]
+        out = [
+            PrefetchOrder(customer=customers[idx % 5]) for idx in range(20)
+        ]
+        for (idx, order) in enumerate(out):
+            order.items = [
+                PrefetchItem(price=price) for price in range(idx % 4)
+            ]
+        session.add_all(out)
+        session.commit()
+        return dict(
+            (order.id, (
+                not order.customer.is_blocked and bool(order.items),
+                sum(item.price for item in order.items)
+            ))
+            for order in out
+        )
+
+    @pytest.fixture
+    def statements(self):
+        out = []
+
+        def on_execute(conn, cursor, statement, *args):
+            out.append(statement)
+
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', on_execute)
+        yield out
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', on_execute)
+
+    def check_result(self, session, orders):
+        session.expire_all()
+        for record in session.query(PrefetchOrder):
+            (accepted, total) = orders[record.id]
+            if accepted:
+                assert record.state == 'accepted'
+                assert record.total == total
+            else:
+                assert record.state == 'new'
+                assert record.total is None
+
+    def test_stream_apply(self, session, orders, statements):
+        progress = stream.apply(
+            session, session.query(PrefetchOrder), PrefetchOrder.accepted,
+            chunk_size=5
+        )
+        assert progress.processed == 20
+        assert progress.chunks == 4
+
+        customer_selects = [
+            stmt for stmt in statements
+            if stmt.startswith('SELECT') and 'FROM prefetch_customer' in stmt
+        ]
+        item_selects = [
+            stmt for stmt in statements
+            if stmt.startswith('SELECT') and 'FROM prefetch_item' in stmt
+        ]
+        # One per chunk, not one per record
+        assert len(customer_selects) == progress.chunks
+        assert len(item_selects) == progress.chunks
+        self.check_result(session, orders)
+
+    def test_batch_run(self, session, orders):
+        result = batch.run(
+            session, session.query(PrefetchOrder), PrefetchOrder.accepted,
+            chunk_size=6, max_workers=2,
+        )
+        session.commit()
+        assert result.processed == 20
+        assert result.changed == sum(
+            1 for (accepted, _) in orders.values() if accepted)
+        self.check_result(session, orders)
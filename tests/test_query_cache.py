@@ -0,0 +1,227 @@
+import pytest
+import sqlalchemy
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+import sqlalchemy_fsm
+
+from sqlalchemy_fsm import query_cache
+
+from tests.conftest import Base, SessionGen
+
+
+class CachedTask(Base):
+    __tablename__ = 'cached_task'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(sqlalchemy_fsm.FSMField)
+    owner = sqlalchemy.Column(sqlalchemy.Integer)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'pending'
+        super(CachedTask, self).__init__(*args, **kwargs)
+
+    @sqlalchemy_fsm.transition(source='*', target='pending')
+    def pending(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='pending', target='running')
+    def running(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='running', target='done')
+    def done(self):
+        pass
+
+
+class TestStateQueryCache(object):
+
+    @pytest.fixture
+    def tasks(self, session):
+        session.query(CachedTask).delete()
+        session.add_all([CachedTask(owner=idx % 2) for idx in range(4)])
+        session.commit()
+        return session.query(CachedTask).order_by(CachedTask.id).all()
+
+    @pytest.fixture
+    def cache(self, session, tasks):
+        out = query_cache.StateQueryCache(max_size=3, sessions=session)
+        yield out
+        out.close()
+
+    @pytest.fixture
+    def statements(self, session):
+        out = []
+
+        def on_execute(conn, cursor, statement, *args):
+            out.append(statement)
+
+        sqlalchemy.event.listen(
+            session.bind, 'before_cursor_execute', on_execute)
+        yield out
+        sqlalchemy.event.remove(
+            session.bind, 'before_cursor_execute', on_execute)
+
+    def ids(self, records):
+        return sorted(record.id for record in records)
+
+    def test_hit(self, session, cache, tasks, statements):
+        first = cache.all(session, CachedTask.pending)
+        assert self.ids(first) == self.ids(tasks)
+        del statements[:]
+
+        other_session = SessionGen()
+        second = cache.all(other_session, CachedTask.pending)
+        assert statements == []
+        assert self.ids(second) == self.ids(tasks)
+        assert all(record in other_session for record in second)
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_state_change(self, session, cache, tasks):
+        cache.all(session, CachedTask.pending)
+        cache.all(session, CachedTask.running)
+        cache.all(session, CachedTask.done)
+
+        tasks[0].running.set()
+        session.flush()
+        # Not committed yet
+        assert len(cache.entries) == 3
+        session.commit()
+
+        # 'done' list is not affected
+        assert [key[1] for key in cache.entries] == ['done']
+        assert self.ids(cache.all(session, CachedTask.running)) == [
+            tasks[0].id]
+        assert self.ids(cache.all(session, CachedTask.pending)) == self.ids(
+            tasks[1:])
+
+    def test_other_column_change(self, session, cache, tasks):
+        criteria = [CachedTask.owner == 1]
+        assert self.ids(cache.all(session, CachedTask.pending, criteria)) \
+            == [tasks[1].id, tasks[3].id]
+        cache.all(session, CachedTask.running)
+
+        tasks[0].owner = 1
+        session.commit()
+        assert [key[1] for key in cache.entries] == ['running']
+        assert len(cache.all(session, CachedTask.pending, criteria)) == 3
+
+    def test_insert_delete(self, session, cache, tasks):
+        cache.all(session, CachedTask.pending)
+        session.add(CachedTask())
+        session.commit()
+        assert len(cache.all(session, CachedTask.pending)) == 5
+
+        session.delete(tasks[0])
+        session.commit()
+        assert len(cache.all(session, CachedTask.pending)) == 4
+        assert cache.misses == 3
+
+    def test_bulk_update(self, session, cache, tasks):
+        cache.all(session, CachedTask.pending)
+        cache.all(session, CachedTask.done)
+        session.query(CachedTask).update({'state': 'done'})
+        session.commit()
+        assert not cache.entries
+        assert len(cache.all(session, CachedTask.done)) == 4
+
+    def test_rollback(self, session, cache, tasks):
+        task = CachedTask()
+        task.state = 'done'
+        session.add(task)
+        session.flush()
+        assert len(cache.all(session, CachedTask.done)) == 1
+        assert not cache.entries
+        session.rollback()
+        assert len(cache.all(SessionGen(), CachedTask.done)) == 0
+
+    def test_rollback_invalidates(self, session, cache, tasks):
+        cache.all(session, CachedTask.running)
+        tasks[0].running.set()
+        session.flush()
+        session.rollback()
+        assert not cache.entries
+        assert self.ids(cache.all(session, CachedTask.running)) == []
+
+    def test_savepoint_release(self, session, cache, tasks):
+        session.begin_nested()
+        tasks[0].running.set()
+        session.commit()  # Releases the savepoint
+        cache.all(SessionGen(), CachedTask.running)
+        assert cache.entries
+        session.commit()
+        assert not cache.entries
+
+    def test_criteria_keys(self, session, cache, tasks):
+        for owner in (0, 1, 0, 1):
+            cache.all(session, CachedTask.pending, [CachedTask.owner == owner])
+        assert (cache.hits, cache.misses) == (2, 2)
+        cache.all(
+            session, CachedTask.pending, order_by=[CachedTask.id.desc()])
+        assert cache.misses == 3
+
+    def test_lru(self, session, cache, tasks):
+        for owner in range(3):
+            cache.all(session, CachedTask.pending, [CachedTask.owner == owner])
+        # Refresh the oldest entry
+        cache.all(session, CachedTask.pending, [CachedTask.owner == 0])
+        cache.all(session, CachedTask.running)
+        assert len(cache.entries) == 3
+        assert [
+            (key[1], [params for (_, params) in key[2][0]])
+            for key in cache.entries
+        ] == [
+            ('pending', [(('owner_1', 2), )]),
+            ('pending', [(('owner_1', 0), )]),
+            ('running', []),
+        ]
+
+    def test_caller_key(self, session, cache, tasks, monkeypatch):
+        criteria = [CachedTask.owner == 0]
+        cache.all(session, CachedTask.pending, criteria, key='owner-0')
+        # Not compiled for the key
+        monkeypatch.setattr(query_cache, 'criteria_key', None)
+        assert self.ids(cache.all(
+            session, CachedTask.pending, [CachedTask.owner == 0],
+            key='owner-0'
+        )) == [tasks[0].id, tasks[2].id]
+        assert cache.hits == 1
+
+    def test_clause_compiled_once(self, session, cache, tasks, monkeypatch):
+        criteria = [CachedTask.owner == 1]
+        cache.all(session, CachedTask.pending, criteria)
+        calls = []
+        compile_fn = type(criteria[0]).compile
+
+        def counted(*args, **kwargs):
+            calls.append(args)
+            return compile_fn(*args, **kwargs)
+
+        monkeypatch.setattr(type(criteria[0]), 'compile', counted)
+        cache.all(session, CachedTask.pending, criteria)
+        assert calls == []
+        assert cache.hits == 1
+
+    def test_local_edit_kept(self, session, cache, tasks):
+        cache.all(SessionGen(), CachedTask.pending)
+        tasks[0].owner = 10
+        # Unflushed change of the model - the cache is bypassed
+        out = cache.all(session, CachedTask.pending)
+        assert tasks[0] in out
+        assert tasks[0].owner == 10
+        assert cache.hits == 0
+
+    def test_own_flushed_changes(self, session, cache, tasks):
+        assert cache.all(SessionGen(), CachedTask.running) == []
+        tasks[0].running.set()
+        session.flush()
+        assert cache.all(session, CachedTask.running) == [tasks[0]]
+        assert cache.hits == 0
+
+    def test_identity_map_kept(self, session, cache, tasks):
+        cache.all(SessionGen(), CachedTask.pending)
+        set_committed_value(tasks[0], 'owner', 99)
+        out = cache.all(session, CachedTask.pending)
+        assert cache.hits == 1
+        assert tasks[0] in out
+        assert tasks[0].owner == 99
+        assert not session.dirty
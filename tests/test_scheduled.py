@@ -0,0 +1,184 @@
+import datetime
+
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import (
+    FSMField, FSMTimestamp, transition, scheduled, exc,
+)
+
+from tests.conftest import Base
+
+
+def is_expirable(instance):
+    return instance.note != 'keep'
+
+
+class ExpiringOrder(Base):
+    __tablename__ = 'expiring_order'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    state_changed_at = sqlalchemy.Column(FSMTimestamp)
+    note = sqlalchemy.Column(sqlalchemy.String)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(ExpiringOrder, self).__init__(*args, **kwargs)
+
+    @transition(source='new', target='pending')
+    def pending(self):
+        pass
+
+    @transition(source='pending', target='pending')
+    def touched(self):
+        pass
+
+    @transition(
+        source='pending', target='expired',
+        after=datetime.timedelta(days=7), conditions=[is_expirable]
+    )
+    def expired(self):
+        if self.note == 'broken':
+            raise ValueError('Can not expire')
+        self.note = 'expired'
+
+
+class TestStateTimestamp(object):
+
+    def test_maintained(self):
+        before = datetime.datetime.utcnow()
+        order = ExpiringOrder()
+        created_at = order.state_changed_at
+        assert created_at >= before
+
+        order.pending.set()
+        pending_at = order.state_changed_at
+        assert pending_at >= created_at
+
+        # Self-loop does not reset the time spent in the state
+        order.touched.set()
+        assert order.state_changed_at is pending_at
+
+        order.state = 'expired'
+        assert order.state_changed_at >= pending_at
+
+    def test_index_created(self):
+        indexes = dict(
+            (index.name, [col.name for col in index.columns])
+            for index in ExpiringOrder.__table__.indexes
+        )
+        assert indexes == {
+            'ix_expiring_order_state_state_changed_at': [
+                'state', 'state_changed_at'],
+        }
+
+    def test_invalid_after(self):
+        with pytest.raises(NotImplementedError):
+            transition(source='*', target='a', after=7)(lambda self: None)
+
+
+class TestSweep(object):
+
+    now = datetime.datetime(2020, 1, 10)
+
+    @pytest.fixture
+    def orders(self, session):
+        session.query(ExpiringOrder).delete()
+        out = []
+        for (days_ago, state, note) in [
+            (10, 'pending', None),
+            (8, 'pending', None),
+            (8, 'pending', 'keep'),
+            (6, 'pending', None),
+            (10, 'new', None),
+            (10, 'pending', None),
+        ]:
+            order = ExpiringOrder(note=note)
+            order.state = state
+            order.state_changed_at = self.now - datetime.timedelta(
+                days=days_ago)
+            out.append(order)
+        session.add_all(out)
+        session.commit()
+        return [order.id for order in out]
+
+    def get_orders(self, session, ids):
+        session.expire_all()
+        return [session.query(ExpiringOrder).get(pk) for pk in ids]
+
+    def test_sweep(self, session, orders):
+        result = scheduled.sweep(
+            session, ExpiringOrder.expired, now=self.now, batch_size=2)
+        assert (result.applied, result.rejected, result.conflicts) == \
+            (3, 1, 0)
+        assert result.batches == 2
+
+        records = self.get_orders(session, orders)
+        assert [el.state for el in records] == [
+            'expired', 'expired', 'pending', 'pending', 'new', 'expired']
+        assert records[0].note == 'expired'
+        assert records[0].state_changed_at >= self.now
+
+        # Nothing left to do
+        result = scheduled.sweep(
+            session, ExpiringOrder.expired, now=self.now)
+        assert (result.applied, result.rejected) == (0, 1)
+
+    def test_max_batches(self, session, orders):
+        result = scheduled.sweep(
+            session, ExpiringOrder.expired, now=self.now,
+            batch_size=1, max_batches=1
+        )
+        assert result.applied == 1
+        assert result.batches == 1
+
+    def test_batch_size_not_cached(self, session, orders):
+        scheduled.SweepQueryCache.cache.clear()
+        for batch_size in (1, 2, 3):
+            scheduled.sweep(
+                session, ExpiringOrder.expired, now=self.now,
+                batch_size=batch_size, max_batches=1
+            )
+        # First & next batch queries
+        assert len(scheduled.SweepQueryCache.cache) == 2
+
+    def test_cas_conflict(self, session, orders):
+        result = scheduled.SweepResult()
+        table = ExpiringOrder.__table__
+        seen = []
+
+        def on_change(instance, source, target):
+            seen.append(target)
+
+        sqlalchemy.event.listen(ExpiringOrder, 'after_state_change', on_change)
+        try:
+            # Other worker has already moved the record on
+            stale_time = self.now - datetime.timedelta(days=20)
+            scheduled._sweep_record(
+                session, ExpiringOrder, 'expired', result, orders[0],
+                table.c.id,
+                (table.c.state, 'state', 'pending'),
+                (table.c.state_changed_at, 'state_changed_at', stale_time),
+                (), {}
+            )
+        finally:
+            sqlalchemy.event.remove(
+                ExpiringOrder, 'after_state_change', on_change)
+        assert result.conflicts == 1
+        # No handler, no state change listeners
+        assert seen == []
+        assert self.get_orders(session, orders[:1])[0].state == 'pending'
+        assert self.get_orders(session, orders[:1])[0].note is None
+
+    def test_errors_propagate(self, session, orders):
+        record = session.query(ExpiringOrder).get(orders[0])
+        record.note = 'broken'
+        session.commit()
+        with pytest.raises(ValueError):
+            scheduled.sweep(session, ExpiringOrder.expired, now=self.now)
+        session.rollback()
+
+    def test_not_time_based(self, session):
+        with pytest.raises(exc.SetupError) as err:
+            scheduled.sweep(session, ExpiringOrder.pending)
+        assert 'is not a time-based transition' in str(err)
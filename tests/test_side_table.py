@@ -0,0 +1,123 @@
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import transition, side_table, migration, stream, exc
+
+from tests.conftest import Base
+
+
+wide_article_table = sqlalchemy.Table(
+    'wide_article', Base.metadata,
+    sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('title', sqlalchemy.String),
+    sqlalchemy.Column('body', sqlalchemy.Text),
+)
+
+
+class WideArticle(Base):
+    __table__ = side_table.join(wide_article_table)
+    id = side_table.pk_property(__table__)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(WideArticle, self).__init__(*args, **kwargs)
+
+    @transition(source='new', target='published')
+    def published(self):
+        pass
+
+    @transition(source='*', target='hidden')
+    def hidden(self):
+        self.title = 'hidden'
+
+
+class TestSideTable(object):
+
+    state_table = WideArticle.__table__.right
+
+    @pytest.fixture
+    def articles(self, session):
+        session.execute(self.state_table.delete())
+        session.execute(wide_article_table.delete())
+        out = [WideArticle(title='article', body='x' * 100) for _ in range(3)]
+        session.add_all(out)
+        session.commit()
+        return out
+
+    @pytest.fixture
+    def statements(self, session):
+        out = []
+
+        def on_execute(conn, cursor, statement, *args):
+            out.append(statement)
+
+        sqlalchemy.event.listen(
+            session.bind, 'before_cursor_execute', on_execute)
+        yield out
+        sqlalchemy.event.remove(
+            session.bind, 'before_cursor_execute', on_execute)
+
+    def test_state_table(self):
+        assert self.state_table.name == 'wide_article_state'
+        assert [col.name for col in self.state_table.columns] == [
+            'id', 'state']
+        assert sqlalchemy.inspect(WideArticle).primary_key == (
+            wide_article_table.c.id, )
+
+    def test_set(self, session, articles, statements):
+        articles[0].published.set()
+        assert articles[0].state == 'published'
+        assert articles[0].published()
+        session.commit()
+
+        updates = [el for el in statements if el.startswith('UPDATE')]
+        assert updates == [
+            'UPDATE wide_article_state SET state=? '
+            'WHERE wide_article_state.id = ?'
+        ]
+
+        session.expire_all()
+        assert articles[0].state == 'published'
+        assert session.query(WideArticle).filter(
+            WideArticle.published()
+        ).all() == [articles[0]]
+        assert session.query(WideArticle).filter(
+            WideArticle.published.is_(False)
+        ).count() == 2
+
+    def test_both_tables_changed(self, session, articles):
+        articles[1].hidden.set()
+        session.commit()
+        row = session.execute(
+            sqlalchemy.select([
+                wide_article_table.c.title, self.state_table.c.state
+            ]).select_from(WideArticle.__table__).where(
+                wide_article_table.c.id == articles[1].id)
+        ).fetchone()
+        assert tuple(row) == ('hidden', 'hidden')
+
+    def test_stream_and_migration(self, session, articles):
+        progress = stream.apply(
+            session, session.query(WideArticle), WideArticle.published,
+            chunk_size=2
+        )
+        assert progress.succeeded == 3
+
+        with pytest.warns(UserWarning):
+            out = migration.remap_states(
+                session.connection(), WideArticle, {'published': 'hidden'},
+                chunk_size=2,
+            )
+        assert out == {'wide_article_state.state': 3}
+        assert set(
+            el.state for el in session.query(WideArticle)
+        ) == set(['hidden'])
+
+    def test_composite_pk(self):
+        table = sqlalchemy.Table(
+            'composite_wide', sqlalchemy.MetaData(),
+            sqlalchemy.Column('a', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('b', sqlalchemy.Integer, primary_key=True),
+        )
+        with pytest.raises(exc.SetupError):
+            side_table.join(table)
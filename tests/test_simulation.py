@@ -0,0 +1,136 @@
+import pytest
+import sqlalchemy
+
+import sqlalchemy_fsm
+
+from sqlalchemy_fsm import simulation
+
+from tests.conftest import Base
+
+
+def is_paid(instance):
+    return True
+
+
+class SimulatedOrder(Base):
+    __tablename__ = 'simulated_order'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(sqlalchemy_fsm.FSMField)
+
+    @sqlalchemy_fsm.transition(source=None, target='new')
+    def created(self):
+        pass
+
+    @sqlalchemy_fsm.transition(
+        source='new', target='paid', conditions=[is_paid])
+    def paid(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='paid', target='shipped.partial')
+    def ship_partial(self):
+        pass
+
+    @sqlalchemy_fsm.transition(
+        source=['paid', 'shipped.partial'], target='shipped.full')
+    def ship_full(self):
+        pass
+
+    @sqlalchemy_fsm.transition(source='*', target='cancelled')
+    def cancelled(self):
+        pass
+
+    @sqlalchemy_fsm.transition(target='returned')
+    class returned(object):
+
+        @sqlalchemy_fsm.transition(source='shipped.*')
+        def from_shipped(self, instance):
+            pass
+
+        @sqlalchemy_fsm.transition(source=['shipped.full', 'paid'])
+        def from_full(self, instance):
+            pass
+
+
+class TestMachine(object):
+
+    @pytest.fixture
+    def machine(self):
+        return simulation.Machine(SimulatedOrder, states=['legacy'])
+
+    def test_tables(self, machine):
+        assert machine.states == [
+            None, 'cancelled', 'legacy', 'new', 'paid', 'returned',
+            'shipped.full', 'shipped.partial',
+        ]
+        assert machine.step(None, 'created') == 'new'
+        assert machine.step('new', 'created') is None
+        assert machine.step('shipped.partial', 'ship_full') == 'shipped.full'
+        assert machine.step(None, 'cancelled') == 'cancelled'
+        assert machine.step('legacy', 'cancelled') == 'cancelled'
+        assert machine.step('legacy', 'paid') is None
+        # Class transition handlers
+        assert machine.step('shipped.partial', 'returned') == 'returned'
+        assert machine.step('paid', 'returned') == 'returned'
+        # Matched by both handlers
+        assert machine.step('shipped.full', 'returned') is None
+        assert machine.conditional == ['paid']
+
+    def test_replay(self, machine):
+        events = [
+            (1, 'created'), (2, 'created'), (1, 'paid'), (3, 'paid'),
+            (1, 'ship_partial'), (2, 'cancelled'), (2, 'paid'),
+            (1, 'returned'), (3, 'created'),
+        ]
+        report = machine.replay(iter(events))
+        assert report.events == 9
+        assert report.final_states == {
+            1: 'returned', 2: 'cancelled', 3: 'new'}
+        assert report.rejections == {
+            ('paid', None): 1, ('paid', 'cancelled'): 1}
+        assert report.rejected_count == 2
+        assert report.distribution() == {
+            'returned': 1, 'cancelled': 1, 'new': 1}
+
+        # Continued with the next events
+        report = machine.replay(
+            [(3, 'paid'), (4, 'cancelled')], current=report.final_states)
+        assert report.distribution() == {
+            'returned': 1, 'cancelled': 2, 'paid': 1}
+        assert not report.rejections
+
+    def test_initial(self, machine):
+        report = machine.replay(
+            [('a', 'paid'), ('b', 'cancelled')], initial='new')
+        assert report.final_states == {'a': 'paid', 'b': 'cancelled'}
+
+    def test_invalid(self, machine):
+        with pytest.raises(NotImplementedError):
+            machine.replay([(1, 'created'), (1, 'teleported')])
+        with pytest.raises(NotImplementedError):
+            machine.replay([], initial='unknown')
+
+
+class TestDefinition(object):
+
+    def test_machine(self):
+        from tests.test_definition import workflows
+
+        machine = simulation.Machine.from_definition(
+            workflows.get('wholesale'))
+        assert sorted(machine.tables) == ['reopen', 'ship']
+        assert machine.conditional == ['ship']
+        assert machine.states == [None, 'draft', 'new', 'shipped']
+        report = machine.replay(
+            [(1, 'ship'), (2, 'ship'), (1, 'reopen'), (2, 'ship')],
+            current={1: 'new', 2: 'draft'}
+        )
+        assert report.final_states == {1: 'shipped', 2: 'shipped'}
+        assert report.rejections == {
+            ('reopen', 'shipped'): 1, ('ship', 'shipped'): 1}
+
+        machine = simulation.Machine.from_definition(
+            workflows.get('retail'), states=['legacy'])
+        assert machine.step('paid', 'ship_partially') == 'shipped.partial'
+        assert 'legacy' in machine.codes
+        with pytest.raises(NotImplementedError):
+            machine.replay([(1, 'reopen')])
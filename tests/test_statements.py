@@ -0,0 +1,103 @@
+import datetime
+
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import (
+    FSMField, FSMTimestamp, transition, scheduled, statements, query_cache,
+    util,
+)
+
+from tests.conftest import Base
+
+
+class StaleInvoice(Base):
+    __tablename__ = 'statements_stale_invoice'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    state_changed_at = sqlalchemy.Column(FSMTimestamp)
+
+    @transition(source='*', target='open')
+    def open(self):
+        pass
+
+    @transition(
+        source='open', target='overdue', after=datetime.timedelta(days=30))
+    def overdue(self):
+        pass
+
+
+class TestCompiledCache(object):
+
+    @pytest.fixture
+    def cache(self):
+        out = statements.CompiledCache(max_size=10)
+        old = statements.set_compiled_cache(out)
+        yield out
+        statements.set_compiled_cache(old)
+
+    def test_lru(self):
+        cache = statements.CompiledCache(max_size=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        assert cache.get('a') == 1
+        cache['c'] = 3
+        assert list(cache.compiled) == ['a', 'c']
+        assert cache.get('b') is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_invalid_size(self):
+        with pytest.raises(NotImplementedError):
+            statements.CompiledCache(0)
+
+    def test_reused(self, session, cache):
+        table = StaleInvoice.__table__
+        query = sqlalchemy.select([table.c.id]).where(
+            table.c.state == sqlalchemy.bindparam('state'))
+        for state in ('open', 'overdue', 'open'):
+            statements.execute(session, query, dict(state=state)).fetchall()
+        assert len(cache) == 1
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    def test_disabled(self, session, cache):
+        statements.set_compiled_cache(None)
+        query = sqlalchemy.select([StaleInvoice.__table__.c.id])
+        assert statements.execute(session, query).fetchall() is not None
+        assert (len(cache), cache.misses) == (0, 0)
+
+    def test_pk_chunks(self, session, cache):
+        session.query(StaleInvoice).delete()
+        invoices = [StaleInvoice(state='open') for _ in range(4)]
+        session.add_all(invoices)
+        session.commit()
+        chunks = list(util.iter_pk_chunks(
+            session.query(StaleInvoice), StaleInvoice.__table__.c.id, 1))
+        assert chunks == [[invoice.id] for invoice in invoices]
+        # Compiled once: the first chunk & the next ones
+        assert (cache.hits, cache.misses) == (3, 2)
+
+    def test_sweep(self, session, cache):
+        session.query(StaleInvoice).delete()
+        now = datetime.datetime(2020, 3, 1)
+        for days_ago in (40, 35, 10):
+            invoice = StaleInvoice(state='open')
+            invoice.state_changed_at = now - datetime.timedelta(
+                days=days_ago)
+            session.add(invoice)
+        session.commit()
+
+        state_cache = query_cache.StateQueryCache()
+        try:
+            assert len(state_cache.all(session, StaleInvoice.open)) == 3
+            for day in (0, 1):
+                result = scheduled.sweep(
+                    session, StaleInvoice.overdue, batch_size=1,
+                    now=now + datetime.timedelta(days=day)
+                )
+            # Compiled once: first batch, next batches & the claim update
+            assert (result.applied, cache.misses) == (0, 3)
+            assert cache.hits > 0
+            # Cached results are invalidated by the swept records
+            assert len(state_cache.all(session, StaleInvoice.open)) == 1
+        finally:
+            state_cache.close()
@@ -0,0 +1,105 @@
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import FSMField, transition, stream, exc
+
+from tests.conftest import Base
+
+
+class StreamedRecord(Base):
+    __tablename__ = 'streamed_record'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+    note = sqlalchemy.Column(sqlalchemy.String)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(StreamedRecord, self).__init__(*args, **kwargs)
+
+    @transition(source=['new', 'hidden'], target='archived')
+    def archived(self, note):
+        if self.id % 5 == 0:
+            self.note = 'should not be saved'
+            raise ValueError('Can not archive {}'.format(self.id))
+        self.note = note
+
+    @transition(source='new', target='hidden')
+    def hidden(self):
+        pass
+
+
+class TestStreamApply(object):
+
+    @pytest.fixture
+    def records(self, session):
+        session.query(StreamedRecord).delete()
+        out = [StreamedRecord() for idx in range(23)]
+        session.add_all(out)
+        session.commit()
+        return [el.id for el in out]
+
+    def test_apply(self, session, records):
+        reports = []
+        progress = stream.apply(
+            session, session.query(StreamedRecord),
+            StreamedRecord.archived, args=('done', ),
+            chunk_size=5,
+            on_progress=lambda progress: reports.append(
+                (progress.chunks, progress.processed)),
+        )
+        assert reports == [(1, 5), (2, 10), (3, 15), (4, 20), (5, 23)]
+        assert progress.processed == 23
+        assert progress.last_pk == max(records)
+        failed_ids = set(pk for (pk, err) in progress.failures)
+        assert failed_ids == set(pk for pk in records if pk % 5 == 0)
+        assert all(
+            isinstance(err, ValueError) for (pk, err) in progress.failures)
+        assert progress.succeeded == 23 - len(failed_ids)
+
+        # Nothing is left in the session
+        assert not list(session)
+
+        for record in session.query(StreamedRecord):
+            if record.id in failed_ids:
+                assert record.state == 'new'
+                assert record.note is None
+            else:
+                assert record.state == 'archived'
+                assert record.note == 'done'
+
+    def test_filtered_and_resumed(self, session, records):
+        for record in session.query(StreamedRecord).filter(
+            StreamedRecord.id.in_(records[:10])
+        ):
+            record.hidden.set()
+        session.commit()
+
+        progress = stream.apply(
+            session,
+            session.query(StreamedRecord).filter(StreamedRecord.hidden()),
+            StreamedRecord.archived, kwargs={'note': 'resumed'},
+            chunk_size=3, start_after=records[4],
+        )
+        assert progress.processed == 5
+        assert progress.chunks == 2
+
+        archived = session.query(StreamedRecord).filter(
+            StreamedRecord.archived()).all()
+        assert set(el.id for el in archived) == set(
+            pk for pk in records[5:10] if pk % 5 != 0)
+
+    def test_invalid_source_reported(self, session, records):
+        progress = stream.apply(
+            session, session.query(StreamedRecord),
+            StreamedRecord.archived, args=('done', ),
+        )
+        progress = stream.apply(
+            session, session.query(StreamedRecord),
+            StreamedRecord.hidden,
+        )
+        assert progress.succeeded == len(
+            [pk for pk in records if pk % 5 == 0])
+        assert all(
+            isinstance(err, exc.InvalidSourceStateError)
+            for (pk, err) in progress.failures
+        )
@@ -0,0 +1,167 @@
+import pytest
+import sqlalchemy
+
+from sqlalchemy_fsm import FSMField, transition, exc
+from sqlalchemy_fsm.history import History
+from sqlalchemy_fsm.stream import tail, CursorStore, TailQueryCache
+
+from tests.conftest import Base, SessionGen
+
+
+history = History(Base.metadata, name='fsm_tail_history')
+cursors = CursorStore(Base.metadata, name='fsm_tail_cursor')
+
+
+class TailOrder(Base):
+    __tablename__ = 'tail_order'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+
+    def __init__(self, *args, **kwargs):
+        self.state = 'new'
+        super(TailOrder, self).__init__(*args, **kwargs)
+
+    @transition(source='new', target='paid')
+    def paid(self):
+        pass
+
+    @transition(source='paid', target='shipped')
+    def shipped(self):
+        pass
+
+
+class UntrackedOrder(Base):
+    __tablename__ = 'tail_untracked_order'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    state = sqlalchemy.Column(FSMField)
+
+
+history.track(TailOrder)
+
+
+def flatten(batches):
+    return [
+        (change.pk, change.source, change.target)
+        for batch in batches for change in batch
+    ]
+
+
+def get_last_id(session):
+    return session.execute(sqlalchemy.select([
+        sqlalchemy.func.coalesce(sqlalchemy.func.max(history.table.c.id), 0)
+    ])).scalar()
+
+
+class TestTail(object):
+
+    @pytest.fixture
+    def start(self, session):
+        return get_last_id(session)
+
+    @pytest.fixture
+    def orders(self, session, start):
+        out = [TailOrder() for _ in range(5)]
+        session.add_all(out)
+        session.flush()
+        for order in out:
+            order.paid.set()
+        session.flush()
+        out[0].shipped.set()
+        session.commit()
+        return out
+
+    def test_all(self, session, start, orders):
+        batches = list(tail(session, TailOrder, since=start, batch_size=2))
+        assert [len(batch) for batch in batches] == [2, 2, 2]
+        changes = flatten(batches)
+        assert changes == [
+            (order.id, 'new', 'paid') for order in orders
+        ] + [(orders[0].id, 'paid', 'shipped')]
+        ids = [change.id for batch in batches for change in batch]
+        assert ids == sorted(ids)
+        assert all(change.ts for change in batches[0])
+
+    def test_since_and_states(self, session, start, orders):
+        first = next(tail(session, TailOrder, since=start, batch_size=1))[0]
+        assert flatten(tail(session, TailOrder, since=first.id)) == [
+            (order.id, 'new', 'paid') for order in orders[1:]
+        ] + [(orders[0].id, 'paid', 'shipped')]
+        assert flatten(tail(
+            session, TailOrder, since=start, states=['shipped']
+        )) == [
+            (orders[0].id, 'paid', 'shipped')]
+
+    def test_query_cache_keys(self, session, start, orders):
+        TailQueryCache.cache.clear()
+        for batch_size in (1, 2, 3):
+            for states in (['paid'], ['shipped'], ['paid', 'shipped']):
+                list(tail(
+                    session, TailOrder, since=start, states=states,
+                    batch_size=batch_size
+                ))
+        # Batch sizes and state names are bind parameters
+        assert len(TailQueryCache.cache) == 1
+
+    def test_state_patterns(self, session, start, orders):
+        assert flatten(tail(
+            session, TailOrder, since=start, states=['new.*', 'shipped']
+        )) == [(orders[0].id, 'paid', 'shipped')]
+        assert flatten(tail(
+            session, TailOrder, since=start, states=['paid.*'])) == []
+        assert flatten(tail(
+            session, TailOrder, since=start, states=[])) == []
+        assert flatten(tail(
+            session, TailOrder, since=start, states='shipped'
+        )) == [(orders[0].id, 'paid', 'shipped')]
+        assert flatten(tail(
+            session, TailOrder, since=start, states='paid'
+        )) == [(order.id, 'new', 'paid') for order in orders]
+        assert len(flatten(tail(
+            session, TailOrder, since=start, states=['*']))) == 6
+
+    def consume(self, session, cursor, **kwargs):
+        out = []
+        for batch in tail(session, TailOrder, since=cursor, **kwargs):
+            out.extend(flatten([batch]))
+            cursor.ack(session, batch)
+            session.commit()
+        return out
+
+    def test_cursor(self, session, start, orders):
+        cursor = cursors.load(session, 'mailer', TailOrder)
+        assert cursor.position == 0
+        cursor.save(session, start)
+        session.commit()
+
+        # Consumer interrupted before acknowledging the second batch
+        stream = tail(session, TailOrder, since=cursor, batch_size=3)
+        cursor.ack(session, next(stream))
+        session.commit()
+        assert len(next(stream)) == 3
+        session.rollback()
+
+        cursor = cursors.load(SessionGen(), 'mailer', TailOrder)
+        assert cursor.position == start + 3
+        assert self.consume(session, cursor, batch_size=3) == [
+            (order.id, 'new', 'paid') for order in orders[3:]
+        ] + [(orders[0].id, 'paid', 'shipped')]
+
+        # The last batch is acknowledged too
+        cursor = cursors.load(SessionGen(), 'mailer', TailOrder)
+        assert cursor.position == start + 6
+        assert self.consume(session, cursor) == []
+
+        orders[1].shipped.set()
+        session.commit()
+        assert self.consume(session, cursor) == [
+            (orders[1].id, 'paid', 'shipped')]
+        assert self.consume(session, cursor) == []
+        cursor = cursors.load(SessionGen(), 'mailer', TailOrder)
+        assert self.consume(session, cursor) == []
+
+        other = cursors.load(session, 'audit', TailOrder)
+        assert other.position == 0
+
+    def test_untracked(self, session):
+        with pytest.raises(exc.SetupError):
+            next(tail(session, UntrackedOrder))
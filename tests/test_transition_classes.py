@@ -36,6 +36,22 @@ class SeparateDecoratedPublishHandler(object):
         instance.side_effect = "SeparatePublishHandler::did_two"
 
 
+def remember_instance(handler, instance):
+    handler.instance = instance
+    return True
+
+
+@transition(source='*', target='counted')
+class StatefulHandler(object):
+    """Keeps per-call state on the handler object."""
+
+    @transition(conditions=[remember_instance])
+    def count(self, instance):
+        assert self.instance is instance
+        self.calls = getattr(self, 'calls', 0) + 1
+        instance.side_effect = 'calls={}'.format(self.calls)
+
+
 class AltSyntaxBlogPost(Base):
 
     __tablename__ = 'AltSyntaxBlogPost'
@@ -55,6 +71,7 @@ class AltSyntaxBlogPost(Base):
     pre_decorated_publish = SeparateDecoratedPublishHandler
     post_decorated_publish = transition(target='post_decorated_publish')(
         SeparatePublishHandler)
+    counted = StatefulHandler
 
 
 class TestAltSyntaxBlogPost(object):
@@ -90,6 +107,25 @@ class TestAltSyntaxBlogPost(object):
         assert model.state == 'post_decorated_publish'
         assert model.side_effect == 'SeparatePublishHandler::did_two'
 
+    def test_bound_meta_shared_by_records(self, model):
+        other = AltSyntaxBlogPost()
+        bound_meta = model.pre_decorated_publish._sa_fsm_bound_meta
+        assert other.pre_decorated_publish._sa_fsm_bound_meta is bound_meta
+        assert bound_meta.target_state == 'pre_decorated_publish'
+        assert other.post_decorated_publish._sa_fsm_bound_meta.\
+            target_state == 'post_decorated_publish'
+        other.hide.set()
+        model.pre_decorated_publish.set()
+        other.pre_decorated_publish.set()
+        assert model.side_effect == 'SeparatePublishHandler::did_one'
+        assert other.side_effect == 'SeparatePublishHandler::did_two'
+
+    def test_handler_object_per_call(self, model):
+        other = AltSyntaxBlogPost()
+        for record in (model, other, model):
+            record.counted.set()
+            assert record.side_effect == 'calls=1'
+
     def mk_records(self, session, count):
         records = [AltSyntaxBlogPost() for idx in range(10)]
         session.add_all(records)